@@ -0,0 +1,256 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """统一全角/半角并折叠空白，让只差空格或标点宽度的文本命中同一条缓存"""
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+def text_analysis_key(text: str, role: str, context: Optional[List[str]], model: str, prompt_version: str) -> str:
+    payload = [
+        "text",
+        normalize_text(text),
+        role,
+        [normalize_text(msg) for msg in (context or [])],
+        model,
+        prompt_version,
+    ]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def message_analysis_key(pair_id: int, message_id, text: str, role: str, model: str, prompt_version: str) -> str:
+    """服务端组装上下文时的缓存键：配对中某条消息之前的对话已经固定，键只取消息本身。
+
+    滚动摘要会随对话推进不断刷新，计入键的话同一条消息隔一段时间再分析几乎不会命中；
+    摘要变化对已经分析过的消息影响很小，这里接受沿用先前的结果。文本计入键，消息ID被复用时不会串。
+    """
+    payload = ["message", int(pair_id), str(message_id), normalize_text(text), role, model, prompt_version]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class CacheBackend:
+    """共享缓存层接口，多个worker之间共享分析结果"""
+
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str, ttl: float):
+        raise NotImplementedError
+
+    async def check(self):
+        """健康检查，不可用时抛出异常"""
+        pass
+
+    async def close(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """进程内的共享层替身，用于本地开发和测试"""
+
+    def __init__(self):
+        self._data: Dict[str, tuple] = {}
+
+    async def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return value
+
+    async def set(self, key: str, value: str, ttl: float):
+        self._data[key] = (value, time.monotonic() + ttl)
+
+
+class RedisCacheBackend(CacheBackend):
+    def __init__(self, url: str, prefix: str = "analysis:"):
+        # redis 为可选依赖，只有配置了 redis 共享层时才需要安装
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self.client.get(self.prefix + key)
+        return value.decode("utf-8") if value is not None else None
+
+    async def set(self, key: str, value: str, ttl: float):
+        await self.client.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+    async def check(self):
+        await self.client.ping()
+
+    async def close(self):
+        await self.client.close()
+
+
+def create_cache_backend(name: Optional[str]) -> Optional[CacheBackend]:
+    name = (name or "").lower()
+    if not name or name == "none":
+        return None
+    if name == "memory":
+        return MemoryCacheBackend()
+    if name == "redis":
+        return RedisCacheBackend(os.getenv("ANALYSIS_CACHE_REDIS_URL", "redis://localhost:6379/0"))
+    raise ValueError(f"未知的分析缓存后端: {name}")
+
+
+class _Flight:
+    """一次进行中的计算，合并进来的调用方共用同一个任务"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.callers = 0
+
+
+class AnalysisCache:
+    """模型分析结果缓存：进程内LRU（带TTL）+ 可选共享层，并对相同的并发请求只调用一次模型"""
+
+    def __init__(self, max_entries: int = None, ttl: float = None, backend: Optional[CacheBackend] = None):
+        self.max_entries = max_entries or int(os.getenv("ANALYSIS_CACHE_SIZE", "10000"))
+        self.ttl = ttl or float(os.getenv("ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+        self.backend = backend
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, _Flight] = {}
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.compute_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def _get_local(self, key: str) -> Optional[str]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_local(self, key: str, value: str):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @property
+    def average_compute_seconds(self) -> float:
+        return self.compute_seconds / self.misses if self.misses else 0.0
+
+    def _record_hit(self):
+        # 每次命中按平均模型耗时估算节省的时间
+        self.saved_seconds += self.average_compute_seconds
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        value = self._get_local(key)
+        if value is not None:
+            self.local_hits += 1
+            self._record_hit()
+            return value
+
+        # 相同请求正在计算中，等待同一个结果
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            self._record_hit()
+        else:
+            flight = self._inflight[key] = _Flight(asyncio.create_task(self._fill(key, compute)))
+            flight.task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        flight.callers += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # 所有等待者都放弃了才取消计算，先发起的请求被取消不影响其他等待者
+            flight.callers -= 1
+            if flight.callers == 0:
+                flight.task.cancel()
+            raise
+
+    async def _fill(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        value = await self._get_shared(key)
+        if value is not None:
+            self.shared_hits += 1
+            self._record_hit()
+        else:
+            started = time.monotonic()
+            value = await compute()
+            self.misses += 1
+            self.compute_seconds += time.monotonic() - started
+            await self._set_shared(key, value)
+        self._set_local(key, value)
+        return value
+
+    async def get(self, key: str) -> Optional[str]:
+        """只查缓存，不触发计算（流式分析先查缓存，生成完成后再调用 set 写入）"""
+        value = self._get_local(key)
+        if value is not None:
+            self.local_hits += 1
+            self._record_hit()
+            return value
+        value = await self._get_shared(key)
+        if value is not None:
+            self.shared_hits += 1
+            self._record_hit()
+            self._set_local(key, value)
+        return value
+
+    async def set(self, key: str, value: str, compute_seconds: float = 0.0):
+        self.misses += 1
+        self.compute_seconds += compute_seconds
+        self._set_local(key, value)
+        await self._set_shared(key, value)
+
+    async def _get_shared(self, key: str) -> Optional[str]:
+        if self.backend is None:
+            return None
+        try:
+            return await self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"读取共享分析缓存失败: {str(e)}")
+            return None
+
+    async def _set_shared(self, key: str, value: str):
+        if self.backend is None:
+            return
+        try:
+            await self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            logger.warning(f"写入共享分析缓存失败: {str(e)}")
+
+    def stats(self) -> Dict:
+        hits = self.local_hits + self.shared_hits + self.coalesced
+        total = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "local_hits": self.local_hits,
+            "shared_hits": self.shared_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "average_model_seconds": self.average_compute_seconds,
+            "saved_seconds": self.saved_seconds,
+        }
+
+    async def check(self):
+        if self.backend is not None:
+            await self.backend.check()
+
+    async def close(self):
+        if self.backend is not None:
+            await self.backend.close()
@@ -0,0 +1,45 @@
+"""把较早的聊天记录归档到对象存储（冷数据层）
+
+每个配对保留最新的 HISTORY_HOT_MIN 条消息在 chat_messages 中，其余超过 HISTORY_HOT_DAYS 天的消息
+压缩成不可变的分段上传，索引记录在 history_segments 中，随后从热表删除。历史查询会自动合并两层。
+可以在服务运行期间反复执行，也可以用 HISTORY_ARCHIVE_INTERVAL 让服务定时执行。
+
+用法:
+    python archive_history.py [--pair-id N] [--hot-days 30] [--hot-min 200]
+"""
+import argparse
+import logging
+
+from db_manager import DatabaseManager
+from history_archive import HistoryArchive
+from object_storage import create_archive_bucket
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="归档较早的聊天记录到对象存储")
+    parser.add_argument("--pair-id", type=int, help="只归档指定的配对")
+    parser.add_argument("--hot-days", type=float, help="热表保留的天数（默认 HISTORY_HOT_DAYS）")
+    parser.add_argument("--hot-min", type=int, help="每个配对至少保留在热表中的消息数（默认 HISTORY_HOT_MIN）")
+    args = parser.parse_args()
+
+    db = DatabaseManager()
+    db.archive = HistoryArchive(create_archive_bucket(), hot_days=args.hot_days, hot_min=args.hot_min)
+    try:
+        if args.pair_id is not None:
+            messages = db.archive_pair(args.pair_id)
+            logger.info(f"配对 {args.pair_id} 归档 {messages} 条消息")
+        else:
+            pairs, messages = db.archive_history()
+            logger.info(f"{pairs} 个配对共归档 {messages} 条消息")
+    except Exception as e:
+        logger.error(f"归档失败: {e}")
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import json
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+from analysis_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# 模型输出里第一个JSON数组（模型偶尔会在数组前后加说明文字或代码块标记）
+JSON_ARRAY_PATTERN = re.compile(r"\[.*\]", re.S)
+
+ROLE_LABELS = {
+    "elder": ("年轻人", "用简单易懂的方式", "👴"),
+    "young": ("老人", "用年轻人易懂的方式", "👱"),
+}
+
+
+def dedupe_messages(messages: List[Tuple[str, str]]) -> Tuple[List[str], Dict[str, List[str]]]:
+    """按归一化后的文本去重，返回 (去重后的文本列表, 文本 -> 消息ID列表)"""
+    texts: List[str] = []
+    ids_by_text: Dict[str, List[str]] = {}
+    for message_id, text in messages:
+        normalized = normalize_text(text)
+        if not normalized:
+            continue
+        if normalized not in ids_by_text:
+            ids_by_text[normalized] = []
+            texts.append(normalized)
+        ids_by_text[normalized].append(message_id)
+    return texts, ids_by_text
+
+
+def pack_batches(texts: List[str], max_chars: int, max_items: int) -> List[List[str]]:
+    """按输入字数和条数上限把文本装进尽量少的批次（保持原有顺序，便于模型参考前后文）"""
+    batches: List[List[str]] = []
+    current: List[str] = []
+    size = 0
+    for text in texts:
+        if current and (size + len(text) > max_chars or len(current) >= max_items):
+            batches.append(current)
+            current, size = [], 0
+        current.append(text)
+        size += len(text)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_batch_prompt(texts: List[str], role: str, context: Optional[List[str]] = None, summary: str = "") -> str:
+    speaker, style, emoji = ROLE_LABELS.get(role, ROLE_LABELS["elder"])
+    context_str = "\n".join(f"上下文消息 {i + 1}: {msg}" for i, msg in enumerate(context or []))
+    items_str = "\n".join(f"{i + 1}. {text}" for i, text in enumerate(texts))
+    summary_str = f"对话摘要:\n{summary}\n\n" if summary else ""
+    return f"""请结合以下聊天上下文，{style}逐条解释{speaker}说的话：
+
+{summary_str}聊天上下文:
+{context_str}
+
+需要解释的话（按编号）:
+{items_str}
+
+对每一条给出：解释含义(10字内)、智能转换{emoji}(15字内)、原因(10字内)。
+只输出一个JSON数组，不要输出其他内容，每条一个对象，格式如下：
+[{{"no": 1, "meaning": "解释含义", "translation": "智能转换", "reason": "原因"}}]"""
+
+
+def format_analysis(item: Dict, role: str) -> str:
+    """与单条分析的输出格式保持一致，前端无需区分来源"""
+    emoji = ROLE_LABELS.get(role, ROLE_LABELS["elder"])[2]
+    return (
+        f"1. 解释含义：{item.get('meaning', '')}\n"
+        f"2. 智能转换{emoji}：{item.get('translation', '')}\n"
+        f"3. 原因：{item.get('reason', '')}"
+    )
+
+
+def parse_batch_output(output: str, texts: List[str], role: str) -> Dict[str, str]:
+    """解析模型返回的JSON数组，返回 文本 -> 分析结果；缺失或格式不对的条目不出现在结果中"""
+    match = JSON_ARRAY_PATTERN.search(output or "")
+    if match is None:
+        logger.warning("批量分析输出中没有JSON数组")
+        return {}
+    try:
+        items = json.loads(match.group(0))
+    except ValueError as e:
+        logger.warning(f"批量分析输出无法解析: {str(e)}")
+        return {}
+
+    results = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        try:
+            index = int(item.get("no")) - 1
+        except (TypeError, ValueError):
+            continue
+        if 0 <= index < len(texts) and item.get("translation"):
+            results[texts[index]] = format_analysis(item, role)
+    return results
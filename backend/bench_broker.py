@@ -0,0 +1,103 @@
+"""多worker消息路由压测：每个worker进程通过 SocketBroker 向下一个worker上的用户发送消息，
+统计跨进程投递的吞吐（条/秒）和延迟分位数
+
+用法: python bench_broker.py --workers 4 --messages 20000 [--rate 0] [--payload 200]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import statistics
+import time
+
+from message_broker import BrokerHub, SocketBroker, client_channel
+
+
+async def _worker(index: int, args, ready, start, results):
+    broker = SocketBroker(port=args.port, start_hub=False)
+    await broker.start()
+    per_worker = args.messages // args.workers
+    latencies = []
+    done = asyncio.Event()
+
+    async def on_message(message):
+        latencies.append(time.time() - message["sent_at"])
+        if len(latencies) >= per_worker:
+            done.set()
+
+    await broker.subscribe(client_channel(f"bench_{index}"), on_message)
+    await broker.set_online(f"bench_{index}")
+    ready.wait()
+    start.wait()
+
+    recipient = client_channel(f"bench_{(index + 1) % args.workers}")
+    payload = "x" * args.payload
+    interval = args.workers / args.rate if args.rate else 0
+    began = time.time()
+    for i in range(per_worker):
+        await broker.publish(recipient, {"seq": i, "message": payload, "sent_at": time.time()})
+        if interval:
+            await asyncio.sleep(max(0.0, began + (i + 1) * interval - time.time()))
+        elif i % 100 == 0:
+            await asyncio.sleep(0)
+
+    try:
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    results.put((index, latencies, time.time()))
+    await broker.close()
+
+
+def _run_worker(index, args, ready, start, results):
+    asyncio.run(_worker(index, args, ready, start, results))
+
+
+async def _main(args):
+    hub = BrokerHub()
+    await hub.start("127.0.0.1", args.port)
+
+    ready = multiprocessing.Barrier(args.workers + 1)
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_run_worker, args=(i, args, ready, start, results))
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, ready.wait)
+    began = time.time()
+    start.set()
+
+    collected = [await loop.run_in_executor(None, results.get) for _ in processes]
+    for process in processes:
+        process.join()
+    await hub.close()
+
+    latencies = sorted(latency for _, worker_latencies, _ in collected for latency in worker_latencies)
+    finished = max(end for _, _, end in collected)
+    expected = args.messages // args.workers * args.workers
+    elapsed = finished - began
+    print(f"workers={args.workers} 发送={expected} 送达={len(latencies)} 耗时={elapsed:.2f}s")
+    if latencies:
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(f"吞吐: {len(latencies) / elapsed:.0f} 条/秒")
+        print(f"延迟(ms): p50={quantiles[49] * 1000:.2f} p95={quantiles[94] * 1000:.2f} "
+              f"p99={quantiles[98] * 1000:.2f} max={latencies[-1] * 1000:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多worker消息路由压测")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=20000, help="所有worker合计发送的消息数")
+    parser.add_argument("--rate", type=float, default=0, help="合计发送速率（条/秒），0 表示不限速")
+    parser.add_argument("--payload", type=int, default=200, help="消息正文字节数")
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--timeout", type=float, default=30)
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""数据库连接池压测：大量配对同时写消息、读历史，统计操作延迟、从连接池取连接的等待时间和事件循环延迟
+
+每个配对一个协程，按间隔交替执行 save_messages 和 get_messages。事件循环延迟由一个每 10ms 醒来一次的
+协程测量（实际醒来时间比预定晚多少）。--blocking 时在事件循环里直接调用同步的 DatabaseManager
+（查询移到线程池之前的写法），作为对照。默认使用临时目录里的 SQLite，--db mysql 时使用 .env 中的 MySQL 配置。
+
+用法: python bench_db_pool.py [--pairs 200] [--duration 10] [--interval 0.05] [--pool-max 10] [--blocking]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+
+LAG_TICK = 0.01
+
+
+def _quantiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+    values = sorted(values)
+    if len(values) == 1:
+        return {"p50": values[0], "p99": values[0], "max": values[0]}
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p99": quantiles[98], "max": values[-1]}
+
+
+def _timed_acquire(pool, waits: List[float]):
+    # 记录每次取连接的等待时间（包括新建连接和健康检查）
+    acquire = pool.acquire
+
+    def timed():
+        started = time.perf_counter()
+        try:
+            return acquire()
+        finally:
+            waits.append(time.perf_counter() - started)
+
+    pool.acquire = timed
+
+
+async def _loop_lag(stop: asyncio.Event, lags: List[float]):
+    while not stop.is_set():
+        expected = time.perf_counter() + LAG_TICK
+        await asyncio.sleep(LAG_TICK)
+        lags.append(max(0.0, time.perf_counter() - expected))
+
+
+async def _pair(args, db, pair_id: int, ids, stop: asyncio.Event, latencies: Dict[str, List[float]], errors):
+    blocking = args.blocking
+    while not stop.is_set():
+        message_id = next(ids)
+        message = {
+            "message_id": message_id, "from_role": f"elder_{pair_id}", "to_role": f"young_{pair_id}",
+            "message_type": "text", "message_content": f"消息{message_id}", "image_data": None,
+            "pair_id": pair_id, "seq": message_id,
+        }
+        for op, call in (("save_messages", lambda: db.save_messages([message])),
+                         ("get_messages", lambda: db.get_messages(pair_id, 50))):
+            started = time.perf_counter()
+            try:
+                if blocking:
+                    call()
+                else:
+                    await call()
+                latencies[op].append(time.perf_counter() - started)
+            except Exception:
+                errors[op] = errors.get(op, 0) + 1
+        await asyncio.sleep(args.interval)
+
+
+async def _main(args):
+    if args.db == "sqlite":
+        workdir = tempfile.mkdtemp(prefix="bench_db_pool_")
+        os.environ.update({"DB_BACKEND": "sqlite", "DB_SQLITE_PATH": os.path.join(workdir, "bench.db")})
+    os.environ["DB_POOL_MAX"] = str(args.pool_max)
+
+    from db_manager import AsyncDatabaseManager, DatabaseManager
+
+    manager = DatabaseManager()
+    manager.ensure_schema()
+    waits: List[float] = []
+    _timed_acquire(manager.pool, waits)
+    db = manager if args.blocking else AsyncDatabaseManager(manager)
+
+    stop = asyncio.Event()
+    lags: List[float] = []
+    latencies: Dict[str, List[float]] = {"save_messages": [], "get_messages": []}
+    errors: Dict[str, int] = {}
+    ids = itertools.count(int(time.time() * 1000) * 1000)
+    lag_task = asyncio.create_task(_loop_lag(stop, lags))
+    pairs = [asyncio.create_task(_pair(args, db, pair_id, ids, stop, latencies, errors))
+             for pair_id in range(1, args.pairs + 1)]
+    started = time.monotonic()
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(lag_task, *pairs)
+    elapsed = time.monotonic() - started
+    db.close()
+
+    mode = "事件循环内直接查询" if args.blocking else "线程池 + 连接池"
+    print(f"模式: {mode}  后端: {args.db}  配对: {args.pairs}  连接池上限: {args.pool_max}  耗时: {elapsed:.1f}s")
+    print(f"{'指标':<16}{'次数':>8}{'错误':>6}{'吞吐(/s)':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    rows = [(op, values) for op, values in latencies.items()]
+    rows += [("pool_wait", waits), ("event_loop_lag", lags)]
+    for name, values in rows:
+        stats = _quantiles(values)
+        throughput = len(values) / elapsed if name in latencies else 0
+        print(f"{name:<16}{len(values):>8}{errors.get(name, 0):>6}{throughput:>10.1f}"
+              f"{stats['p50'] * 1000:>10.2f}{stats['p99'] * 1000:>10.2f}{stats['max'] * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="数据库连接池压测")
+    parser.add_argument("--pairs", type=int, default=200, help="同时读写的配对数")
+    parser.add_argument("--duration", type=float, default=10, help="压测时长（秒）")
+    parser.add_argument("--interval", type=float, default=0.05, help="每个配对两轮读写之间的间隔（秒）")
+    parser.add_argument("--pool-max", type=int, default=10, help="连接池最大连接数（DB_POOL_MAX）")
+    parser.add_argument("--db", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--blocking", action="store_true", help="在事件循环里直接调用同步查询作为对照")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
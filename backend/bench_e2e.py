@@ -0,0 +1,609 @@
+"""端到端压测：在本地替身上启动完整的 FastAPI 应用，模拟大量长辈/年轻人配对的 WebSocket 聊天，
+同时发起文本/批量/表情包分析、表情包搜索、图片上传和历史消息查询，统计各场景的吞吐、p50/p99 延迟和服务进程内存
+
+本地替身：延迟可配的 DashScope 桩（在模型调用线程里 sleep，返回与SDK相同结构的响应）、本地目录 OSS
+（OSS_BACKEND=local）、假表情包搜索API（同时提供表情包图片下载）和临时目录里的 SQLite。
+服务端在子进程中运行，与真实部署一样独占一个事件循环；压测客户端在主进程中运行。
+
+结果写入 bench_results/e2e-<时间>.json；--save-baseline 同时保存为基线，--baseline 与基线比较，
+p99 延迟、吞吐、错误率或内存峰值超出容差时以非0状态退出，可放在CI里发现 websocket_endpoint、
+DatabaseManager 和各分析器的性能回退。
+
+用法: python bench_e2e.py --pairs 1000 --duration 60 [--interval 2] [--model-latency 0.8]
+      python bench_e2e.py --pairs 200 --duration 20 --save-baseline
+      python bench_e2e.py --pairs 200 --duration 20 --baseline bench_results/baseline.json
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sqlite3
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import httpx
+from websockets.asyncio.client import connect
+
+from frame_codec import JSON_CODEC, MSGPACK_CODEC, MSGPACK_SUBPROTOCOL
+
+SAMPLE_TEXTS = [
+    "吃饭了吗", "今天天气不错，出去走走吧", "yyds", "绝绝子，这也太好看了吧！", "我明天下午回家",
+    "记得按时吃药，别忘了量血压", "哈哈哈哈哈哈", "emo了", "周末一起去公园拍照怎么样？", "好的收到",
+    "这波操作666", "破防了家人们", "躺平了，不想上班", "你是懂生活的", "栓Q",
+]
+SAMPLE_KEYWORDS = ["开心", "哈哈", "加油", "晚安", "点赞", "无语", "震惊", "谢谢", "抱抱", "吃饭"]
+ANALYSIS_TEXT = "1. 解释含义：表示非常满意\n2. 智能转换👴：真是太好了\n3. 原因：网络流行语"
+EMOJI_ANALYSIS_TEXT = "开心→真高兴\n原因:表情包里的人物在笑"
+BATCH_ITEMS_PATTERN = re.compile(r"需要解释的话（按编号）:\n(.*?)\n\n", re.S)
+IMAGE_VARIANTS = 200
+
+# 各HTTP场景在混合流量中的权重
+HTTP_MIX = {
+    "analyze_text": 30,
+    "analyze_batch": 5,
+    "analyze_emoji": 15,
+    "search_emojis": 20,
+    "upload_image": 10,
+    "get_messages": 20,
+}
+
+
+# ---- 本地替身（在服务端子进程中使用） ----
+
+def _response(text: str):
+    # 同时满足 Generation（output.text）和 MultiModalConversation（output.choices）两种读取方式
+    message = SimpleNamespace(content=[{"text": text}])
+    output = SimpleNamespace(text=text, choices=[SimpleNamespace(message=message)])
+    return SimpleNamespace(status_code=200, message="", output=output)
+
+
+class FakeDashScope:
+    """DashScope SDK 的替身：在调用线程中 sleep 模拟生成耗时，流式调用把耗时平均分到各段"""
+
+    def __init__(self, latency: float, jitter: float, chunks: int = 5):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunks = chunks
+
+    def _delay(self) -> float:
+        return max(0.0, random.uniform(self.latency * (1 - self.jitter), self.latency * (1 + self.jitter)))
+
+    def _reply(self, text: str, stream: bool):
+        if not stream:
+            time.sleep(self._delay())
+            return _response(text)
+        return self._stream(text)
+
+    def _stream(self, text: str):
+        step = max(1, len(text) // self.chunks)
+        pause = self._delay() / self.chunks
+        for i in range(0, len(text), step):
+            time.sleep(pause)
+            yield _response(text[i:i + step])
+
+    def generation_call(self, model=None, prompt: str = "", stream: bool = False, **kwargs):
+        match = BATCH_ITEMS_PATTERN.search(prompt)
+        if match:
+            count = len(match.group(1).splitlines())
+            text = json.dumps([{"no": i + 1, "meaning": "含义", "translation": "转换", "reason": "原因"}
+                               for i in range(count)], ensure_ascii=False)
+        else:
+            text = ANALYSIS_TEXT
+        return self._reply(text, stream)
+
+    def multimodal_call(self, model=None, messages=None, stream: bool = False, **kwargs):
+        return self._reply(EMOJI_ANALYSIS_TEXT, stream)
+
+
+@lru_cache(maxsize=IMAGE_VARIANTS * 2)
+def sample_png(seed: int, size: int = 96) -> bytes:
+    """按种子生成的随机色块图，不同种子的感知哈希不同"""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    cells = 8
+    image = Image.new("RGB", (cells, cells))
+    image.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(cells * cells)])
+    buffer = io.BytesIO()
+    image.resize((size, size)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def create_fake_emoji_app(latency: float, base_url: str):
+    """假表情包搜索API：返回指向自身 /img/ 的表情包URL，同一关键词的结果固定"""
+    from fastapi import FastAPI, Response
+
+    app = FastAPI()
+
+    @app.get("/api")
+    async def search(words: str, limit: int = 10):
+        await asyncio.sleep(latency)
+        seed = sum(map(ord, words))
+        return {"code": 200, "res": [f"{base_url}/img/{(seed + i) % IMAGE_VARIANTS}.png" for i in range(limit)]}
+
+    @app.get("/img/{seed}.png")
+    async def image(seed: int):
+        return Response(sample_png(seed), media_type="image/png")
+
+    return app
+
+
+def configure_environment(args, workdir: str):
+    """在导入 main 之前设置环境变量，让应用使用本地替身"""
+    os.environ.update({
+        "DASHSCOPE_API_KEY": "bench",
+        "OSS_BACKEND": "local",
+        "OSS_LOCAL_DIR": os.path.join(workdir, "oss"),
+        "OSS_LOCAL_BASE_URL": f"http://127.0.0.1:{args.port}/oss",
+        "EMOJI_API_URL": f"http://127.0.0.1:{args.emoji_port}/api",
+        "EMOJI_API_ID": "bench",
+        "EMOJI_API_KEY": "bench",
+        "EMOJI_CATALOG_PATH": os.path.join(workdir, "emoji_catalog.jsonl"),
+        "EMOJI_HASH_INDEX_PATH": os.path.join(workdir, "emoji_hash_index.jsonl"),
+        "EMOJI_FETCH_ALLOW_PRIVATE": "1",
+        "ANALYSIS_CACHE_BACKEND": "memory",
+        "MESSAGE_BROKER": "memory",
+        "PRETRANSLATE_DEFAULT": "1" if args.pretranslate else "0",
+        "LOG_SAMPLE_RATE": "0",
+    })
+    if args.db == "sqlite":
+        os.environ.update({"DB_BACKEND": "sqlite", "DB_SQLITE_PATH": os.path.join(workdir, "bench.db")})
+
+
+async def _serve(args, workdir: str, ready, stop):
+    import logging
+
+    import uvicorn
+
+    configure_environment(args, workdir)
+    import dashscope
+    import main
+
+    logging.getLogger().setLevel(args.log_level.upper())
+    fake = FakeDashScope(args.model_latency, args.model_jitter)
+    dashscope.Generation.call = fake.generation_call
+    dashscope.MultiModalConversation.call = fake.multimodal_call
+
+    servers = [
+        uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning",
+                                      backlog=4096)),
+        uvicorn.Server(uvicorn.Config(create_fake_emoji_app(args.emoji_latency, f"http://127.0.0.1:{args.emoji_port}"),
+                                      host="127.0.0.1", port=args.emoji_port, log_level="warning", backlog=4096)),
+    ]
+    # 由主进程通过 stop 事件结束，服务端正常关闭（包括写入队列落库）
+    async def watch():
+        while not all(server.started for server in servers):
+            await asyncio.sleep(0.05)
+        ready.set()
+        while not stop.is_set():
+            await asyncio.sleep(0.2)
+        for server in servers:
+            server.should_exit = True
+
+    await asyncio.gather(watch(), *(server.serve() for server in servers))
+
+
+def _run_server(args, workdir, ready, stop):
+    asyncio.run(_serve(args, workdir, ready, stop))
+
+
+# ---- 统计 ----
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def observe(self, scenario: str, seconds: float):
+        self.samples.setdefault(scenario, []).append(seconds)
+
+    def error(self, scenario: str, count: int = 1):
+        self.errors[scenario] = self.errors.get(scenario, 0) + count
+
+    def summary(self, elapsed: float) -> Dict[str, Dict]:
+        results = {}
+        for scenario in sorted(set(self.samples) | set(self.errors)):
+            values = sorted(self.samples.get(scenario, []))
+            errors = self.errors.get(scenario, 0)
+            results[scenario] = {
+                "count": len(values),
+                "errors": errors,
+                "error_rate": errors / (len(values) + errors) if values or errors else 0.0,
+                "throughput": len(values) / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(values, 0.5) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "max_ms": (values[-1] if values else 0.0) * 1000,
+            }
+        return results
+
+
+class MemorySampler:
+    """定时读取服务进程的 RSS（Linux /proc），记录峰值"""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.path = f"/proc/{pid}/status"
+        self.interval = interval
+        self.peak_kb = 0
+        self.last_kb = 0
+
+    def _read(self, field: str) -> Optional[int]:
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    if line.startswith(field + ":"):
+                        return int(line.split()[1])
+        except OSError:
+            return None
+        return None
+
+    def sample(self):
+        rss = self._read("VmRSS")
+        if rss is not None:
+            self.last_kb = rss
+            self.peak_kb = max(self.peak_kb, rss, self._read("VmHWM") or 0)
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def result(self) -> Dict:
+        return {"rss_peak_mb": round(self.peak_kb / 1024, 1), "rss_end_mb": round(self.last_kb / 1024, 1)}
+
+
+# ---- 压测客户端 ----
+
+class ChatPair:
+    """一对长辈/年轻人连接。每个连接定时给对方发消息，记录回执（ack）延迟和对方收到的端到端延迟"""
+
+    def __init__(self, args, pair_id: int, ids, recorder: Recorder, codec):
+        self.args = args
+        self.pair_id = pair_id
+        self.ids = ids
+        self.recorder = recorder
+        self.codec = codec
+        self.clients = {f"elder_{pair_id}": f"young_{pair_id}", f"young_{pair_id}": f"elder_{pair_id}"}
+        self.sockets = {}
+        self.ack_pending: Dict[int, float] = {}
+        self.deliver_pending: Dict[int, float] = {}
+        self.sent = 0
+
+    async def connect(self, limiter: asyncio.Semaphore):
+        subprotocols = [MSGPACK_SUBPROTOCOL] if self.codec is not JSON_CODEC else None
+        for client_id in self.clients:
+            async with limiter:
+                started = time.perf_counter()
+                try:
+                    self.sockets[client_id] = await connect(
+                        f"ws://127.0.0.1:{self.args.port}/ws/{client_id}?pair_id={self.pair_id}",
+                        subprotocols=subprotocols, open_timeout=30, max_queue=None,
+                    )
+                except Exception:
+                    self.recorder.error("ws_connect")
+                    continue
+                self.recorder.observe("ws_connect", time.perf_counter() - started)
+
+    async def _receive(self, client_id: str):
+        async for raw in self.sockets[client_id]:
+            frame = self.codec.decode(raw) if isinstance(raw, bytes) else JSON_CODEC.decode(raw)
+            now = time.perf_counter()
+            kind = frame.get("type")
+            if kind == "ack":
+                started = self.ack_pending.pop(frame.get("id"), None)
+                if started is not None:
+                    self.recorder.observe("ws_ack", now - started)
+            elif kind in ("text", "emoji"):
+                started = self.deliver_pending.pop(frame.get("id"), None)
+                if started is not None:
+                    self.recorder.observe("ws_deliver", now - started)
+            elif kind == "ping":
+                await self.sockets[client_id].send(self.codec.encode({"type": "pong"}))
+
+    async def _send(self, client_id: str, stop_at: float, rng: random.Random):
+        websocket = self.sockets[client_id]
+        await asyncio.sleep(rng.uniform(0, self.args.interval))
+        while time.monotonic() < stop_at:
+            message_id = next(self.ids)
+            frame = {"id": message_id, "from": client_id, "to": self.clients[client_id], "pair_id": self.pair_id}
+            if rng.random() < 0.8:
+                frame.update(type="text", message=rng.choice(SAMPLE_TEXTS))
+            else:
+                frame.update(type="emoji", image_data=f"http://127.0.0.1:{self.args.emoji_port}/img/"
+                                                      f"{rng.randrange(IMAGE_VARIANTS)}.png")
+            started = time.perf_counter()
+            self.ack_pending[message_id] = started
+            self.deliver_pending[message_id] = started
+            try:
+                await websocket.send(self.codec.encode(frame))
+            except Exception:
+                self.recorder.error("ws_send")
+                return
+            self.sent += 1
+            await asyncio.sleep(self.args.interval)
+
+    async def run(self, stop_at: float, drain: float):
+        if len(self.sockets) < 2:
+            return
+        rng = random.Random(self.pair_id)
+        receivers = [asyncio.create_task(self._receive(client_id)) for client_id in self.sockets]
+        await asyncio.gather(*(self._send(client_id, stop_at, rng) for client_id in self.sockets))
+        # 停止发送后等待在途消息，仍未送达的算作丢失
+        deadline = time.monotonic() + drain
+        while (self.ack_pending or self.deliver_pending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self.recorder.error("ws_ack", len(self.ack_pending))
+        self.recorder.error("ws_deliver", len(self.deliver_pending))
+        for task in receivers:
+            task.cancel()
+
+    async def close(self):
+        await asyncio.gather(*(websocket.close() for websocket in self.sockets.values()), return_exceptions=True)
+
+
+class HttpLoad:
+    """按 HTTP_MIX 的权重混合发起分析、搜索、上传和历史查询请求"""
+
+    def __init__(self, args, recorder: Recorder):
+        self.args = args
+        self.recorder = recorder
+        self.base_url = f"http://127.0.0.1:{args.port}"
+        self.emoji_base = f"http://127.0.0.1:{args.emoji_port}"
+        self.scenarios = list(HTTP_MIX)
+        self.weights = [HTTP_MIX[name] for name in self.scenarios]
+
+    def _text(self, rng: random.Random) -> str:
+        # 文本有一定重复，分析缓存的命中率随压测时间上升，与线上相近
+        return f"{rng.choice(SAMPLE_TEXTS)}{rng.randrange(self.args.text_variety)}"
+
+    def _request(self, scenario: str, rng: random.Random):
+        pair_id = rng.randint(1, self.args.pairs)
+        role = rng.choice(("elder", "young"))
+        if scenario == "analyze_text":
+            return "POST", "/api/analyze_text", {"json": {"text": self._text(rng), "role": role, "pair_id": pair_id}}
+        if scenario == "analyze_batch":
+            messages = [{"id": i, "text": self._text(rng)} for i in range(rng.randint(5, 30))]
+            return "POST", "/api/analyze_batch", {"json": {"pair_id": pair_id, "role": role, "messages": messages}}
+        if scenario == "analyze_emoji":
+            image_url = f"{self.emoji_base}/img/{rng.randrange(IMAGE_VARIANTS)}.png"
+            return "POST", "/api/analyze_emoji", {"json": {"image_url": image_url, "role": role}}
+        if scenario == "search_emojis":
+            words = f"{rng.choice(SAMPLE_KEYWORDS)}{rng.randrange(self.args.text_variety)}"
+            return "POST", "/api/search_emojis", {"json": {"text": words, "limit": 5}}
+        if scenario == "upload_image":
+            data = sample_png(IMAGE_VARIANTS + rng.randrange(self.args.upload_variety), size=256)
+            return "POST", "/api/upload_image", {"files": {"image": ("photo.png", data, "image/png")}}
+        return "GET", "/api/get_messages", {"params": {"pair_id": pair_id, "limit": 50}}
+
+    async def _worker(self, client: httpx.AsyncClient, index: int, stop_at: float):
+        rng = random.Random(index)
+        while time.monotonic() < stop_at:
+            scenario = rng.choices(self.scenarios, self.weights)[0]
+            method, path, kwargs = self._request(scenario, rng)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+            except httpx.HTTPError:
+                self.recorder.error(scenario)
+                continue
+            if response.status_code == 200:
+                self.recorder.observe(scenario, time.perf_counter() - started)
+            else:
+                self.recorder.error(scenario)
+
+    async def run(self, stop_at: float):
+        limits = httpx.Limits(max_connections=self.args.http_concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=60, limits=limits) as client:
+            await asyncio.gather(*(self._worker(client, i, stop_at) for i in range(self.args.http_concurrency)))
+
+    async def fetch_json(self, path: str) -> Dict:
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=10) as client:
+            return (await client.get(path)).json()
+
+    async def register_pairs(self, pair_ids, concurrency: int):
+        """通过 /api/pairs 注册压测用的配对，未注册的用户连接会被拒绝"""
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=30, limits=limits) as client:
+            limiter = asyncio.Semaphore(concurrency)
+
+            async def register(pair_id):
+                async with limiter:
+                    response = await client.post("/api/pairs", json={"pair_id": pair_id})
+                    # 409: 配对已存在
+                    if response.status_code not in (200, 409):
+                        response.raise_for_status()
+
+            await asyncio.gather(*(register(pair_id) for pair_id in pair_ids))
+
+
+def raise_fd_limit():
+    # 每个配对两条连接，几千个配对需要的文件描述符超过常见的默认上限1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def drive(args, server_pid: int) -> Dict:
+    recorder = Recorder()
+    sampler = MemorySampler(server_pid)
+    sampling = asyncio.create_task(sampler.run())
+    codec = MSGPACK_CODEC if args.codec == "msgpack" else JSON_CODEC
+    ids = itertools.count(int(time.time() * 1000) * 1000)
+
+    http = HttpLoad(args, recorder)
+    started = time.monotonic()
+    await http.register_pairs(range(1, args.pairs + 1), args.connect_concurrency)
+    print(f"注册 {args.pairs} 个配对，耗时 {time.monotonic() - started:.1f}s")
+
+    pairs = [ChatPair(args, pair_id, ids, recorder, codec) for pair_id in range(1, args.pairs + 1)]
+    limiter = asyncio.Semaphore(args.connect_concurrency)
+    started = time.monotonic()
+    await asyncio.gather(*(pair.connect(limiter) for pair in pairs))
+    print(f"建立 {sum(len(pair.sockets) for pair in pairs)} 条连接，耗时 {time.monotonic() - started:.1f}s")
+
+    started = time.monotonic()
+    stop_at = started + args.duration
+    await asyncio.gather(http.run(stop_at), *(pair.run(stop_at, args.drain) for pair in pairs))
+    elapsed = min(time.monotonic() - started, args.duration)
+
+    model_stats = await http.fetch_json("/api/model_calls/stats")
+    sampler.sample()
+    sampling.cancel()
+    await asyncio.gather(*(pair.close() for pair in pairs))
+    return {
+        "scenarios": recorder.summary(elapsed),
+        "memory": sampler.result(),
+        "server": {
+            "messages_sent": sum(pair.sent for pair in pairs),
+            "model_calls": model_stats.get("model_calls"),
+            "model_calls_coalesced": model_stats.get("model_coalesced"),
+        },
+    }
+
+
+def count_persisted(db_path: str) -> Optional[int]:
+    try:
+        with sqlite3.connect(db_path) as conn:
+            return conn.execute("SELECT COUNT(*) FROM chat_messages").fetchone()[0]
+    except sqlite3.Error:
+        return None
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ---- 结果与基线比较 ----
+
+def print_report(result: Dict):
+    print(f"{'场景':<16}{'次数':>9}{'错误':>7}{'吞吐(/s)':>11}{'p50(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for name, stats in result["scenarios"].items():
+        print(f"{name:<16}{stats['count']:>9}{stats['errors']:>7}{stats['throughput']:>11.1f}"
+              f"{stats['p50_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    memory, server = result["memory"], result["server"]
+    print(f"服务进程内存: 峰值 {memory['rss_peak_mb']} MB, 结束时 {memory['rss_end_mb']} MB")
+    print(f"发送消息 {server['messages_sent']} 条, 落库 {server.get('messages_persisted')} 条, "
+          f"模型调用 {server['model_calls']} 次（合并 {server['model_calls_coalesced']} 次）")
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """返回超出容差的指标；只比较基线中有的场景"""
+    if result["config"] != baseline.get("config"):
+        print("警告: 压测参数与基线不同，比较结果仅供参考")
+    regressions = []
+    for name, base in baseline.get("scenarios", {}).items():
+        current = result["scenarios"].get(name)
+        if current is None:
+            regressions.append(f"{name}: 本次没有数据")
+            continue
+        if base["p99_ms"] and current["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {base['p99_ms']:.1f}ms -> {current['p99_ms']:.1f}ms")
+        if base["throughput"] and current["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: 吞吐 {base['throughput']:.1f}/s -> {current['throughput']:.1f}/s")
+        if current["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(f"{name}: 错误率 {base['error_rate']:.2%} -> {current['error_rate']:.2%}")
+    base_memory = baseline.get("memory", {}).get("rss_peak_mb")
+    if base_memory and result["memory"]["rss_peak_mb"] > base_memory * (1 + tolerance):
+        regressions.append(f"内存峰值: {base_memory} MB -> {result['memory']['rss_peak_mb']} MB")
+    return regressions
+
+
+def save_result(result: Dict, output_dir: str, save_baseline: bool) -> str:
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"e2e-{datetime.now():%Y%m%d-%H%M%S}.json")
+    for target in [path] + ([os.path.join(output_dir, "baseline.json")] if save_baseline else []):
+        with open(target, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端压测（本地替身）")
+    parser.add_argument("--pairs", type=int, default=1000, help="模拟的长辈/年轻人配对数，每对两条WebSocket连接")
+    parser.add_argument("--duration", type=float, default=60, help="发送消息和HTTP请求的时长（秒）")
+    parser.add_argument("--interval", type=float, default=2.0, help="每条连接发消息的间隔（秒）")
+    parser.add_argument("--drain", type=float, default=5.0, help="停止发送后等待在途消息的时间（秒）")
+    parser.add_argument("--codec", choices=("json", "msgpack"), default="json")
+    parser.add_argument("--http-concurrency", type=int, default=20, help="并发的HTTP请求数")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--text-variety", type=int, default=500, help="分析和搜索文本的变化数，越大缓存命中越少")
+    parser.add_argument("--upload-variety", type=int, default=50, help="上传图片的种类数")
+    parser.add_argument("--model-latency", type=float, default=0.8, help="DashScope 桩每次调用的平均耗时（秒）")
+    parser.add_argument("--model-jitter", type=float, default=0.25, help="耗时的相对抖动范围")
+    parser.add_argument("--emoji-latency", type=float, default=0.1, help="假表情包API的响应耗时（秒）")
+    parser.add_argument("--pretranslate", action="store_true", help="为所有配对开启预翻译")
+    parser.add_argument("--db", choices=("sqlite", "env"), default="sqlite",
+                        help="sqlite: 临时目录中的SQLite；env: 使用 DB_* 环境变量配置的数据库")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--emoji-port", type=int, default=18001)
+    parser.add_argument("--log-level", default="warning", help="服务端日志级别")
+    parser.add_argument("--output-dir", default="bench_results")
+    parser.add_argument("--baseline", help="与该基线结果比较，超出容差时以状态码1退出")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的相对退化比例")
+    parser.add_argument("--save-baseline", action="store_true", help="同时把本次结果保存为 baseline.json")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    context = multiprocessing.get_context("spawn")
+    ready, stop = context.Event(), context.Event()
+    server = context.Process(target=_run_server, args=(args, workdir, ready, stop))
+    server.start()
+    try:
+        if not ready.wait(60):
+            raise SystemExit("服务端启动超时")
+        result = asyncio.run(drive(args, server.pid))
+    finally:
+        # 服务端正常关闭时会把写入队列中的消息落库
+        stop.set()
+        server.join(30)
+        if server.is_alive():
+            server.terminate()
+
+    result["server"]["messages_persisted"] = (
+        count_persisted(os.path.join(workdir, "bench.db")) if args.db == "sqlite" else None
+    )
+    result.update({
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "config": {name: getattr(args, name) for name in (
+            "pairs", "duration", "interval", "codec", "http_concurrency", "text_variety", "upload_variety",
+            "model_latency", "model_jitter", "emoji_latency", "pretranslate", "db")},
+    })
+    print_report(result)
+    path = save_result(result, args.output_dir, args.save_baseline)
+    print(f"结果已保存到 {path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("性能回退:")
+            for line in regressions:
+                print(f"  {line}")
+            raise SystemExit(1)
+        print("与基线相比没有超出容差的回退")
+
+
+if __name__ == "__main__":
+    main()
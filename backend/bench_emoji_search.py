@@ -0,0 +1,251 @@
+"""表情包搜索客户端压测：对着可控的上游替身，验证重试、熔断（打开/半开/恢复）和过期后后台刷新的效果
+
+上游替身在子进程中运行，通过 /control 切换行为：按比例返回 500、全部返回 503（故障）、固定延迟。
+依次测量四个阶段：
+1. 间歇失败：上游按 --error-rate 返回 500，统计搜索成功率、每次搜索的上游请求数（重试放大）和延迟
+2. 上游故障：全部返回 503，统计多少次搜索后熔断打开、熔断前后打到上游的请求数、熔断期间快速失败的延迟
+3. 恢复：上游恢复正常，统计熔断从打开到半开试探、再到恢复所用的时间和试探请求数
+4. 过期后后台刷新：关键词按 Zipf 分布重复搜索，缓存有效期很短，统计新鲜命中、过期命中（立即返回旧结果并
+   后台刷新）和未命中的比例及各自的延迟
+
+用法: python bench_emoji_search.py [--error-rate 0.3] [--latency 0.05] [--searches 300] [--duration 10]
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import time
+from typing import Dict, List
+
+import httpx
+
+
+def create_upstream_app():
+    from fastapi import FastAPI, Response
+
+    app = FastAPI()
+    state = {"error_rate": 0.0, "down": False, "latency": 0.0, "requests": 0}
+
+    @app.get("/control")
+    async def control(error_rate: float = None, down: bool = None, latency: float = None):
+        for name, value in (("error_rate", error_rate), ("down", down), ("latency", latency)):
+            if value is not None:
+                state[name] = value
+        return state
+
+    @app.get("/api")
+    async def search(words: str, limit: int = 10):
+        state["requests"] += 1
+        if state["latency"]:
+            await asyncio.sleep(state["latency"])
+        if state["down"]:
+            return Response(status_code=503)
+        if random.random() < state["error_rate"]:
+            return Response(status_code=500)
+        return {"code": 200, "res": [f"https://img.example/{words}/{i}.gif" for i in range(limit)]}
+
+    return app
+
+
+def _run_upstream(port, ready, stop):
+    import uvicorn
+
+    async def serve():
+        server = uvicorn.Server(uvicorn.Config(create_upstream_app(), host="127.0.0.1", port=port,
+                                               log_level="warning"))
+
+        async def watch():
+            while not server.started:
+                await asyncio.sleep(0.05)
+            ready.set()
+            while not stop.is_set():
+                await asyncio.sleep(0.2)
+            server.should_exit = True
+
+        await asyncio.gather(watch(), server.serve())
+
+    asyncio.run(serve())
+
+
+def _quantiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p99": 0.0}
+    values = sorted(values)
+    if len(values) == 1:
+        return {"p50": values[0], "p99": values[0]}
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p99": quantiles[98]}
+
+
+async def _control(control: httpx.AsyncClient, **params) -> Dict:
+    response = await control.get("/control", params={k: str(v).lower() for k, v in params.items()})
+    return response.json()
+
+
+async def _search(client, words: str) -> tuple:
+    """返回 (结果, 耗时)，结果为 "ok" 或异常类型名"""
+    from emoji_search import CircuitOpenError
+
+    started = time.perf_counter()
+    try:
+        await client.search(words, 10)
+        outcome = "ok"
+    except CircuitOpenError:
+        outcome = "circuit_open"
+    except (httpx.HTTPError, ValueError) as e:
+        outcome = type(e).__name__
+    return outcome, time.perf_counter() - started
+
+
+async def flaky(args, client, control) -> None:
+    await _control(control, error_rate=args.error_rate, down=False, latency=args.latency)
+    before = (await _control(control))["requests"]
+    outcomes: Dict[str, int] = {}
+    latencies = []
+    for i in range(args.searches):
+        # 熔断打开时等它恢复，这一阶段只看重试的效果
+        while client.breaker.state == "open":
+            await asyncio.sleep(0.05)
+        outcome, seconds = await _search(client, f"间歇{i}")
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        latencies.append(seconds)
+    upstream = (await _control(control))["requests"] - before
+    stats = _quantiles(latencies)
+    print(f"\n[间歇失败] 上游错误率 {args.error_rate:.0%}，重试 {client.retries} 次，{args.searches} 次搜索")
+    print(f"  结果: {outcomes}")
+    print(f"  成功率 {outcomes.get('ok', 0) / args.searches:.1%}（不重试时约 {1 - args.error_rate:.0%}），"
+          f"每次搜索的上游请求数 {upstream / args.searches:.2f}")
+    print(f"  延迟 p50 {stats['p50'] * 1000:.1f}ms  p99 {stats['p99'] * 1000:.1f}ms")
+
+
+async def outage_and_recovery(args, client, control) -> None:
+    await _control(control, error_rate=0.0, down=True, latency=args.latency)
+    before = (await _control(control))["requests"]
+    searches, opened_after, fast_fail = 0, None, []
+    started = time.monotonic()
+    while time.monotonic() - started < args.reset_timeout / 2:
+        outcome, seconds = await _search(client, f"故障{searches}")
+        searches += 1
+        if outcome == "circuit_open":
+            if opened_after is None:
+                opened_after = searches
+            fast_fail.append(seconds)
+        await asyncio.sleep(0.01)
+    upstream = (await _control(control))["requests"] - before
+    stats = _quantiles(fast_fail)
+    print(f"\n[上游故障] 全部返回503，熔断阈值 {client.breaker.failure_threshold} 次连续失败")
+    print(f"  第 {opened_after} 次搜索时熔断已打开；{searches} 次搜索共打到上游 {upstream} 次")
+    print(f"  熔断期间快速失败 {len(fast_fail)} 次，p50 {stats['p50'] * 1000:.3f}ms  p99 {stats['p99'] * 1000:.3f}ms")
+
+    await _control(control, down=False)
+    before = (await _control(control))["requests"]
+    recovered = time.monotonic()
+    states, i = [], 0
+    while True:
+        state = client.breaker.state
+        if not states or states[-1][0] != state:
+            states.append((state, time.monotonic() - recovered))
+        outcome, _ = await _search(client, f"恢复{i}")
+        i += 1
+        if outcome == "ok":
+            break
+        await asyncio.sleep(0.05)
+    probes = (await _control(control))["requests"] - before
+    print(f"\n[恢复] 上游恢复后，熔断状态变化: "
+          + " -> ".join(f"{state}({seconds:.1f}s)" for state, seconds in states)
+          + f" -> {client.breaker.state}")
+    print(f"  {time.monotonic() - recovered:.1f}s 后第一次搜索成功（熔断恢复时间 {args.reset_timeout:.0f}s），"
+          f"期间打到上游 {probes} 次")
+
+
+async def stale_while_revalidate(args, client, control) -> None:
+    await _control(control, error_rate=0.0, down=False, latency=args.latency)
+    client._cache.clear()
+    hits_before, stale_before = client.cache_hits, client.stale_hits
+    before = (await _control(control))["requests"]
+    rng = random.Random(0)
+    # Zipf 分布：少数热门关键词被反复搜索
+    weights = [1 / rank for rank in range(1, args.keywords + 1)]
+    latencies: Dict[str, List[float]] = {"fresh": [], "stale": [], "miss": []}
+    searches = 0
+    started = time.monotonic()
+    while time.monotonic() - started < args.duration:
+        words = f"热门{rng.choices(range(args.keywords), weights)[0]}"
+        hits, stale = client.cache_hits, client.stale_hits
+        outcome, seconds = await _search(client, words)
+        searches += 1
+        kind = "fresh" if client.cache_hits > hits else "stale" if client.stale_hits > stale else "miss"
+        latencies[kind].append(seconds)
+        await asyncio.sleep(args.interval)
+    # 等后台刷新完成再统计上游请求
+    await asyncio.gather(*client._inflight.values(), return_exceptions=True)
+    upstream = (await _control(control))["requests"] - before
+    print(f"\n[过期后后台刷新] {args.keywords} 个关键词（Zipf 分布），缓存有效期 {client.cache_ttl}s，"
+          f"上游延迟 {args.latency * 1000:.0f}ms，{searches} 次搜索")
+    print(f"  {'类型':<8}{'占比':>8}{'p50(ms)':>10}{'p99(ms)':>10}")
+    for kind, values in latencies.items():
+        stats = _quantiles(values)
+        print(f"  {kind:<8}{len(values) / searches:>8.1%}{stats['p50'] * 1000:>10.2f}{stats['p99'] * 1000:>10.2f}")
+    print(f"  命中率（新鲜+过期） {(client.cache_hits - hits_before + client.stale_hits - stale_before) / searches:.1%}，"
+          f"上游请求 {upstream} 次（含后台刷新）")
+
+
+async def _main(args):
+    context = multiprocessing.get_context("spawn")
+    ready, stop = context.Event(), context.Event()
+    process = context.Process(target=_run_upstream, args=(args.port, ready, stop))
+    process.start()
+    try:
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, ready.wait, 30):
+            raise RuntimeError("上游替身启动超时")
+        os.environ.update({
+            "EMOJI_API_ID": "bench", "EMOJI_API_KEY": "bench",
+            "EMOJI_API_BREAKER_FAILURES": str(args.breaker_failures),
+            "EMOJI_API_BREAKER_RESET": str(args.reset_timeout),
+        })
+        from emoji_search import EmojiSearchClient
+
+        # 重试和刷新失败的警告在这里是预期内的，不输出
+        logging.getLogger("emoji_search").setLevel(logging.ERROR)
+
+        base_url = f"http://127.0.0.1:{args.port}"
+        client = EmojiSearchClient(base_url=f"{base_url}/api", cache_ttl=args.cache_ttl, stale_ttl=3600,
+                                   retries=args.retries, timeout=2)
+        async with httpx.AsyncClient(base_url=base_url) as control:
+            try:
+                await flaky(args, client, control)
+                # 等间歇失败阶段可能触发的熔断恢复
+                while client.breaker.state != "closed":
+                    await _search(client, "等待恢复")
+                    await asyncio.sleep(0.1)
+                await outage_and_recovery(args, client, control)
+                await stale_while_revalidate(args, client, control)
+            finally:
+                await client.close()
+    finally:
+        stop.set()
+        process.join(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="表情包搜索客户端的重试、熔断和缓存压测")
+    parser.add_argument("--error-rate", type=float, default=0.3, help="间歇失败阶段上游返回500的比例")
+    parser.add_argument("--latency", type=float, default=0.05, help="上游每次请求的延迟（秒）")
+    parser.add_argument("--searches", type=int, default=300, help="间歇失败阶段的搜索次数")
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--breaker-failures", type=int, default=5)
+    parser.add_argument("--reset-timeout", type=float, default=5, help="熔断打开到半开的时间（秒）")
+    parser.add_argument("--cache-ttl", type=float, default=1, help="过期后后台刷新阶段的缓存有效期（秒）")
+    parser.add_argument("--keywords", type=int, default=50, help="过期后后台刷新阶段的关键词数")
+    parser.add_argument("--duration", type=float, default=10, help="过期后后台刷新阶段的时长（秒）")
+    parser.add_argument("--interval", type=float, default=0.01, help="两次搜索之间的间隔（秒）")
+    parser.add_argument("--port", type=int, default=18300)
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
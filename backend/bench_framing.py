@@ -0,0 +1,136 @@
+"""WebSocket帧编码压测：对比JSON文本帧和msgpack二进制帧在每1000条聊天消息上的线上字节数和服务端CPU耗时
+
+每条消息在服务端对应三帧：发送方上行的聊天帧（解码）、转发给接收方的聊天帧和回执给发送方的 ack（编码）。
+字节数包含WebSocket帧头（客户端上行帧带4字节掩码），并分别统计开启 permessage-deflate
+（每个连接一个带上下文的压缩器，与uvicorn默认配置一致）前后的大小。
+
+用法: python bench_framing.py [--messages 1000] [--rounds 20]
+"""
+import argparse
+import random
+import time
+import zlib
+
+from frame_codec import JSON_CODEC, MSGPACK_CODEC
+
+SAMPLE_TEXTS = [
+    "吃饭了吗", "今天天气不错，出去走走吧", "yyds", "绝绝子，这也太好看了吧！", "我明天下午回家",
+    "记得按时吃药，别忘了量血压", "哈哈哈哈哈哈", "emo了", "周末一起去公园拍照怎么样？", "好的收到",
+]
+SAMPLE_URLS = [
+    "https://img.example.com/emoji/2024/05/{0:08x}.gif",
+    "https://testbucket.oss-cn-hangzhou.aliyuncs.com/uploads/{0:064x}.jpg",
+]
+
+
+def sample_frames(count: int):
+    rng = random.Random(42)
+    frames = []
+    for i in range(count):
+        sender, recipient = ("elder_1", "young_1") if i % 2 else ("young_1", "elder_1")
+        frame = {"id": 1718000000000 + i, "from": sender, "to": recipient, "pair_id": 1}
+        kind = rng.random()
+        if kind < 0.7:
+            frame.update(type="text", message=rng.choice(SAMPLE_TEXTS) * rng.randint(1, 3))
+        elif kind < 0.9:
+            frame.update(type="emoji", image_data=SAMPLE_URLS[0].format(rng.getrandbits(32)))
+        else:
+            key = rng.getrandbits(256)
+            frame.update(type="image", image_data=SAMPLE_URLS[1].format(key),
+                         thumbnail_url=SAMPLE_URLS[1].format(key).replace(".jpg", ".thumb.webp"))
+        frames.append(frame)
+    return frames
+
+
+def frame_overhead(length: int, masked: bool) -> int:
+    header = 2 if length < 126 else 4 if length < 65536 else 10
+    return header + (4 if masked else 0)
+
+
+class Deflater:
+    """模拟 permessage-deflate（保留上下文）：每条消息 SYNC_FLUSH 后去掉末尾4字节"""
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    def compress(self, data: bytes) -> bytes:
+        return (self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+
+def to_bytes(data):
+    return data.encode("utf-8") if isinstance(data, str) else data
+
+
+def measure(codec, frames, rounds: int):
+    inbound = [to_bytes(codec.encode(frame)) for frame in frames]
+    acks = [{"type": "ack", "id": frame["id"], "seq": seq} for seq, frame in enumerate(frames, 1)]
+
+    # 线上字节数：上行聊天帧 + 下行转发帧 + 下行回执
+    raw = deflated = 0
+    upstream, downstream_sender, downstream_recipient = Deflater(), Deflater(), Deflater()
+    for seq, (frame, data) in enumerate(zip(frames, inbound), 1):
+        forward = to_bytes(codec.encode({**frame, "seq": seq}))
+        ack = to_bytes(codec.encode(acks[seq - 1]))
+        raw += len(data) + frame_overhead(len(data), True)
+        raw += len(forward) + frame_overhead(len(forward), False)
+        raw += len(ack) + frame_overhead(len(ack), False)
+        for deflater, payload, masked in ((upstream, data, True), (downstream_recipient, forward, False),
+                                          (downstream_sender, ack, False)):
+            compressed = deflater.compress(payload)
+            deflated += len(compressed) + frame_overhead(len(compressed), masked)
+
+    # 服务端CPU：解码上行帧、编码转发帧和回执
+    decode_input = [data if codec.binary else data.decode("utf-8") for data in inbound]
+    started = time.process_time()
+    for _ in range(rounds):
+        for seq, data in enumerate(decode_input, 1):
+            frame = codec.decode(data)
+            frame["seq"] = seq
+            codec.encode(frame)
+            codec.encode(acks[seq - 1])
+    codec_seconds = (time.process_time() - started) / rounds
+
+    # 压缩本身的CPU开销（服务端解压上行、压缩两路下行）
+    encoded = [(data, to_bytes(codec.encode({**frame, "seq": seq})), to_bytes(codec.encode(acks[seq - 1])))
+               for seq, (frame, data) in enumerate(zip(frames, inbound), 1)]
+    started = time.process_time()
+    for _ in range(rounds):
+        up, down_a, down_b = Deflater(), Deflater(), Deflater()
+        inflater = zlib.decompressobj(-15)
+        for data, forward, ack in encoded:
+            inflater.decompress(up.compress(data) + b"\x00\x00\xff\xff")
+            down_a.compress(forward)
+            down_b.compress(ack)
+    deflate_seconds = (time.process_time() - started) / rounds
+
+    return raw, deflated, codec_seconds, deflate_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocket帧编码压测")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    frames = sample_frames(args.messages)
+    scale = 1000 / args.messages
+    codecs = [("json", JSON_CODEC)]
+    if MSGPACK_CODEC is not None:
+        codecs.append(("msgpack", MSGPACK_CODEC))
+    else:
+        print("未安装 msgpack，只测试JSON")
+
+    print(f"{'编码':<8}{'字节/千条':>12}{'deflate后':>12}{'编解码CPU(ms)':>16}{'deflate CPU(ms)':>18}")
+    for name, codec in codecs:
+        raw, deflated, codec_seconds, deflate_seconds = measure(codec, frames, args.rounds)
+        print(f"{name:<8}{raw * scale:>12.0f}{deflated * scale:>12.0f}"
+              f"{codec_seconds * scale * 1000:>16.2f}{deflate_seconds * scale * 1000:>18.2f}")
+
+    # 心跳：原来前端每3秒一次JSON ping/pong，对比uvicorn每20秒一次原生 ping（4字节负载）
+    app_ping = len('{"type":"ping"}') + 6 + len('{"type":"pong"}') + 2
+    native_ping = (4 + 2) + (4 + 6)
+    print(f"心跳字节/连接/小时: 应用层(3s) {app_ping * 3600 // 3}  原生(20s) {native_ping * 3600 // 20}")
+
+
+if __name__ == "__main__":
+    main()
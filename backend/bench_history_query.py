@@ -0,0 +1,193 @@
+"""历史消息查询压测：chat_messages 中有百万级消息时，测量各种分页方式的读取延迟，并用 EXPLAIN 确认执行计划
+
+先向 chat_messages 写入 --rows 条消息（默认 100 万，平均分给 --pairs 个配对），然后随机挑配对测量：
+- latest：最新一页（get_messages 不带游标）
+- before_id：从历史中随机位置向上翻一页（游标分页）
+- after_id：从历史中随机位置取之后的一页（断线重连取增量）
+- offset：同样深度用 LIMIT/OFFSET 翻页作为对照
+每种游标查询都用 EXPLAIN（SQLite 为 EXPLAIN QUERY PLAN）检查是否按 (pair_id, message_id) 唯一索引的前缀
+定位和排序，没有用上时在结果中标出。默认使用临时目录里的 SQLite，--db mysql 时使用 .env 中的 MySQL 配置
+（会写入并在结束时删除测试配对的消息）。
+
+用法: python bench_history_query.py [--rows 1000000] [--pairs 100] [--samples 2000] [--limit 50] [--keep]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+# 测试配对的ID从这里开始，避免和 MySQL 中已有的配对混在一起
+FIRST_PAIR = 900000
+FIRST_MESSAGE_ID = 1_700_000_000_000
+SEED_BATCH = 10000
+
+
+def _quantiles(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p99": quantiles[98], "max": values[-1]}
+
+
+def seed(db, rows: int, pairs: int) -> float:
+    """按配对依次写入消息，每 SEED_BATCH 条一个事务"""
+    per_pair = rows // pairs
+    query = db._sql("""
+    INSERT INTO chat_messages (pair_id, message_id, from_role, to_role, message_type, message_content, image_data, seq)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """)
+    started = time.monotonic()
+    with db.pool.connection() as conn:
+        cursor = conn.cursor()
+        batch = []
+        for pair_id in range(FIRST_PAIR, FIRST_PAIR + pairs):
+            for i in range(per_pair):
+                sender, receiver = ("elder", "young") if i % 2 else ("young", "elder")
+                batch.append((pair_id, FIRST_MESSAGE_ID + i, f"{sender}_{pair_id}", f"{receiver}_{pair_id}",
+                              "text", f"历史消息 {i}", None, i + 1))
+                if len(batch) >= SEED_BATCH:
+                    cursor.executemany(query, batch)
+                    conn.commit()
+                    batch = []
+        if batch:
+            cursor.executemany(query, batch)
+            conn.commit()
+        cursor.close()
+    return time.monotonic() - started
+
+
+def offset_page(db, pair_id: int, depth: int, limit: int):
+    # 对照：按偏移量翻页，数据库要先数过前面 depth 条
+    from db_manager import HISTORY_COLUMNS, HISTORY_SOURCE
+
+    return db.execute_query(f"""
+    SELECT {HISTORY_COLUMNS}
+    FROM {HISTORY_SOURCE}
+    WHERE m.pair_id = %s
+    ORDER BY m.message_id DESC
+    LIMIT %s OFFSET %s
+    """, (pair_id, limit, depth))
+
+
+def _fetch(db, query: str, params=()):
+    # PRAGMA/EXPLAIN 不以 SELECT 开头，execute_query 不会返回结果，直接在连接上执行
+    with db.pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(db._sql(query), params)
+            return [col[0] for col in cursor.description], cursor.fetchall()
+        finally:
+            cursor.close()
+
+
+def unique_index(db) -> str:
+    """chat_messages 上 (pair_id, message_id, from_role) 唯一索引的名字"""
+    if db.backend != 'sqlite':
+        return "uk_pair_message"
+    _, rows = _fetch(db, "PRAGMA index_list('chat_messages')")
+    # 列依次为 seq, name, unique, origin, partial；UNIQUE 约束生成的索引 origin 为 'u'
+    for row in rows:
+        if row[3] == 'u':
+            return row[1]
+    raise RuntimeError("chat_messages 上没有唯一索引")
+
+
+def explain(db, query: str, params) -> Tuple[List[str], bool]:
+    """返回执行计划的各行，以及对 m 表的访问是否走唯一索引的 (pair_id, message_id) 前缀"""
+    index = unique_index(db)
+    if db.backend == 'sqlite':
+        _, rows = _fetch(db, "EXPLAIN QUERY PLAN " + query, params)
+        # 列依次为 id, parent, notused, detail。m 表应按索引定位，例:
+        #   SEARCH m USING INDEX sqlite_autoindex_chat_messages_1 (pair_id=? AND message_id<?)
+        # 并且同一层查询里没有额外排序（USE TEMP B-TREE），即 ORDER BY message_id 直接沿索引读出；
+        # 外层恢复升序时对一页结果的排序不算
+        search = [row for row in rows if row[3].startswith(f"SEARCH m USING INDEX {index} (pair_id=?")]
+        uses_prefix = bool(search) and not any(
+            row[1] == search[0][1] and row[3].startswith("USE TEMP B-TREE") for row in rows
+        )
+        return [row[3] for row in rows], uses_prefix
+    columns, rows = _fetch(db, "EXPLAIN " + query, params)
+    plan = [dict(zip(columns, row)) for row in rows]
+    # 带游标时 key_len 覆盖 pair_id(INT, 4) + message_id(BIGINT, 8) 两列，最新一页只用到 pair_id；
+    # 两种情况下 m 表都不应需要 filesort
+    uses_prefix = any(
+        row.get("table") == "m" and row.get("key") == index and "filesort" not in (row.get("Extra") or "")
+        for row in plan
+    )
+    return [" ".join(f"{k}={v}" for k, v in row.items() if v is not None) for row in plan], uses_prefix
+
+
+def cleanup(db, pairs: int):
+    db.execute_query("DELETE FROM chat_messages WHERE pair_id >= %s AND pair_id < %s",
+                     (FIRST_PAIR, FIRST_PAIR + pairs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="百万级消息下历史分页查询的延迟和执行计划")
+    parser.add_argument("--rows", type=int, default=1000000, help="写入 chat_messages 的消息总数")
+    parser.add_argument("--pairs", type=int, default=100, help="消息平均分给多少个配对")
+    parser.add_argument("--samples", type=int, default=2000, help="每种查询测量的次数")
+    parser.add_argument("--limit", type=int, default=50, help="每页消息条数")
+    parser.add_argument("--db", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--keep", action="store_true", help="结束后保留测试数据（仅 MySQL）")
+    args = parser.parse_args()
+
+    if args.db == "sqlite":
+        workdir = tempfile.mkdtemp(prefix="bench_history_query_")
+        os.environ.update({"DB_BACKEND": "sqlite", "DB_SQLITE_PATH": os.path.join(workdir, "bench.db")})
+
+    from db_manager import DatabaseManager
+
+    db = DatabaseManager()
+    db.ensure_schema()
+    per_pair = args.rows // args.pairs
+    try:
+        seconds = seed(db, args.rows, args.pairs)
+        print(f"写入 {per_pair * args.pairs} 条消息（{args.pairs} 个配对 × {per_pair} 条）: {seconds:.1f}s")
+        if db.backend == 'sqlite':
+            db.execute_query("ANALYZE")
+
+        # 执行计划：三种查询都应按唯一索引的 (pair_id, message_id) 前缀定位并按索引顺序读取
+        pair_id, middle = FIRST_PAIR, FIRST_MESSAGE_ID + per_pair // 2
+        all_ok = True
+        for name, cursor_args in (("latest", {}), ("before_id", {"before_id": middle}),
+                                  ("after_id", {"after_id": middle})):
+            query, params = db._history_query(pair_id, args.limit, **cursor_args)
+            plan, uses_prefix = explain(db, query, params)
+            all_ok = all_ok and uses_prefix
+            print(f"\nEXPLAIN {name}: {'使用 (pair_id, message_id) 索引前缀' if uses_prefix else '未使用索引前缀!'}")
+            for line in plan:
+                print(f"  {line}")
+
+        rng = random.Random(0)
+        samples = [(rng.randrange(FIRST_PAIR, FIRST_PAIR + args.pairs), rng.randrange(per_pair))
+                   for _ in range(args.samples)]
+        queries = {
+            "latest": lambda pair, depth: db.get_messages(pair, args.limit),
+            "before_id": lambda pair, depth: db.get_messages(pair, args.limit,
+                                                             before_id=FIRST_MESSAGE_ID + per_pair - depth),
+            "after_id": lambda pair, depth: db.get_messages(pair, args.limit, after_id=FIRST_MESSAGE_ID + depth),
+            "offset": lambda pair, depth: offset_page(db, pair, depth, args.limit),
+        }
+        print(f"\n{'查询':<12}{'次数':>8}{'p50(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+        for name, query in queries.items():
+            latencies = []
+            for pair, depth in samples:
+                started = time.perf_counter()
+                query(pair, depth)
+                latencies.append(time.perf_counter() - started)
+            stats = _quantiles(latencies)
+            print(f"{name:<12}{len(latencies):>8}{stats['p50'] * 1000:>10.3f}{stats['p99'] * 1000:>10.3f}"
+                  f"{stats['max'] * 1000:>10.3f}")
+        if not all_ok:
+            print("\n警告: 有游标查询没有使用 (pair_id, message_id) 索引前缀，见上面的执行计划")
+    finally:
+        if args.db == "mysql" and not args.keep:
+            cleanup(db, args.pairs)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""图片处理进程池压测：不同进程数下 ImagePipeline 的吞吐，以及折算到每个核的吞吐
+
+样本为几种典型的表情包/照片：小 PNG、大 JPEG 照片、多帧 GIF，轮流提交。每档先预热（子进程以 spawn 启动，
+首个任务包含导入 PIL 的时间），再保持 进程数×2 个任务在进行，统计每秒处理的图片数和单张耗时。
+"每核吞吐" = 吞吐 / min(进程数, CPU核数)；进程数超过核数后吞吐不再增加，说明瓶颈在 CPU。
+--inline 时额外在当前进程里直接调用 normalize_image 作为单核基线。
+
+用法: python bench_image_pipeline.py [--workers 1,2,4] [--images 200] [--inline]
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import statistics
+import time
+from typing import Dict, List
+
+from PIL import Image
+
+from image_pipeline import ImagePipeline, normalize_image
+
+
+def sample_images() -> Dict[str, bytes]:
+    rng = random.Random(0)
+
+    def noise(size):
+        return Image.frombytes("RGB", size, bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] * 3)))
+
+    samples = {}
+    output = io.BytesIO()
+    noise((240, 240)).save(output, "PNG")
+    samples["png_240"] = output.getvalue()
+
+    # 照片：平滑渐变叠加少量噪点，接近手机照片的压缩率
+    photo = Image.linear_gradient("L").resize((3000, 2000)).convert("RGB")
+    photo.paste(noise((300, 200)).resize((3000, 2000)), mask=Image.new("L", (3000, 2000), 40))
+    output = io.BytesIO()
+    photo.save(output, "JPEG", quality=90)
+    samples["jpeg_3000x2000"] = output.getvalue()
+
+    frames = [noise((320, 320)) for _ in range(20)]
+    output = io.BytesIO()
+    frames[0].save(output, "GIF", save_all=True, append_images=frames[1:], duration=80, loop=0)
+    samples["gif_320_20f"] = output.getvalue()
+    return samples
+
+
+def _quantiles(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p99": quantiles[98]}
+
+
+async def _measure(pipeline: ImagePipeline, images: List[bytes], total: int) -> dict:
+    latencies = []
+    queue = iter(range(total))
+
+    async def submitter():
+        for i in queue:
+            started = time.perf_counter()
+            await pipeline.process(images[i % len(images)])
+            latencies.append(time.perf_counter() - started)
+
+    # 预热：每个子进程先处理一张，启动和导入的时间不计入
+    await asyncio.gather(*(pipeline.process(images[0]) for _ in range(pipeline.max_workers)))
+    started = time.monotonic()
+    await asyncio.gather(*(submitter() for _ in range(pipeline.max_workers * 2)))
+    elapsed = time.monotonic() - started
+    return {"throughput": total / elapsed, **_quantiles(latencies)}
+
+
+def _inline(images: List[bytes], total: int) -> dict:
+    latencies = []
+    started = time.monotonic()
+    for i in range(total):
+        begin = time.perf_counter()
+        normalize_image(images[i % len(images)], 768, 240)
+        latencies.append(time.perf_counter() - begin)
+    return {"throughput": total / (time.monotonic() - started), **_quantiles(latencies)}
+
+
+async def _main(args):
+    samples = sample_images()
+    images = list(samples.values())
+    cores = os.cpu_count() or 1
+    print("样本: " + ", ".join(f"{name} {len(data) / 1024:.0f}KB" for name, data in samples.items()))
+    print(f"CPU 核数: {cores}，每档处理 {args.images} 张")
+    print(f"{'进程数':<8}{'吞吐(张/s)':>12}{'每核(张/s)':>12}{'p50(ms)':>10}{'p99(ms)':>10}")
+    if args.inline:
+        result = _inline(images, args.images)
+        print(f"{'当前进程':<8}{result['throughput']:>12.1f}{result['throughput']:>12.1f}"
+              f"{result['p50'] * 1000:>10.1f}{result['p99'] * 1000:>10.1f}")
+    for workers in args.workers:
+        pipeline = ImagePipeline(max_workers=workers)
+        try:
+            result = await _measure(pipeline, images, args.images)
+        finally:
+            pipeline.shutdown()
+        per_core = result["throughput"] / min(workers, cores)
+        print(f"{workers:<8}{result['throughput']:>12.1f}{per_core:>12.1f}"
+              f"{result['p50'] * 1000:>10.1f}{result['p99'] * 1000:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图片处理进程池的吞吐压测")
+    parser.add_argument("--workers", type=lambda value: [int(v) for v in value.split(",")], default=[1, 2, 4],
+                        help="进程池大小，逗号分隔")
+    parser.add_argument("--images", type=int, default=200, help="每档处理的图片数")
+    parser.add_argument("--inline", action="store_true", help="同时测量在当前进程内直接处理的单核基线")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""消息表结构对比压测：旧的每配对一张表（chat_records_pair_N） vs 统一的 chat_messages
+
+先给 N 个配对（默认 1 万）各写入 M 条历史消息，两种结构各一份，然后随机挑配对测量：
+- 写入：旧结构按原来的写法先检查表是否存在再 INSERT；新结构走 save_messages
+- 读取历史：旧结构 ORDER BY created_at LIMIT（原来的查询）；新结构走 get_messages（基于索引的分页）
+默认使用临时目录里的 SQLite，--db mysql 时使用 .env 中的 MySQL 配置（会创建并在结束时删除 N 张旧表）。
+
+用法: python bench_message_tables.py [--pairs 10000] [--messages 20] [--samples 2000] [--keep]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+
+COLUMNS = "message_id, from_role, to_role, message_type, message_content, image_data, pair_id"
+
+
+def _quantiles(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p99": quantiles[98], "max": values[-1]}
+
+
+def legacy_ddl(db, table: str) -> str:
+    # 与旧版 save_message 中按需建表的语句一致
+    id_column = "id INTEGER PRIMARY KEY AUTOINCREMENT" if db.backend == 'sqlite' else "id INT AUTO_INCREMENT PRIMARY KEY"
+    return f"""
+    CREATE TABLE IF NOT EXISTS {table} (
+        {id_column},
+        message_id BIGINT NOT NULL,
+        from_role VARCHAR(10) NOT NULL,
+        to_role VARCHAR(10) NOT NULL,
+        message_type VARCHAR(10) NOT NULL,
+        message_content TEXT,
+        image_data VARCHAR(255),
+        pair_id INT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )"""
+
+
+def _rows(pair_id: int, first_id: int, count: int):
+    return [
+        (first_id + i, f"elder_{pair_id}" if i % 2 else f"young_{pair_id}",
+         f"young_{pair_id}" if i % 2 else f"elder_{pair_id}", "text", f"历史消息 {i}", None, pair_id)
+        for i in range(count)
+    ]
+
+
+def seed(db, pairs: int, messages: int):
+    """两种结构各写入一份相同的历史消息，每个配对一个事务"""
+    started = time.monotonic()
+    with db.pool.connection() as conn:
+        cursor = conn.cursor()
+        for pair_id in range(1, pairs + 1):
+            table = f"chat_records_pair_{pair_id}"
+            cursor.execute(legacy_ddl(db, table))
+            cursor.executemany(db._sql(f"INSERT INTO {table} ({COLUMNS}) VALUES (%s, %s, %s, %s, %s, %s, %s)"),
+                               _rows(pair_id, 1, messages))
+            conn.commit()
+        cursor.close()
+    legacy_seconds = time.monotonic() - started
+
+    started = time.monotonic()
+    for pair_id in range(1, pairs + 1):
+        db.save_messages([
+            {"message_id": row[0], "from_role": row[1], "to_role": row[2], "message_type": row[3],
+             "message_content": row[4], "image_data": row[5], "pair_id": pair_id, "seq": row[0]}
+            for row in _rows(pair_id, 1, messages)
+        ])
+    return legacy_seconds, time.monotonic() - started
+
+
+def legacy_write(db, pair_id: int, message_id: int):
+    table = f"chat_records_pair_{pair_id}"
+    if table not in db.list_tables(table):
+        db.execute_query(legacy_ddl(db, table))
+    db.execute_query(f"INSERT INTO {table} ({COLUMNS}) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                     _rows(pair_id, message_id, 1)[0])
+
+
+def legacy_read(db, pair_id: int, limit: int):
+    return db.execute_query(f"""
+    SELECT message_id as "id", from_role as "from", to_role as "to", message_type as "type",
+           message_content as "message", pair_id as "pair_id", created_at as "created_at", image_data as "image_data"
+    FROM chat_records_pair_{pair_id}
+    ORDER BY created_at ASC
+    LIMIT %s
+    """, (limit,))
+
+
+def new_write(db, pair_id: int, message_id: int):
+    row = _rows(pair_id, message_id, 1)[0]
+    db.save_messages([{"message_id": row[0], "from_role": row[1], "to_role": row[2], "message_type": row[3],
+                       "message_content": row[4], "image_data": row[5], "pair_id": pair_id, "seq": row[0]}])
+
+
+def measure(func, samples: List[int]) -> List[float]:
+    latencies = []
+    for pair_id in samples:
+        started = time.perf_counter()
+        func(pair_id)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def drop_legacy(db, pairs: int):
+    for pair_id in range(1, pairs + 1):
+        db.execute_query(f"DROP TABLE IF EXISTS chat_records_pair_{pair_id}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="每配对一张表 vs 统一消息表的读写延迟对比")
+    parser.add_argument("--pairs", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=20, help="每个配对预先写入的历史消息数")
+    parser.add_argument("--samples", type=int, default=2000, help="每项测量随机挑选的配对次数")
+    parser.add_argument("--limit", type=int, default=50, help="每次读取的历史消息条数")
+    parser.add_argument("--db", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--keep", action="store_true", help="结束后保留测试数据（仅 MySQL）")
+    args = parser.parse_args()
+
+    if args.db == "sqlite":
+        workdir = tempfile.mkdtemp(prefix="bench_message_tables_")
+        os.environ.update({"DB_BACKEND": "sqlite", "DB_SQLITE_PATH": os.path.join(workdir, "bench.db")})
+
+    from db_manager import DatabaseManager
+
+    db = DatabaseManager()
+    db.ensure_schema()
+    try:
+        legacy_seconds, new_seconds = seed(db, args.pairs, args.messages)
+        print(f"写入 {args.pairs} 个配对 × {args.messages} 条历史: 旧结构 {legacy_seconds:.1f}s, "
+              f"chat_messages {new_seconds:.1f}s")
+
+        rng = random.Random(0)
+        samples = [rng.randint(1, args.pairs) for _ in range(args.samples)]
+        next_id = args.messages + 1
+        ids = iter(range(next_id, next_id + 2 * args.samples))
+        results = {
+            "legacy_write": measure(lambda pair_id: legacy_write(db, pair_id, next(ids)), samples),
+            "new_write": measure(lambda pair_id: new_write(db, pair_id, next(ids)), samples),
+            "legacy_read": measure(lambda pair_id: legacy_read(db, pair_id, args.limit), samples),
+            "new_read": measure(lambda pair_id: db.get_messages(pair_id, args.limit), samples),
+        }
+        print(f"{'操作':<14}{'次数':>8}{'p50(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+        for name, latencies in results.items():
+            stats = _quantiles(latencies)
+            print(f"{name:<14}{len(latencies):>8}{stats['p50'] * 1000:>10.3f}{stats['p99'] * 1000:>10.3f}"
+                  f"{stats['max'] * 1000:>10.3f}")
+    finally:
+        if args.db == "mysql" and not args.keep:
+            drop_legacy(db, args.pairs)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""模型调用与事件循环压测：保持 N 个分析请求同时进行（桩模型在调用线程里 sleep），
+测量同一服务上 WebSocket 回显的 p50/p99 延迟，验证模型调用不会阻塞转发
+
+服务端在子进程中运行：/analyze 通过 ModelCallRunner 在线程池中调用桩模型，/ws 原样回显每一帧。
+--blocking 时 /analyze 直接在事件循环里调用桩模型（模型调用移出事件循环之前的写法），作为对照。
+
+用法: python bench_model_calls.py [--levels 0,10,50] [--model-latency 0.5] [--pings 200] [--blocking]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import statistics
+import time
+from types import SimpleNamespace
+
+import httpx
+from websockets.asyncio.client import connect
+
+MODEL = "bench-model"
+
+
+def create_app(args):
+    from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+
+    from model_runner import ModelCallRunner
+
+    app = FastAPI()
+    # 名额和线程数都不小于最大并发，保证 N 个调用真的同时在进行
+    slots = max(args.levels)
+    runner = ModelCallRunner(default_limit=max(1, slots), max_workers=max(1, slots))
+
+    def stub_model(text: str):
+        time.sleep(args.model_latency)
+        return SimpleNamespace(status_code=200, output=SimpleNamespace(text=f"解释: {text}"), message="")
+
+    @app.post("/analyze")
+    async def analyze(payload: dict):
+        if args.blocking:
+            response = stub_model(payload["text"])
+        else:
+            response = await runner.run(MODEL, stub_model, payload["text"], coalesce=False, analyzer="bench")
+        return {"analysis": response.output.text}
+
+    @app.websocket("/ws")
+    async def echo(websocket: WebSocket):
+        await websocket.accept()
+        try:
+            while True:
+                await websocket.send_text(await websocket.receive_text())
+        except WebSocketDisconnect:
+            pass
+
+    return app
+
+
+def _run_server(args, ready, stop):
+    import uvicorn
+
+    async def serve():
+        server = uvicorn.Server(uvicorn.Config(create_app(args), host="127.0.0.1", port=args.port,
+                                               log_level="warning"))
+
+        async def watch():
+            while not server.started:
+                await asyncio.sleep(0.05)
+            ready.set()
+            while not stop.is_set():
+                await asyncio.sleep(0.2)
+            server.should_exit = True
+
+        await asyncio.gather(watch(), server.serve())
+
+    asyncio.run(serve())
+
+
+async def _analysis_load(client: httpx.AsyncClient, ids, stop: asyncio.Event, done: list):
+    # 每个循环始终保持一个请求在进行，文本各不相同，不会被合并
+    while not stop.is_set():
+        await client.post("/analyze", json={"text": f"消息{next(ids)}"})
+        done.append(time.monotonic())
+
+
+async def _measure(args, level: int, ids) -> dict:
+    base_url = f"http://127.0.0.1:{args.port}"
+    stop = asyncio.Event()
+    done = []
+    limits = httpx.Limits(max_connections=max(1, level))
+    # 先建立连接再加压：--blocking 时事件循环被占住，握手本身也会排在模型调用后面
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client, \
+            connect(f"ws://127.0.0.1:{args.port}/ws", open_timeout=None, ping_interval=None) as ws:
+        loads = [asyncio.create_task(_analysis_load(client, ids, stop, done)) for _ in range(level)]
+        # 等所有分析请求都进入模型调用
+        await asyncio.sleep(min(args.model_latency / 2, 1.0) if level else 0)
+        latencies = []
+        started = time.monotonic()
+        for i in range(args.pings):
+            sent = time.perf_counter()
+            await ws.send(json.dumps({"type": "ping", "seq": i}))
+            await ws.recv()
+            latencies.append(time.perf_counter() - sent)
+            await asyncio.sleep(args.interval)
+        elapsed = time.monotonic() - started
+        stop.set()
+        await asyncio.gather(*loads)
+
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "in_flight": level,
+        "p50_ms": quantiles[49] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "analyses_per_s": sum(1 for t in done if t >= started) / elapsed,
+    }
+
+
+async def _main(args):
+    context = multiprocessing.get_context("spawn")
+    ready, stop = context.Event(), context.Event()
+    process = context.Process(target=_run_server, args=(args, ready, stop))
+    process.start()
+    try:
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, ready.wait, 30):
+            raise RuntimeError("服务端启动超时")
+        ids = itertools.count()
+        mode = "事件循环内直接调用" if args.blocking else "ModelCallRunner 线程池"
+        print(f"模型调用方式: {mode}，桩模型耗时 {args.model_latency * 1000:.0f}ms")
+        print(f"{'进行中分析数':<12}{'p50(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}{'分析/秒':>10}")
+        for level in args.levels:
+            result = await _measure(args, level, ids)
+            print(f"{result['in_flight']:<12}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+                  f"{result['max_ms']:>10.2f}{result['analyses_per_s']:>10.1f}")
+    finally:
+        stop.set()
+        process.join(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型调用期间的 WebSocket 延迟压测")
+    parser.add_argument("--levels", type=lambda value: [int(v) for v in value.split(",")], default=[0, 10, 50],
+                        help="同时进行的分析请求数，逗号分隔")
+    parser.add_argument("--model-latency", type=float, default=0.5, help="桩模型每次调用的耗时（秒）")
+    parser.add_argument("--pings", type=int, default=200, help="每档测量的回显次数")
+    parser.add_argument("--interval", type=float, default=0.01, help="两次回显之间的间隔（秒）")
+    parser.add_argument("--blocking", action="store_true", help="在事件循环里直接调用桩模型作为对照")
+    parser.add_argument("--port", type=int, default=18100)
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""图片上传压测：按不同并发数同时上传图片，统计 /api/upload_image 的延迟、吞吐和服务进程（含图片处理子进程）的内存峰值，
+并测量超过大小上限的上传多久被拒绝
+
+服务端在子进程中运行完整应用（本地目录 OSS、临时目录里的 SQLite，环境与 bench_e2e 相同）。每个请求上传内容不同的
+PNG（噪点图，末尾附加序号，哈希各不相同，不会命中已存在的对象）。内存每 20ms 读取一次 /proc 中的 VmRSS，
+服务进程和图片处理进程分别取峰值。超限上传分两种：声明了 Content-Length 的，和分块传输不声明长度的。
+
+用法: python bench_upload.py [--levels 1,8,32] [--image-mb 4] [--requests 64] [--oversize-mb 50]
+"""
+import argparse
+import asyncio
+import io
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+
+import httpx
+
+MEMORY_TICK = 0.02
+
+
+def noise_png(megabytes: float) -> bytes:
+    # 噪点几乎不可压缩，PNG 大小约等于 宽×高×3
+    from PIL import Image
+
+    side = int((megabytes * 1024 * 1024 / 3) ** 0.5)
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    output = io.BytesIO()
+    image.save(output, "PNG", compress_level=1)
+    return output.getvalue()
+
+
+def _quantiles(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    if len(values) == 1:
+        return {"p50": values[0], "p99": values[0], "max": values[0]}
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p99": quantiles[98], "max": values[-1]}
+
+
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid: int) -> List[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+async def _sample_memory(pid: int, stop: asyncio.Event, peaks: Dict[str, int]):
+    """记录服务进程和图片处理进程（子进程 RSS 之和）各自的峰值"""
+    while not stop.is_set():
+        peaks["server"] = max(peaks["server"], _rss_kb(pid))
+        peaks["workers"] = max(peaks["workers"], sum(_rss_kb(child) for child in _children(pid)))
+        await asyncio.sleep(MEMORY_TICK)
+
+
+def _run_server(args, workdir, ready, stop):
+    import logging
+
+    import uvicorn
+
+    from bench_e2e import configure_environment
+
+    configure_environment(SimpleNamespace(port=args.port, emoji_port=args.port + 1, pretranslate=False,
+                                          db="sqlite"), workdir)
+    os.environ["UPLOAD_MAX_BYTES"] = str(args.max_mb * 1024 * 1024)
+    import main
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async def serve():
+        server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+
+        async def watch():
+            while not server.started:
+                await asyncio.sleep(0.05)
+            ready.set()
+            while not stop.is_set():
+                await asyncio.sleep(0.2)
+            server.should_exit = True
+
+        await asyncio.gather(watch(), server.serve())
+
+    asyncio.run(serve())
+
+
+async def _upload(client: httpx.AsyncClient, content: bytes) -> float:
+    started = time.perf_counter()
+    response = await client.post("/api/upload_image", files={"image": ("bench.png", content, "image/png")})
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+async def _measure(args, client, pid: int, image: bytes, level: int, ids) -> dict:
+    peaks = {"server": 0, "workers": 0}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(_sample_memory(pid, stop, peaks))
+    queue = asyncio.Queue()
+    for _ in range(args.requests):
+        queue.put_nowait(image + next(ids).to_bytes(8, "big"))
+    latencies, errors = [], 0
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            content = queue.get_nowait()
+            try:
+                latencies.append(await _upload(client, content))
+            except httpx.HTTPError:
+                errors += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(level)))
+    elapsed = time.monotonic() - started
+    stop.set()
+    await sampler
+    stats = _quantiles(latencies) if latencies else {"p50": 0.0, "p99": 0.0, "max": 0.0}
+    return {"level": level, "errors": errors, "throughput": len(latencies) / elapsed, **stats,
+            "server_mb": peaks["server"] / 1024, "workers_mb": peaks["workers"] / 1024}
+
+
+async def _oversize(client: httpx.AsyncClient, size: int, declared: bool) -> tuple:
+    """上传 size 字节的请求体，返回 (状态码, 耗时)。declared=False 时以分块传输发送，不带 Content-Length"""
+    chunk = b"\0" * (256 * 1024)
+    boundary = "benchboundary"
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"image\"; filename=\"big.png\"\r\n"
+            f"Content-Type: image/png\r\n\r\n").encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def body():
+        yield head
+        for _ in range(size // len(chunk)):
+            yield chunk
+        yield tail
+
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    if declared:
+        headers["Content-Length"] = str(len(head) + size // len(chunk) * len(chunk) + len(tail))
+    started = time.perf_counter()
+    try:
+        response = await client.post("/api/upload_image", content=body(), headers=headers)
+        status = response.status_code
+    except httpx.HTTPError as e:
+        # 服务端返回413后关闭连接，客户端可能还没发完请求体
+        status = type(e).__name__
+    return status, time.perf_counter() - started
+
+
+async def _main(args):
+    workdir = tempfile.mkdtemp(prefix="bench_upload_")
+    context = multiprocessing.get_context("spawn")
+    ready, stop = context.Event(), context.Event()
+    process = context.Process(target=_run_server, args=(args, workdir, ready, stop))
+    process.start()
+    try:
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, ready.wait, 60):
+            raise RuntimeError("服务端启动超时")
+        image = noise_png(args.image_mb)
+        ids = iter(range(1 << 62))
+        print(f"图片 {len(image) / 1024 / 1024:.1f} MB，每档 {args.requests} 次上传，服务进程启动后 RSS "
+              f"{_rss_kb(process.pid) / 1024:.0f} MB")
+        print(f"{'并发':<6}{'错误':>6}{'吞吐(/s)':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}"
+              f"{'服务进程峰值(MB)':>18}{'处理进程峰值(MB)':>18}")
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=None,
+                                     limits=httpx.Limits(max_connections=max(args.levels))) as client:
+            for level in args.levels:
+                r = await _measure(args, client, process.pid, image, level, ids)
+                print(f"{r['level']:<6}{r['errors']:>6}{r['throughput']:>10.1f}{r['p50'] * 1000:>10.1f}"
+                      f"{r['p99'] * 1000:>10.1f}{r['max'] * 1000:>10.1f}{r['server_mb']:>18.0f}{r['workers_mb']:>18.0f}")
+
+            size = int(args.oversize_mb * 1024 * 1024)
+            for declared in (True, False):
+                status, seconds = await _oversize(client, size, declared)
+                mode = "Content-Length" if declared else "分块传输"
+                print(f"超限上传 {args.oversize_mb:.0f} MB（{mode}）: 状态 {status}，耗时 {seconds * 1000:.1f}ms")
+    finally:
+        stop.set()
+        process.join(timeout=15)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图片上传的并发延迟和内存峰值压测")
+    parser.add_argument("--levels", type=lambda value: [int(v) for v in value.split(",")], default=[1, 8, 32],
+                        help="同时进行的上传数，逗号分隔")
+    parser.add_argument("--image-mb", type=float, default=4, help="上传图片的大小（MB）")
+    parser.add_argument("--requests", type=int, default=64, help="每档上传次数")
+    parser.add_argument("--max-mb", type=int, default=10, help="服务端的上传大小上限 UPLOAD_MAX_BYTES（MB）")
+    parser.add_argument("--oversize-mb", type=float, default=50, help="超限上传的请求体大小（MB）")
+    parser.add_argument("--port", type=int, default=18200)
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from frame_codec import JSON_CODEC, decode_message
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect")
+
+# 关闭码：帧无法解析（协议错误）/ 发送队列溢出 / 心跳超时 / 发送超时
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_OVERFLOW = 4008
+CLOSE_PING_TIMEOUT = 4009
+CLOSE_SEND_TIMEOUT = 4010
+
+
+class ClientConnection:
+    """单个WebSocket连接：有界发送队列由独立的写任务发送，慢客户端不会阻塞发送方
+
+    帧的编码由握手时协商的 codec 决定（JSON文本帧或msgpack二进制帧）。
+    心跳默认使用uvicorn的原生 ping/pong（--ws-ping-interval / --ws-ping-timeout）；
+    WS_PING_INTERVAL 大于0时改为应用层 ping，超过 ping_timeout 没有收到客户端任何帧就断开连接。
+    """
+
+    def __init__(self, client_id: str, websocket: WebSocket, manager: "ConnectionManager", codec=JSON_CODEC):
+        self.client_id = client_id
+        self.websocket = websocket
+        self.manager = manager
+        self.codec = codec
+        self.queue: deque = deque()
+        self.sent = 0
+        self.dropped = 0
+        self.close_code: Optional[int] = None
+        self.last_seen = time.monotonic()
+        self._ready = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [
+            asyncio.create_task(self._write_loop()),
+            asyncio.create_task(self._ping_loop()),
+            asyncio.create_task(self._closed.wait()),
+        ]
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+    def send(self, frame: Dict) -> bool:
+        """放入发送队列，不等待发送完成。连接已关闭或因溢出断开时返回 False"""
+        if self.closed:
+            return False
+        if len(self.queue) >= self.manager.max_queue:
+            if self.manager.overflow == "disconnect":
+                logger.warning(f"用户 {self.client_id} 发送队列已满，断开连接")
+                self.manager.overflow_disconnects += 1
+                self.close(CLOSE_OVERFLOW)
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+            self.manager.dropped += 1
+        self.queue.append(frame)
+        self._ready.set()
+        return True
+
+    async def receive(self) -> Dict:
+        """接收客户端的帧；连接被服务端关闭（溢出、超时）时抛出 WebSocketDisconnect"""
+        receive = asyncio.ensure_future(self.websocket.receive())
+        await asyncio.wait({receive, self._tasks[2]}, return_when=asyncio.FIRST_COMPLETED)
+        if not receive.done():
+            receive.cancel()
+            raise WebSocketDisconnect(self.close_code or 1000)
+        message = receive.result()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        self.last_seen = time.monotonic()
+        try:
+            return decode_message(message, self.codec)
+        except ValueError as e:
+            # JSON 和 msgpack 帧格式错误同样处理：以协议错误关闭连接
+            logger.warning(f"用户 {self.client_id} 发送了无法解析的帧，断开连接: {str(e)}")
+            self.manager.protocol_errors += 1
+            self.close(CLOSE_PROTOCOL_ERROR)
+            raise WebSocketDisconnect(CLOSE_PROTOCOL_ERROR)
+
+    async def _write_loop(self):
+        while True:
+            await self._ready.wait()
+            while self.queue:
+                frame = self.queue.popleft()
+                try:
+                    await asyncio.wait_for(self._send_frame(frame), timeout=self.manager.send_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"用户 {self.client_id} 发送超时，断开连接")
+                    self.manager.timeouts += 1
+                    self.close(CLOSE_SEND_TIMEOUT)
+                    return
+                except Exception as e:
+                    logger.warning(f"向用户 {self.client_id} 发送失败: {str(e)}")
+                    self.close(1011)
+                    return
+                self.sent += 1
+            self._ready.clear()
+
+    async def _send_frame(self, frame: Dict):
+        data = self.codec.encode(frame)
+        if self.codec.binary:
+            await self.websocket.send_bytes(data)
+        else:
+            await self.websocket.send_text(data)
+
+    async def _ping_loop(self):
+        if self.manager.ping_interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.manager.ping_interval)
+            if time.monotonic() - self.last_seen > self.manager.ping_timeout:
+                logger.warning(f"用户 {self.client_id} 心跳超时，断开连接")
+                self.manager.timeouts += 1
+                self.close(CLOSE_PING_TIMEOUT)
+                return
+            self.send({"type": "ping"})
+
+    def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.close_code = code
+        self._closed.set()
+        for task in self._tasks[:2]:
+            if task is not asyncio.current_task():
+                task.cancel()
+        # 事件循环只弱引用任务，由连接表持有引用直到关闭握手结束；连接本身可能已经从连接表移除
+        task = asyncio.create_task(self._close_socket(code))
+        self.manager.closing.add(task)
+        task.add_done_callback(self.manager.closing.discard)
+
+    async def _close_socket(self, code: int):
+        # 对方已经失联时关闭握手可能一直等不到回应
+        try:
+            await asyncio.wait_for(self.websocket.close(code), timeout=1)
+        except Exception:
+            pass
+
+
+class ConnectionManager:
+    """本worker上的WebSocket连接表，统一配置发送队列和心跳，并汇总队列指标"""
+
+    def __init__(self, max_queue: int = None, overflow: str = None, send_timeout: float = None,
+                 ping_interval: float = None, ping_timeout: float = None):
+        self.max_queue = max_queue or int(os.getenv("WS_SEND_QUEUE_MAX", "256"))
+        self.overflow = overflow or os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")
+        if self.overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"未知的发送队列溢出策略: {self.overflow}")
+        self.send_timeout = send_timeout or float(os.getenv("WS_SEND_TIMEOUT", "10"))
+        # 默认0：不发应用层 ping，由uvicorn发送原生 ping 帧并断开无响应的连接
+        self.ping_interval = ping_interval if ping_interval is not None else float(os.getenv("WS_PING_INTERVAL", "0"))
+        self.ping_timeout = ping_timeout or float(os.getenv("WS_PING_TIMEOUT", "60"))
+        self.connections: Dict[str, ClientConnection] = {}
+        self.dropped = 0
+        self.overflow_disconnects = 0
+        self.timeouts = 0
+        self.protocol_errors = 0
+        # 进行中的关闭握手任务
+        self.closing = set()
+
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self.connections
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def get(self, client_id: str) -> Optional[ClientConnection]:
+        return self.connections.get(client_id)
+
+    def add(self, client_id: str, websocket: WebSocket, codec=JSON_CODEC) -> ClientConnection:
+        connection = ClientConnection(client_id, websocket, self, codec)
+        previous = self.connections.get(client_id)
+        if previous is not None:
+            # 同一用户重复登录时只保留最新的连接
+            previous.close(1000)
+        self.connections[client_id] = connection
+        connection.start()
+        return connection
+
+    def remove(self, connection: ClientConnection) -> bool:
+        """关闭连接；返回该连接是否仍是此用户当前登记的连接"""
+        connection.close()
+        for task in connection._tasks:
+            task.cancel()
+        if self.connections.get(connection.client_id) is connection:
+            del self.connections[connection.client_id]
+            return True
+        return False
+
+    def send(self, client_id: str, frame: Dict) -> bool:
+        connection = self.connections.get(client_id)
+        return connection.send(frame) if connection is not None else False
+
+    def stats(self) -> Dict:
+        depths = [len(c.queue) for c in self.connections.values()]
+        return {
+            "connections": len(depths),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "max_queue": self.max_queue,
+            "overflow_policy": self.overflow,
+            "binary_connections": sum(1 for c in self.connections.values() if c.codec.binary),
+            "dropped_frames": self.dropped,
+            "overflow_disconnects": self.overflow_disconnects,
+            "timeouts": self.timeouts,
+            "protocol_errors": self.protocol_errors,
+        }
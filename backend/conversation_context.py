@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ROLE_NAMES = {"elder": "长辈", "young": "年轻人"}
+PLACEHOLDERS = {"image": "[图片]", "emoji": "[表情包]"}
+
+Summarizer = Callable[[str, List[str]], Awaitable[str]]
+
+
+def format_turn(message: Dict) -> str:
+    """把一条历史消息格式化为 "说话人: 内容"，图片和表情包用占位符代替"""
+    speaker = (message.get("from") or "").split("_")[0]
+    content = PLACEHOLDERS.get(message.get("type")) or (message.get("message") or "")
+    return f"{ROLE_NAMES.get(speaker, speaker or '未知')}: {content}"
+
+
+class ConversationContext:
+    """由服务端根据已保存的历史为分析组装上下文：每个配对一份滚动摘要 + 最近几轮原文
+
+    摘要按消息序号增量更新：未被摘要覆盖的消息达到 refresh_every 条时，在后台把这些消息
+    并入已有摘要。提示词因此保持短小且前缀稳定，同时覆盖很长的对话。
+    """
+
+    def __init__(self, db, summarize: Summarizer, recent_turns: int = None, refresh_every: int = None,
+                 summary_ttl: float = None, max_pairs: int = None):
+        self.db = db
+        self.summarize = summarize
+        self.recent_turns = recent_turns or int(os.getenv("CONTEXT_RECENT_TURNS", "6"))
+        self.refresh_every = refresh_every or int(os.getenv("SUMMARY_REFRESH_EVERY", "20"))
+        # 摘要在本worker内的缓存时间，其他worker刷新的摘要最迟在这之后可见
+        self.summary_ttl = summary_ttl or float(os.getenv("SUMMARY_CACHE_TTL", "60"))
+        self.max_pairs = max_pairs or int(os.getenv("SUMMARY_CACHE_PAIRS", "10000"))
+        self._summaries: "OrderedDict[int, Tuple[Optional[Dict], float]]" = OrderedDict()
+        self._refreshing: Dict[int, asyncio.Task] = {}
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def _remember(self, pair_id: int, summary: Optional[Dict]):
+        self._summaries[pair_id] = (summary, time.monotonic())
+        self._summaries.move_to_end(pair_id)
+        while len(self._summaries) > self.max_pairs:
+            self._summaries.popitem(last=False)
+
+    def _cached(self, pair_id: int):
+        cached = self._summaries.get(pair_id)
+        if cached is None or time.monotonic() - cached[1] >= self.summary_ttl:
+            return None
+        return cached
+
+    async def get_summary(self, pair_id: int) -> Optional[Dict]:
+        cached = self._cached(pair_id)
+        if cached is not None:
+            return cached[0]
+        summary = await self.db.get_summary(pair_id)
+        self._remember(pair_id, summary)
+        return summary
+
+    async def build(self, pair_id: int, message_id: Optional[int] = None) -> Tuple[str, List[str]]:
+        """返回 (摘要, message_id 之前最近几轮的原文)；不传 message_id 时取最新的几轮"""
+        summary = await self.get_summary(pair_id)
+        recent = await self.db.get_messages(pair_id, limit=self.recent_turns, before_id=message_id)
+        return (summary["summary"] if summary else ""), [format_turn(message) for message in recent]
+
+    def note_message(self, pair_id: int, seq: Optional[int]):
+        """每转发一条消息调用一次，需要时在后台刷新摘要，不阻塞消息转发"""
+        if seq is None or pair_id in self._refreshing:
+            return
+        cached = self._cached(pair_id)
+        if cached is not None:
+            covered = cached[0]["covered_seq"] if cached[0] else 0
+            if seq - covered < self.refresh_every:
+                return
+        task = asyncio.create_task(self._maybe_refresh(pair_id, seq))
+        self._refreshing[pair_id] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(pair_id, None))
+
+    async def _maybe_refresh(self, pair_id: int, seq: int):
+        try:
+            summary = await self.get_summary(pair_id)
+            covered = summary["covered_seq"] if summary else 0
+            if seq - covered < self.refresh_every:
+                return
+            # 只取已落库的消息；还在写入队列中的消息留给下一次刷新
+            rows = await self.db.get_messages_after_seq(pair_id, covered, self.refresh_every * 3)
+            if not rows:
+                return
+            updated = await self.summarize(summary["summary"] if summary else "", [format_turn(row) for row in rows])
+            covered_seq = rows[-1]["seq"]
+            await self.db.save_summary(pair_id, updated, covered_seq)
+            self._remember(pair_id, {"summary": updated, "covered_seq": covered_seq})
+            self.refreshes += 1
+            logger.info(f"[摘要] pair {pair_id} 已更新到序号 {covered_seq}")
+        except Exception as e:
+            self.refresh_failures += 1
+            logger.warning(f"刷新对话摘要失败: {str(e)}")
+
+    def stats(self) -> Dict:
+        return {
+            "summaries_cached": len(self._summaries),
+            "summary_refreshes": self.refreshes,
+            "summary_refresh_failures": self.refresh_failures,
+        }
+
+    async def close(self):
+        for task in list(self._refreshing.values()):
+            task.cancel()
@@ -1,135 +1,542 @@
 import mysql.connector
-from mysql.connector import Error
+import asyncio
 import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from dotenv import load_dotenv
 
+import metrics
+
 # 加载环境变量
 load_dotenv()
 
-class DatabaseManager:
-    def __init__(self):
-        self.connection = None
+# 数据本身有问题导致的错误，重试也不会成功
+PERMANENT_ERRORS = (
+    mysql.connector.errors.DataError,
+    mysql.connector.errors.IntegrityError,
+    mysql.connector.errors.ProgrammingError,
+    sqlite3.DataError,
+    sqlite3.IntegrityError,
+    sqlite3.ProgrammingError,
+    ValueError,
+    TypeError,
+    KeyError,
+)
+
+
+class ConnectionPool:
+    """线程安全的数据库连接池，支持最小/最大连接数，取出连接时做健康检查"""
+
+    def __init__(self, factory, validate, min_size=1, max_size=10, timeout=10.0):
+        self.factory = factory
+        self.validate = validate
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.timeout = timeout
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def fill(self):
+        # 预先建立最小数量的连接
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self.factory()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            self.release(conn)
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("数据库连接池已关闭")
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("等待数据库连接超时")
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    return self.factory()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+
+            # 健康检查失败的连接直接丢弃，重新获取
+            if self._is_healthy(conn):
+                return conn
+            self.release(conn, discard=True)
+
+    def release(self, conn, discard=False):
+        with self._cond:
+            if discard or self._closed:
+                self._size -= 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
         try:
-            self.connect()
-        except Exception as e:
-            print(f"数据库连接失败: {e}")
+            yield conn
+        except Exception:
+            # 出错的连接可能处于未知状态，回滚失败则丢弃
+            try:
+                conn.rollback()
+                healthy = True
+            except Exception:
+                healthy = False
+            self.release(conn, discard=not healthy)
             raise
+        else:
+            self.release(conn)
 
-    def connect(self):
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._size -= 1
+                self._close_quietly(self._idle.pop())
+            self._cond.notify_all()
+
+    def _is_healthy(self, conn):
         try:
-            self.connection = mysql.connector.connect(
-                host=os.getenv('DB_HOST'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD'),
-                database=os.getenv('DB_NAME')
-            )
-            print("MySQL数据库连接成功")
-        except Error as e:
+            return self.validate(conn)
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+# 历史查询返回的字段，热表查询和归档时共用
+HISTORY_COLUMNS = """
+        m.message_id as "id",
+        m.from_role as "from",
+        m.to_role as "to",
+        m.message_type as "type",
+        m.message_content as "message",
+        m.pair_id as "pair_id",
+        m.created_at as "created_at",
+        m.image_data as "image_data",
+        m.seq as "seq",
+        a.analysis as "pretranslation"
+"""
+# 带上预翻译结果（没有时为空）
+HISTORY_SOURCE = """
+    chat_messages m
+    LEFT JOIN message_analyses a ON a.pair_id = m.pair_id AND a.message_id = m.message_id
+"""
+
+
+class DatabaseManager:
+    def __init__(self, backend=None):
+        # DB_BACKEND=sqlite 时使用本地SQLite文件代替MySQL，便于本地压测
+        self.backend = (backend or os.getenv('DB_BACKEND', 'mysql')).lower()
+        self.pool = ConnectionPool(
+            factory=self.connect,
+            validate=self._validate_connection,
+            min_size=int(os.getenv('DB_POOL_MIN', '1')),
+            max_size=int(os.getenv('DB_POOL_MAX', '10')),
+            timeout=float(os.getenv('DB_POOL_TIMEOUT', '10')),
+        )
+        self._schema_ready = False
+        # 多个查询线程可能同时第一次调用 ensure_schema，只让一个线程执行建表
+        self._schema_lock = threading.Lock()
+        # 冷数据层（history_archive.HistoryArchive），设置后历史查询会合并已归档的分段
+        self.archive = None
+        try:
+            self.pool.fill()
+            print("数据库连接池初始化成功")
+        except Exception as e:
+            # 与之前一样，启动时连不上数据库不致命，使用时再重连
             print(f"数据库连接错误: {e}")
 
-    def init_db(self):
-        # 先删除可能存在的旧表（仅用于开发环境）
-        self.execute_query("DROP TABLE IF EXISTS users")
-        for i in range(1, 11):
-            self.execute_query(f"DROP TABLE IF EXISTS chat_records_pair_{i}")
-        
-        # 创建新的用户表（添加pair_id字段）
-        self.execute_query("""
-        CREATE TABLE IF NOT EXISTS users (
-            id VARCHAR(36) PRIMARY KEY,
-            role ENUM('elder', 'young') NOT NULL,
-            pair_id VARCHAR(36) NOT NULL, 
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )""")
-
-        # 创建10对用户
-        for i in range(1, 11):
-            pair_id = f"{i}"
-            # 创建长辈用户
-            self.execute_query(
-                "INSERT INTO users (id, role, pair_id) VALUES (%s, %s, %s)",
-                (f"elder_{i}", "elder", pair_id)
-            )
-            # 创建晚辈用户
-            self.execute_query(
-                "INSERT INTO users (id, role, pair_id) VALUES (%s, %s, %s)",
-                (f"young_{i}", "young", pair_id)
+    def connect(self):
+        if self.backend == 'sqlite':
+            conn = sqlite3.connect(
+                os.getenv('DB_SQLITE_PATH', 'chat_translator.db'),
+                timeout=30,
+                check_same_thread=False,
             )
-            
-            # 为每对用户创建聊天记录表
-            self.execute_query(f"""
-            CREATE TABLE IF NOT EXISTS chat_records_pair_{pair_id} (
-                id INT AUTO_INCREMENT PRIMARY KEY,
+            conn.execute("PRAGMA journal_mode=WAL")
+            return conn
+        return mysql.connector.connect(
+            host=os.getenv('DB_HOST'),
+            user=os.getenv('DB_USER'),
+            password=os.getenv('DB_PASSWORD'),
+            database=os.getenv('DB_NAME')
+        )
+
+    def _validate_connection(self, conn):
+        if self.backend == 'sqlite':
+            conn.execute("SELECT 1")
+            return True
+        return conn.is_connected()
+
+    def _sql(self, query):
+        # SQLite使用 ? 作为参数占位符
+        if self.backend == 'sqlite':
+            return query.replace('%s', '?')
+        return query
+
+    def _message_table_ddl(self):
+        """所有聊天对共用的消息表。(pair_id, message_id, from_role) 唯一，重复写入会被忽略"""
+        if self.backend == 'sqlite':
+            return [
+                """
+                CREATE TABLE IF NOT EXISTS chat_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    pair_id INTEGER NOT NULL,
+                    message_id BIGINT NOT NULL,
+                    from_role VARCHAR(64) NOT NULL,
+                    to_role VARCHAR(64) NOT NULL,
+                    message_type VARCHAR(10) NOT NULL,
+                    message_content TEXT,
+                    image_data VARCHAR(255),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    seq BIGINT,
+                    UNIQUE (pair_id, message_id, from_role)
+                )""",
+                "CREATE INDEX IF NOT EXISTS idx_chat_messages_pair_created ON chat_messages (pair_id, created_at)",
+            ]
+
+        # 可选按pair_id哈希分区；分区表的唯一键都必须包含pair_id
+        partitions = int(os.getenv('DB_MESSAGE_PARTITIONS', '0'))
+        partition_clause = f"PARTITION BY HASH(pair_id) PARTITIONS {partitions}" if partitions > 1 else ""
+        return [f"""
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                id BIGINT NOT NULL AUTO_INCREMENT,
+                pair_id INT NOT NULL,
                 message_id BIGINT NOT NULL,
-                from_role VARCHAR(10) NOT NULL,
-                to_role VARCHAR(10) NOT NULL,
+                from_role VARCHAR(64) NOT NULL,
+                to_role VARCHAR(64) NOT NULL,
                 message_type VARCHAR(10) NOT NULL,
                 message_content TEXT,
-                image_data VARCHAR(255), 
+                image_data VARCHAR(255),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                seq BIGINT NULL,
+                PRIMARY KEY (pair_id, id),
+                KEY idx_id (id),
+                UNIQUE KEY uk_pair_message (pair_id, message_id, from_role),
+                KEY idx_pair_created (pair_id, created_at),
+                KEY idx_pair_seq (pair_id, seq)
+            ) {partition_clause}"""]
+
+    def _column_exists(self, table, column):
+        if self.backend == 'sqlite':
+            _, rows = self.execute_query(f"SELECT name FROM pragma_table_info('{table}') WHERE name = %s", (column,))
+            return bool(rows)
+        _, rows = self.execute_query(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s",
+            (table, column)
+        )
+        return bool(rows)
+
+    def _ensure_seq_column(self):
+        # 早于序号功能创建的消息表补上 seq 列；迁移来的旧消息 seq 为空
+        if not self._column_exists('chat_messages', 'seq'):
+            if self.backend == 'sqlite':
+                self.execute_query("ALTER TABLE chat_messages ADD COLUMN seq BIGINT")
+            else:
+                self.execute_query(
+                    "ALTER TABLE chat_messages ADD COLUMN seq BIGINT NULL, ADD KEY idx_pair_seq (pair_id, seq)"
+                )
+        if self.backend == 'sqlite':
+            self.execute_query(
+                "CREATE INDEX IF NOT EXISTS idx_chat_messages_pair_seq ON chat_messages (pair_id, seq)"
+            )
+
+    def _ensure_analysis_hash_column(self):
+        # 早于内容校验创建的预翻译表补上 content_hash 列；旧结果的哈希为空，查询时不会命中
+        if not self._column_exists('message_analyses', 'content_hash'):
+            self.execute_query("ALTER TABLE message_analyses ADD COLUMN content_hash CHAR(64) NULL")
+
+    def _summary_table_ddl(self):
+        """每个配对一行的对话滚动摘要，covered_seq 为摘要已覆盖到的消息序号"""
+        return """
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            pair_id INT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered_seq BIGINT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )"""
+
+    def _pretranslation_tables_ddl(self):
+        """预翻译：按配对开关，结果按消息保存（每条消息只为接收方翻译一次）"""
+        return [
+            """
+            CREATE TABLE IF NOT EXISTS pair_settings (
+                pair_id INT PRIMARY KEY,
+                pretranslate SMALLINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""",
+            """
+            CREATE TABLE IF NOT EXISTS message_analyses (
                 pair_id INT NOT NULL,
+                message_id BIGINT NOT NULL,
+                role VARCHAR(10) NOT NULL,
+                analysis TEXT NOT NULL,
+                content_hash CHAR(64) NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                INDEX idx_message_id (message_id),
-                INDEX idx_pair_id (pair_id)
-            )""")
+                PRIMARY KEY (pair_id, message_id)
+            )""",
+        ]
+
+    def _history_segments_ddl(self):
+        """已归档到对象存储的聊天记录分段索引：每段的消息ID和序号范围"""
+        return """
+        CREATE TABLE IF NOT EXISTS history_segments (
+            pair_id INT NOT NULL,
+            segment_key VARCHAR(255) NOT NULL,
+            first_id BIGINT NOT NULL,
+            last_id BIGINT NOT NULL,
+            first_seq BIGINT NULL,
+            last_seq BIGINT NULL,
+            message_count INT NOT NULL,
+            size_bytes INT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (pair_id, segment_key)
+        )"""
+
+    def _pair_tables_ddl(self):
+        """配对和用户：pairs 分配配对ID，users 记录每个客户端ID属于哪个配对、是什么角色"""
+        if self.backend == 'sqlite':
+            pair_table = """
+            CREATE TABLE IF NOT EXISTS pairs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )"""
+            role_type = "VARCHAR(10)"
+        else:
+            pair_table = """
+            CREATE TABLE IF NOT EXISTS pairs (
+                id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )"""
+            role_type = "ENUM('elder', 'young')"
+        return [
+            pair_table,
+            f"""
+            CREATE TABLE IF NOT EXISTS users (
+                id VARCHAR(64) PRIMARY KEY,
+                role {role_type} NOT NULL,
+                pair_id INT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""",
+        ]
+
+    def _ensure_pair_tables(self):
+        for ddl in self._pair_tables_ddl():
+            self.execute_query(ddl)
+        if self.backend == 'sqlite':
+            self.execute_query("CREATE INDEX IF NOT EXISTS idx_users_pair ON users (pair_id)")
+        else:
+            _, rows = self.execute_query(
+                "SELECT 1 FROM information_schema.statistics "
+                "WHERE table_schema = DATABASE() AND table_name = 'users' AND index_name = 'idx_users_pair'"
+            )
+            if not rows:
+                self.execute_query("ALTER TABLE users ADD KEY idx_users_pair (pair_id)")
+        # 早于 pairs 表创建的用户补登配对ID，之后自动分配的ID不会与之冲突
+        self.execute_query(f"{self._insert_ignore()} INTO pairs (id) SELECT DISTINCT pair_id FROM users")
+
+    def ensure_schema(self):
+        # 只在第一次写入/读取时建表，之后不再探测表结构。建好之后不加锁，只读一次标志
+        if self._schema_ready:
+            return
+        with self._schema_lock:
+            # 等锁期间其他线程可能已经建好
+            if self._schema_ready:
+                return
+            for ddl in self._message_table_ddl():
+                self.execute_query(ddl)
+            self._ensure_seq_column()
+            self.execute_query(self._summary_table_ddl())
+            for ddl in self._pretranslation_tables_ddl():
+                self.execute_query(ddl)
+            self._ensure_analysis_hash_column()
+            self.execute_query(self._history_segments_ddl())
+            self._ensure_pair_tables()
+            self._schema_ready = True
+
+    def init_db(self):
+        # 先删除可能存在的旧表（仅用于开发环境）
+        self.execute_query("DROP TABLE IF EXISTS users")
+        self.execute_query("DROP TABLE IF EXISTS pairs")
+        self.execute_query("DROP TABLE IF EXISTS chat_messages")
+        self.execute_query("DROP TABLE IF EXISTS conversation_summaries")
+        self.execute_query("DROP TABLE IF EXISTS pair_settings")
+        self.execute_query("DROP TABLE IF EXISTS message_analyses")
+        self.execute_query("DROP TABLE IF EXISTS history_segments")
+        self._schema_ready = False
+
+        # 创建所有聊天对共用的消息表、配对和用户表
+        self.ensure_schema()
+
+        # 开发环境预置的配对（elder_N / young_N），其余配对通过 /api/pairs 在运行时创建
+        for _ in range(int(os.getenv('DB_SEED_PAIRS', '10'))):
+            self.create_pair()
+
+    # ---- 配对注册 ----
+
+    def create_pair(self, pair_id=None):
+        """创建配对及其两个用户 elder_<pair_id> / young_<pair_id>，在一个事务中完成。
+        不传 pair_id 时自动分配，配对已存在时抛出 ValueError"""
+        self.ensure_schema()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                if pair_id is None:
+                    cursor.execute(
+                        "INSERT INTO pairs DEFAULT VALUES" if self.backend == 'sqlite' else "INSERT INTO pairs () VALUES ()"
+                    )
+                    pair_id = cursor.lastrowid
+                else:
+                    cursor.execute(self._sql("INSERT INTO pairs (id) VALUES (%s)"), (int(pair_id),))
+                elder_id, young_id = f"elder_{pair_id}", f"young_{pair_id}"
+                cursor.execute(
+                    self._sql("INSERT INTO users (id, role, pair_id) VALUES (%s, %s, %s), (%s, %s, %s)"),
+                    (elder_id, "elder", int(pair_id), young_id, "young", int(pair_id))
+                )
+                conn.commit()
+            except (sqlite3.IntegrityError, mysql.connector.errors.IntegrityError):
+                conn.rollback()
+                raise ValueError(f"配对 {pair_id} 已存在")
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+        return {"pair_id": int(pair_id), "elder_id": elder_id, "young_id": young_id}
+
+    def delete_pair(self, pair_id):
+        """删除配对及其用户（聊天记录保留），在一个事务中完成，返回配对是否存在。
+        中途失败时整体回滚，不会留下没有配对的用户、或没有用户的配对"""
+        self.ensure_schema()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(self._sql("DELETE FROM users WHERE pair_id = %s"), (int(pair_id),))
+                cursor.execute(self._sql("DELETE FROM pairs WHERE id = %s"), (int(pair_id),))
+                existed = cursor.rowcount > 0
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+        return existed
+
+    def get_pair_member(self, client_id):
+        """客户端ID所属的配对、角色和对方ID，未注册时返回 None"""
+        self.ensure_schema()
+        columns, rows = self.execute_query("""
+        SELECT u.pair_id as "pair_id", u.role as "role", p.id as "partner"
+        FROM users u
+        JOIN users p ON p.pair_id = u.pair_id AND p.id <> u.id
+        WHERE u.id = %s
+        """, (client_id,))
+        return dict(zip(columns, rows[0])) if rows else None
+
+    def get_pair_members(self, pair_id):
+        self.ensure_schema()
+        columns, rows = self.execute_query(
+            'SELECT id as "id", role as "role" FROM users WHERE pair_id = %s ORDER BY role', (int(pair_id),)
+        )
+        return [dict(zip(columns, row)) for row in rows]
 
     def execute_query(self, query, params=None):
+        """执行SQL。SELECT查询返回 (列名列表, 行列表)，其他语句提交事务后返回None"""
         try:
-            if not self.connection or not self.connection.is_connected():
-                self.connect()
-                
-            cursor = self.connection.cursor()
-            cursor.execute(query, params or ())
-            
-            # 对于SELECT查询，返回cursor
-            if query.strip().upper().startswith('SELECT'):
-                return cursor
-                
-            # 对于非SELECT查询，提交事务并关闭cursor
-            self.connection.commit()
-            cursor.close()
-            return None
-            
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(self._sql(query), params or ())
+
+                    # 对于SELECT查询，在归还连接前取出全部结果
+                    if query.strip().upper().startswith('SELECT'):
+                        columns = [col[0] for col in cursor.description]
+                        return columns, cursor.fetchall()
+
+                    # 对于非SELECT查询，提交事务
+                    conn.commit()
+                    return None
+                finally:
+                    cursor.close()
+
         except Exception as e:
-            if 'cursor' in locals():
-                cursor.close()
             print(f"执行查询失败: {str(e)}")
             raise
 
+    def check(self):
+        """健康检查：从连接池取一个连接执行 SELECT 1"""
+        self.execute_query("SELECT 1")
+
+    def _table_exists(self, table):
+        return table in self.list_tables(table)
+
+    def list_tables(self, pattern):
+        """列出名称匹配 LIKE 模式的表"""
+        if self.backend == 'sqlite':
+            _, rows = self.execute_query(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE %s", (pattern,)
+            )
+            return [row[0] for row in rows]
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SHOW TABLES LIKE %s", (pattern,))
+                return [row[0] for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+
+    def _insert_ignore(self):
+        return "INSERT OR IGNORE" if self.backend == 'sqlite' else "INSERT IGNORE"
+
     def save_message(self, message_id, from_role, to_role, message_type, message_content, image_data, pair_id):
         try:
-            # 检查数据库连接
-            if not self.connection or not self.connection.is_connected():
-                print("数据库连接已断开，尝试重新连接...")
-                self.connect()
-                
-            # 检查表是否存在
-            cursor = self.connection.cursor()
-            cursor.execute(f"SHOW TABLES LIKE 'chat_records_pair_{pair_id}'")
-            if not cursor.fetchone():
-                print(f"表chat_records_pair_{pair_id}不存在，尝试创建...")
-                self.execute_query(f"""
-                CREATE TABLE IF NOT EXISTS chat_records_pair_{pair_id} (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    message_id BIGINT NOT NULL,
-                    from_role VARCHAR(10) NOT NULL,
-                    to_role VARCHAR(10) NOT NULL,
-                    message_type VARCHAR(10) NOT NULL,
-                    message_content TEXT,
-                    image_data VARCHAR(255), 
-                    pair_id INT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )""")
-                
-            # 保存消息
-            query = f"""
-            INSERT INTO chat_records_pair_{pair_id} 
-            (message_id, from_role, to_role, message_type, message_content, image_data, pair_id) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """
-            params = (message_id, from_role, to_role, message_type, message_content, image_data, pair_id)
-            print(f"执行SQL: {query % params}")
-            self.execute_query(query, params)
-            print(f"消息成功保存到chat_records_pair_{pair_id}表")
+            self.save_messages([{
+                "message_id": message_id,
+                "from_role": from_role,
+                "to_role": to_role,
+                "message_type": message_type,
+                "message_content": message_content,
+                "image_data": image_data,
+                "pair_id": pair_id,
+            }])
             return True
         except Exception as e:
             print(f"保存消息失败: {str(e)}")
@@ -137,40 +544,392 @@ class DatabaseManager:
             traceback.print_exc()
             return False
 
-    def get_messages(self, pair_id, limit=500):
-        try:
-            if not self.connection or not self.connection.is_connected():
-                self.connect()
-                
+    def save_messages(self, messages, created_at=False):
+        """批量保存消息：一条多行INSERT，整批在一个事务中提交。失败时抛出异常由调用方重试。
+
+        created_at=True 时使用消息自带的 created_at（迁移历史数据时保留原时间）。
+        """
+        if not messages:
+            return 0
+        self.ensure_schema()
+
+        columns = "pair_id, message_id, from_role, to_role, message_type, message_content, image_data, seq"
+        width = 8
+        if created_at:
+            columns += ", created_at"
+            width += 1
+        row_placeholder = "(" + ", ".join(["%s"] * width) + ")"
+        query = f"""
+        {self._insert_ignore()} INTO chat_messages ({columns})
+        VALUES {", ".join([row_placeholder] * len(messages))}
+        """
+        params = []
+        for msg in messages:
+            params.extend((
+                int(msg['pair_id']), msg['message_id'], msg['from_role'], msg['to_role'],
+                msg['message_type'], msg['message_content'], msg['image_data'], msg.get('seq')
+            ))
+            if created_at:
+                params.append(msg['created_at'])
+        self.execute_query(query, params)
+        return len(messages)
+
+    def _history_query(self, pair_id, limit, before_id=None, after_id=None, after_seq=None):
+        """构造基于 (pair_id, message_id) 索引的游标分页查询，结果按 message_id 升序
+
+        - after_seq: 返回配对内序号大于该值的消息，按序号升序（WebSocket重连补发）
+        - after_id: 返回该消息之后的消息（断线重连时只取增量）
+        - before_id: 返回该消息之前最近的一页（向上翻页）
+        - 都不传: 返回最新的一页
+        """
+        columns = HISTORY_COLUMNS
+        source = HISTORY_SOURCE
+        if after_seq is not None:
+            query = f"""
+            SELECT {columns}
+            FROM {source}
+            WHERE m.pair_id = %s AND m.seq > %s
+            ORDER BY m.seq ASC
+            LIMIT %s
+            """
+            return query, (int(pair_id), int(after_seq), limit)
+
+        if after_id is not None:
             query = f"""
-            SELECT 
-                message_id as "id",
-                from_role as "from",
-                to_role as "to",
-                message_type as "type",
-                message_content as "message",
-                pair_id as "pair_id",
-                created_at as "created_at",
-                image_data as "image_data"
-            FROM chat_records_pair_{pair_id}
-            ORDER BY created_at ASC
+            SELECT {columns}
+            FROM {source}
+            WHERE m.pair_id = %s AND m.message_id > %s
+            ORDER BY m.message_id ASC
             LIMIT %s
             """
-            cursor = self.execute_query(query, (limit,))
-            
-            # 将结果转换为字典列表
-            columns = [col[0] for col in cursor.description]
-            messages = []
-            for row in cursor:
-                messages.append(dict(zip(columns, row)))
-                
-            cursor.close()
-            return messages
-            
+            return query, (int(pair_id), int(after_id), limit)
+
+        condition = "m.pair_id = %s"
+        params = [int(pair_id)]
+        if before_id is not None:
+            condition += " AND m.message_id < %s"
+            params.append(int(before_id))
+        params.append(limit)
+        # 先倒序取最近的一页，再在外层恢复为升序
+        query = f"""
+        SELECT * FROM (
+            SELECT {columns}
+            FROM {source}
+            WHERE {condition}
+            ORDER BY m.message_id DESC
+            LIMIT %s
+        ) page
+        ORDER BY page.id ASC
+        """
+        return query, tuple(params)
+
+    def _read_history(self, pair_id, limit, before_id=None, after_id=None, after_seq=None):
+        self.ensure_schema()
+        query, params = self._history_query(pair_id, limit, before_id, after_id, after_seq)
+        columns, rows = self.execute_query(query, params)
+
+        # 将结果转换为字典列表
+        rows = [dict(zip(columns, row)) for row in rows]
+        return self._with_archived(pair_id, rows, limit, before_id, after_id, after_seq)
+
+    def _with_archived(self, pair_id, rows, limit, before_id=None, after_id=None, after_seq=None):
+        """热表结果不够一页，或增量查询的范围落在已归档的分段里时，合并冷数据层的消息"""
+        if self.archive is None:
+            return rows
+        # 归档的总是较早的消息：热表已经凑满一页时，向前翻页不需要看冷数据
+        if after_seq is None and after_id is None and len(rows) >= limit:
+            return rows
+        segments = self.get_segments(pair_id, before_id, after_id, after_seq)
+        if not segments:
+            return rows
+        return self.archive.merge(rows, segments, limit, before_id, after_id, after_seq)
+
+    def get_messages(self, pair_id, limit=500, before_id=None, after_id=None):
+        try:
+            return self._read_history(pair_id, limit, before_id, after_id)
         except Exception as e:
             print(f"获取历史消息失败: {str(e)}")
             return []
 
+    def get_messages_after_seq(self, pair_id, after_seq, limit=500):
+        """按配对内序号取 after_seq 之后的消息，用于重连补发"""
+        return self._read_history(pair_id, limit, after_seq=after_seq)
+
+    def get_max_seq(self, pair_id):
+        self.ensure_schema()
+        _, rows = self.execute_query("SELECT MAX(seq) FROM chat_messages WHERE pair_id = %s", (int(pair_id),))
+        # 整个配对的消息都已归档时，序号要从分段索引里接着算
+        _, archived = self.execute_query(
+            "SELECT MAX(last_seq) FROM history_segments WHERE pair_id = %s", (int(pair_id),)
+        )
+        return max(rows[0][0] or 0, archived[0][0] or 0)
+
+    # ---- 冷热分层 ----
+
+    def get_segments(self, pair_id, before_id=None, after_id=None, after_seq=None):
+        """与一次历史查询相关的分段，按读取顺序排好：增量查询从旧到新，向前翻页从新到旧"""
+        self.ensure_schema()
+        condition = "pair_id = %s"
+        params = [int(pair_id)]
+        if after_seq is not None:
+            condition += " AND last_seq > %s"
+            params.append(int(after_seq))
+            order = "first_seq ASC"
+        elif after_id is not None:
+            condition += " AND last_id > %s"
+            params.append(int(after_id))
+            order = "first_id ASC"
+        else:
+            if before_id is not None:
+                condition += " AND first_id < %s"
+                params.append(int(before_id))
+            order = "last_id DESC"
+        columns, rows = self.execute_query(f"""
+        SELECT segment_key as "key", first_id, last_id, first_seq, last_seq
+        FROM history_segments
+        WHERE {condition}
+        ORDER BY {order}
+        """, tuple(params))
+        return [dict(zip(columns, row)) for row in rows]
+
+    def _days_ago(self, days):
+        # created_at 由数据库按自己的时钟写入，截止时间也在数据库里计算
+        if self.backend == 'sqlite':
+            return "datetime('now', %s)", f"-{float(days)} days"
+        return "NOW() - INTERVAL %s SECOND", int(float(days) * 86400)
+
+    def archive_candidates(self, pair_id, hot_days, keep_recent, limit):
+        """配对中可以归档的消息：最新的 keep_recent 条之外、早于 hot_days 天的，按消息ID从旧到新"""
+        self.ensure_schema()
+        _, rows = self.execute_query(
+            "SELECT message_id FROM chat_messages WHERE pair_id = %s ORDER BY message_id DESC LIMIT 1 OFFSET %s",
+            (int(pair_id), int(keep_recent) - 1)
+        )
+        if not rows:
+            return []
+        cutoff, cutoff_param = self._days_ago(hot_days)
+        columns, rows = self.execute_query(f"""
+        SELECT m.id as "row_id", {HISTORY_COLUMNS}
+        FROM {HISTORY_SOURCE}
+        WHERE m.pair_id = %s AND m.message_id < %s AND m.created_at < {cutoff}
+        ORDER BY m.message_id ASC
+        LIMIT %s
+        """, (int(pair_id), rows[0][0], cutoff_param, int(limit)))
+        return [dict(zip(columns, row)) for row in rows]
+
+    def save_segment(self, pair_id, segment):
+        self.execute_query(f"""
+        {self._insert_ignore()} INTO history_segments
+            (pair_id, segment_key, first_id, last_id, first_seq, last_seq, message_count, size_bytes)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (int(pair_id), segment["key"], segment["first_id"], segment["last_id"], segment["first_seq"],
+              segment["last_seq"], segment["count"], segment["size"]))
+
+    def delete_archived_rows(self, pair_id, row_ids, batch_size=500):
+        # 按自增主键删除，归档期间新写入的消息不受影响
+        for i in range(0, len(row_ids), batch_size):
+            batch = row_ids[i:i + batch_size]
+            self.execute_query(
+                f"DELETE FROM chat_messages WHERE pair_id = %s AND id IN ({', '.join(['%s'] * len(batch))})",
+                (int(pair_id), *batch)
+            )
+
+    def archive_pair(self, pair_id):
+        """把一个配对的冷消息写成分段并从热表删除，返回归档的消息数。
+
+        先上传分段、再写索引、最后删热表：中途失败时消息可能同时在两层，读取时以热表为准去重，
+        下次归档会把它们写进新的分段。
+        """
+        archive = self.archive
+        archived = 0
+        while True:
+            rows = self.archive_candidates(pair_id, archive.hot_days, archive.hot_min, archive.segment_max)
+            if len(rows) < archive.segment_min:
+                break
+            row_ids = [row.pop("row_id") for row in rows]
+            self.save_segment(pair_id, archive.write(pair_id, rows))
+            self.delete_archived_rows(pair_id, row_ids)
+            archived += len(rows)
+            if len(rows) < archive.segment_max:
+                break
+        return archived
+
+    def archive_history(self):
+        """归档所有配对的冷消息，返回 (涉及的配对数, 归档的消息数)"""
+        self.ensure_schema()
+        cutoff, cutoff_param = self._days_ago(self.archive.hot_days)
+        _, rows = self.execute_query(
+            f"SELECT DISTINCT pair_id FROM chat_messages WHERE created_at < {cutoff}", (cutoff_param,)
+        )
+        pairs = messages = 0
+        for (pair_id,) in rows:
+            archived = self.archive_pair(pair_id)
+            if archived:
+                pairs += 1
+                messages += archived
+        return pairs, messages
+
+    def get_summary(self, pair_id):
+        """返回 {"summary", "covered_seq"}，没有摘要时返回None"""
+        self.ensure_schema()
+        _, rows = self.execute_query(
+            "SELECT summary, covered_seq FROM conversation_summaries WHERE pair_id = %s", (int(pair_id),)
+        )
+        if not rows:
+            return None
+        return {"summary": rows[0][0], "covered_seq": rows[0][1]}
+
+    def save_summary(self, pair_id, summary, covered_seq):
+        """写入摘要；已有覆盖范围更新的摘要时不覆盖（多个worker可能同时刷新）"""
+        self.ensure_schema()
+        if self.backend == 'sqlite':
+            query = """
+            INSERT INTO conversation_summaries (pair_id, summary, covered_seq) VALUES (%s, %s, %s)
+            ON CONFLICT(pair_id) DO UPDATE SET
+                summary = excluded.summary,
+                covered_seq = excluded.covered_seq,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE excluded.covered_seq > conversation_summaries.covered_seq
+            """
+        else:
+            # summary 必须在 covered_seq 之前赋值，才能和旧的 covered_seq 比较
+            query = """
+            INSERT INTO conversation_summaries (pair_id, summary, covered_seq) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                summary = IF(VALUES(covered_seq) > covered_seq, VALUES(summary), summary),
+                updated_at = IF(VALUES(covered_seq) > covered_seq, CURRENT_TIMESTAMP, updated_at),
+                covered_seq = GREATEST(covered_seq, VALUES(covered_seq))
+            """
+        self.execute_query(query, (int(pair_id), summary, int(covered_seq)))
+
+    def get_pretranslate(self, pair_id):
+        """该配对是否开启了预翻译；没有设置过时返回None"""
+        self.ensure_schema()
+        _, rows = self.execute_query("SELECT pretranslate FROM pair_settings WHERE pair_id = %s", (int(pair_id),))
+        return bool(rows[0][0]) if rows else None
+
+    def set_pretranslate(self, pair_id, enabled):
+        self.ensure_schema()
+        if self.backend == 'sqlite':
+            query = """
+            INSERT INTO pair_settings (pair_id, pretranslate) VALUES (%s, %s)
+            ON CONFLICT(pair_id) DO UPDATE SET pretranslate = excluded.pretranslate, updated_at = CURRENT_TIMESTAMP
+            """
+        else:
+            query = """
+            INSERT INTO pair_settings (pair_id, pretranslate) VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE pretranslate = VALUES(pretranslate), updated_at = CURRENT_TIMESTAMP
+            """
+        self.execute_query(query, (int(pair_id), 1 if enabled else 0))
+
+    def save_analysis(self, pair_id, message_id, role, analysis, content_hash):
+        """保存一条消息的预翻译结果和被翻译内容的哈希，重复写入时保留先写入的结果"""
+        self.ensure_schema()
+        self.execute_query(
+            f"{self._insert_ignore()} INTO message_analyses (pair_id, message_id, role, analysis, content_hash) "
+            "VALUES (%s, %s, %s, %s, %s)",
+            (int(pair_id), int(message_id), role, analysis, content_hash)
+        )
+
+    def get_analysis(self, pair_id, message_id, role, content_hash):
+        """内容哈希不一致（消息ID对应的不是这段内容）时视为没有预翻译结果"""
+        self.ensure_schema()
+        _, rows = self.execute_query(
+            "SELECT analysis FROM message_analyses "
+            "WHERE pair_id = %s AND message_id = %s AND role = %s AND content_hash = %s",
+            (int(pair_id), int(message_id), role, content_hash)
+        )
+        return rows[0][0] if rows else None
+
+    def close(self):
+        self.pool.close()
+
+
+DB_SECONDS = metrics.histogram("db_query_seconds", "数据库操作耗时（秒）", ["op"])
+
+
+class AsyncDatabaseManager:
+    """DatabaseManager 的异步封装：在与连接池等大的线程池中执行查询，不阻塞事件循环"""
+
+    def __init__(self, manager=None):
+        self.manager = manager or DatabaseManager()
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.manager.pool.max_size,
+            thread_name_prefix="db",
+        )
+
+    async def _run(self, func, *args, **kwargs):
+        return await self._run_as(func.__name__, func, *args, **kwargs)
+
+    async def _run_as(self, op, func, *args, **kwargs):
+        # 耗时包含等待线程和连接池的时间，即调用方实际感受到的延迟
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, op=op)
+
+    async def save_message(self, message_id, from_role, to_role, message_type, message_content, image_data, pair_id):
+        return await self._run(
+            self.manager.save_message,
+            message_id, from_role, to_role, message_type, message_content, image_data, pair_id
+        )
+
+    async def save_messages(self, messages):
+        return await self._run(self.manager.save_messages, messages)
+
+    async def get_messages(self, pair_id, limit=500, before_id=None, after_id=None):
+        return await self._run(self.manager.get_messages, pair_id, limit, before_id, after_id)
+
+    async def get_messages_after_seq(self, pair_id, after_seq, limit=500):
+        return await self._run(self.manager.get_messages_after_seq, pair_id, after_seq, limit)
+
+    async def get_max_seq(self, pair_id):
+        return await self._run(self.manager.get_max_seq, pair_id)
+
+    async def get_summary(self, pair_id):
+        return await self._run(self.manager.get_summary, pair_id)
+
+    async def save_summary(self, pair_id, summary, covered_seq):
+        return await self._run(self.manager.save_summary, pair_id, summary, covered_seq)
+
+    async def get_pretranslate(self, pair_id):
+        return await self._run(self.manager.get_pretranslate, pair_id)
+
+    async def set_pretranslate(self, pair_id, enabled):
+        return await self._run(self.manager.set_pretranslate, pair_id, enabled)
+
+    async def save_analysis(self, pair_id, message_id, role, analysis, content_hash):
+        return await self._run(self.manager.save_analysis, pair_id, message_id, role, analysis, content_hash)
+
+    async def get_analysis(self, pair_id, message_id, role, content_hash):
+        return await self._run(self.manager.get_analysis, pair_id, message_id, role, content_hash)
+
+    async def check(self):
+        return await self._run(self.manager.check)
+
+    async def archive_history(self):
+        return await self._run(self.manager.archive_history)
+
+    async def create_pair(self, pair_id=None):
+        return await self._run(self.manager.create_pair, pair_id)
+
+    async def delete_pair(self, pair_id):
+        return await self._run(self.manager.delete_pair, pair_id)
+
+    async def get_pair_member(self, client_id):
+        return await self._run(self.manager.get_pair_member, client_id)
+
+    async def get_pair_members(self, pair_id):
+        return await self._run(self.manager.get_pair_members, pair_id)
+
+    async def iter_messages(self, pair_id, limit=500, before_id=None, after_id=None, chunk_size=100):
+        # 查询在线程池中一次完成，之后按块产出不再占用连接：产出速度由HTTP客户端决定，慢客户端不能一直占着连接池
+        rows = await self._run_as("iter_messages", self.manager._read_history, pair_id, limit, before_id, after_id)
+        for i in range(0, len(rows), chunk_size):
+            yield rows[i:i + chunk_size]
+
     def close(self):
-        if self.connection:
-            self.connection.close()
\ No newline at end of file
+        self.executor.shutdown(wait=True)
+        self.manager.close()
@@ -0,0 +1,278 @@
+import json
+import logging
+import math
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set
+
+from analysis_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# 分析结果每行 "1. 解释含义：xxx"，只索引冒号后面的内容，避免模板文字把所有表情包连在一起
+ANALYSIS_VALUE_PATTERN = re.compile(r"[：:](.+)")
+# 去掉标点、空白和表情符号后再切分n-gram
+NON_WORD_PATTERN = re.compile(r"[\W_]+")
+
+KEYWORD_WEIGHT = 2.0
+ANALYSIS_WEIGHT = 1.0
+
+
+def char_ngrams(text: str) -> Dict[str, float]:
+    """字符一元和二元组的词频。中文网络用语没有可靠的分词，字符n-gram对错字、谐音和增减字更宽容"""
+    grams: Dict[str, float] = {}
+    for part in NON_WORD_PATTERN.split(normalize_text(text).lower()):
+        for i, char in enumerate(part):
+            grams[char] = grams.get(char, 0.0) + 1
+            if i + 1 < len(part):
+                gram = part[i:i + 2]
+                grams[gram] = grams.get(gram, 0.0) + 1
+    return grams
+
+
+def analysis_terms(analysis: str) -> str:
+    values = [match.group(1).strip() for match in map(ANALYSIS_VALUE_PATTERN.search, analysis.splitlines()) if match]
+    return " ".join(values) if values else analysis
+
+
+class _Entry:
+    __slots__ = ("keywords", "analysis", "vector")
+
+    def __init__(self):
+        self.keywords: Set[str] = set()
+        self.analysis = ""
+        self.vector: Dict[str, float] = {}
+
+
+class EmojiCatalog:
+    """本地表情包目录：由历史搜索结果、上传并分析过的图片和生成过的标签逐步积累
+
+    两套索引：关键词倒排（完全匹配，排在前面）和字符n-gram向量（L2归一化的稀疏向量，
+    按n-gram倒排求余弦相似度，查询侧乘IDF），用于模糊匹配中文网络用语。全部在内存中，
+    单次查询在毫秒级。数据以追加写的JSON Lines保存在磁盘上，启动时重放并压缩。
+    """
+
+    def __init__(self, path: str = None, max_entries: int = None, min_score: float = None,
+                 max_tag_queries: int = None):
+        self.path = path or os.getenv("EMOJI_CATALOG_PATH", os.path.join("data", "emoji_catalog.jsonl"))
+        self.max_entries = max_entries or int(os.getenv("EMOJI_CATALOG_MAX", "50000"))
+        # 向量匹配的最低相似度，低于它的结果不算命中
+        self.min_score = min_score if min_score is not None else float(os.getenv("EMOJI_CATALOG_MIN_SCORE", "0.2"))
+        self.max_tag_queries = max_tag_queries or int(os.getenv("EMOJI_CATALOG_TAG_QUERIES", "10000"))
+        # 出现在太多表情包里的n-gram（常用字）区分度很低，查询时不遍历它们的倒排，保证查询耗时
+        self.max_postings = int(os.getenv("EMOJI_CATALOG_MAX_POSTINGS", "2000"))
+        self.entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        # 关键词 -> 表情包URL（dict当作有序集合，保持上游返回的顺序）
+        self.keywords: Dict[str, Dict[str, None]] = {}
+        self.postings: Dict[str, Dict[str, float]] = {}
+        self.tags: "OrderedDict[str, List[str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    # ---- 写入 ----
+
+    def add_search(self, words: str, urls: Iterable[str]):
+        """上游搜索结果：查询词作为这些表情包的关键词"""
+        keyword = normalize_text(words).lower()
+        if not keyword:
+            return
+        for url in urls:
+            if isinstance(url, str) and self._add_keywords(url, [keyword]):
+                self._append({"u": url, "k": [keyword]})
+
+    def add_analysis(self, url: str, analysis: str):
+        """视觉模型对表情包或上传图片的分析结果，用于向量匹配"""
+        if not url or not analysis:
+            return
+        entry = self._entry(url)
+        terms = analysis_terms(analysis)
+        if terms in entry.analysis:
+            return
+        entry.analysis = f"{entry.analysis} {terms}".strip()
+        self._reindex(url, entry)
+        self._append({"u": url, "a": terms})
+
+    def remember_tags(self, text: str, tags: List[str]):
+        """记住为一段文本生成的标签，下次不再调用模型，搜索时也用它们扩展查询"""
+        key = normalize_text(text).lower()
+        if not key or not tags:
+            return
+        self._remember_tags(key, tags)
+        self._append({"q": key, "g": tags})
+
+    def tags_for(self, text: str) -> Optional[List[str]]:
+        key = normalize_text(text).lower()
+        tags = self.tags.get(key)
+        if tags is not None:
+            self.tags.move_to_end(key)
+        return tags
+
+    # ---- 查询 ----
+
+    def search(self, words: str, limit: int) -> List[str]:
+        """先取关键词完全匹配，再按向量相似度补足；生成过标签的查询同时匹配这些标签"""
+        query = normalize_text(words).lower()
+        if not query:
+            return []
+        results: List[str] = []
+        seen = set()
+
+        def take(urls):
+            for url in urls:
+                if url not in seen and len(results) < limit:
+                    seen.add(url)
+                    results.append(url)
+
+        take(self.keywords.get(query, ()))
+        if len(results) < limit:
+            take(self._similar(query, limit))
+        for tag in self.tags.get(query, ()):
+            if len(results) >= limit:
+                break
+            take(self.keywords.get(normalize_text(tag).lower(), ()))
+
+        if len(results) >= limit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return results
+
+    def _similar(self, query: str, limit: int) -> List[str]:
+        # 查询向量乘IDF后归一化，与归一化的文档向量求点积，结果在 [0, 1] 之间
+        # 目录里没有的n-gram按最大IDF计入查询向量，查询里陌生的部分越多得分越低
+        total = len(self.entries) or 1
+        weights = {
+            gram: count * math.log(1 + total / (len(self.postings.get(gram) or ()) or 1))
+            for gram, count in char_ngrams(query).items()
+        }
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+        scores: Dict[str, float] = {}
+        for gram, weight in weights.items():
+            postings = self.postings.get(gram) or {}
+            if len(postings) > self.max_postings:
+                continue
+            for url, doc_weight in postings.items():
+                scores[url] = scores.get(url, 0.0) + weight / norm * doc_weight
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return [url for url, score in ranked[:limit] if score >= self.min_score]
+
+    # ---- 索引维护 ----
+
+    def _entry(self, url: str) -> _Entry:
+        entry = self.entries.get(url)
+        if entry is None:
+            entry = self.entries[url] = _Entry()
+            while len(self.entries) > self.max_entries:
+                self._evict(next(iter(self.entries)))
+        self.entries.move_to_end(url)
+        return entry
+
+    def _add_keywords(self, url: str, keywords: List[str]) -> bool:
+        entry = self._entry(url)
+        new = [keyword for keyword in keywords if keyword not in entry.keywords]
+        if not new:
+            return False
+        for keyword in new:
+            entry.keywords.add(keyword)
+            self.keywords.setdefault(keyword, {})[url] = None
+        self._reindex(url, entry)
+        return True
+
+    def _reindex(self, url: str, entry: _Entry):
+        for gram in entry.vector:
+            self.postings[gram].pop(url, None)
+        vector: Dict[str, float] = {}
+        for keyword in entry.keywords:
+            for gram, count in char_ngrams(keyword).items():
+                vector[gram] = vector.get(gram, 0.0) + count * KEYWORD_WEIGHT
+        for gram, count in char_ngrams(entry.analysis).items():
+            vector[gram] = vector.get(gram, 0.0) + count * ANALYSIS_WEIGHT
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        entry.vector = {gram: weight / norm for gram, weight in vector.items()}
+        for gram, weight in entry.vector.items():
+            self.postings.setdefault(gram, {})[url] = weight
+
+    def _evict(self, url: str):
+        entry = self.entries.pop(url)
+        for keyword in entry.keywords:
+            urls = self.keywords.get(keyword)
+            if urls is not None:
+                urls.pop(url, None)
+                if not urls:
+                    del self.keywords[keyword]
+        for gram in entry.vector:
+            postings = self.postings.get(gram)
+            if postings is not None:
+                postings.pop(url, None)
+                if not postings:
+                    del self.postings[gram]
+
+    def _remember_tags(self, key: str, tags: List[str]):
+        self.tags[key] = tags
+        self.tags.move_to_end(key)
+        while len(self.tags) > self.max_tag_queries:
+            self.tags.popitem(last=False)
+
+    # ---- 持久化 ----
+
+    def _append(self, record: Dict):
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        except OSError as e:
+            logger.warning(f"写入表情包目录失败: {str(e)}")
+
+    def _load(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(self.path):
+            return
+
+        lines = 0
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "q" in record:
+                    self._remember_tags(record["q"], record.get("g") or [])
+                elif "k" in record:
+                    self._add_keywords(record["u"], record["k"])
+                elif "a" in record:
+                    entry = self._entry(record["u"])
+                    entry.analysis = f"{entry.analysis} {record['a']}".strip()
+                    self._reindex(record["u"], entry)
+
+        live = sum(1 + bool(entry.analysis) for entry in self.entries.values()) + len(self.tags)
+        if lines > 2 * live:
+            self._compact()
+        logger.info(f"表情包目录加载完成: {len(self.entries)} 个表情包, {len(self.keywords)} 个关键词")
+
+    def _compact(self):
+        # 重写日志，每个表情包和每组标签只保留一条记录
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for url, entry in self.entries.items():
+                if entry.keywords:
+                    f.write(json.dumps({"u": url, "k": sorted(entry.keywords)},
+                                       ensure_ascii=False, separators=(",", ":")) + "\n")
+                if entry.analysis:
+                    f.write(json.dumps({"u": url, "a": entry.analysis},
+                                       ensure_ascii=False, separators=(",", ":")) + "\n")
+            for key, tags in self.tags.items():
+                f.write(json.dumps({"q": key, "g": tags}, ensure_ascii=False, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def stats(self) -> Dict:
+        return {
+            "catalog_entries": len(self.entries),
+            "catalog_keywords": len(self.keywords),
+            "catalog_tag_queries": len(self.tags),
+            "catalog_hits": self.hits,
+            "catalog_misses": self.misses,
+        }
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+import metrics
+from analysis_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMOJI_API_URL = "https://cn.apihz.cn/api/img/apihzbqbbaidu.php"
+
+EMOJI_API_SECONDS = metrics.histogram("emoji_api_seconds", "表情包搜索API请求耗时（秒）", ["status"])
+
+
+class CircuitOpenError(Exception):
+    """上游连续失败，熔断期间不再发起请求"""
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断一段时间，之后放行一个试探请求，成功则恢复"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class EmojiSearchClient:
+    """表情包搜索API客户端：长连接池、显式超时、带抖动的重试、熔断，以及支持过期后后台刷新的结果缓存"""
+
+    def __init__(self, base_url: str = None, cache_ttl: float = None, stale_ttl: float = None,
+                 max_entries: int = None, retries: int = None, timeout: float = None):
+        self.base_url = base_url or os.getenv("EMOJI_API_URL", DEFAULT_EMOJI_API_URL)
+        self.cache_ttl = cache_ttl or float(os.getenv("EMOJI_SEARCH_CACHE_TTL", "3600"))
+        # 过期后仍可返回旧结果的时间窗口，同时在后台刷新
+        self.stale_ttl = stale_ttl or float(os.getenv("EMOJI_SEARCH_STALE_TTL", "86400"))
+        self.max_entries = max_entries or int(os.getenv("EMOJI_SEARCH_CACHE_SIZE", "5000"))
+        self.retries = retries if retries is not None else int(os.getenv("EMOJI_API_RETRIES", "2"))
+        timeout = timeout or float(os.getenv("EMOJI_API_TIMEOUT", "5"))
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 3.0)),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv("EMOJI_API_BREAKER_FAILURES", "5")),
+            reset_timeout=float(os.getenv("EMOJI_API_BREAKER_RESET", "30")),
+        )
+        self._cache: "OrderedDict[Tuple[str, int], Tuple[List, float]]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, int], asyncio.Task] = {}
+        self.upstream_calls = 0
+        self.cache_hits = 0
+        self.stale_hits = 0
+
+    async def search(self, words: str, limit: int) -> List:
+        key = (normalize_text(words), limit)
+        entry = self._cache.get(key)
+        if entry is not None:
+            emojis, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.cache_ttl:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return emojis
+            if age < self.cache_ttl + self.stale_ttl:
+                # 先返回旧结果，后台刷新
+                self.stale_hits += 1
+                self._refresh(key, words, limit)
+                return emojis
+
+        return await asyncio.shield(self._refresh(key, words, limit))
+
+    def _refresh(self, key: Tuple[str, int], words: str, limit: int) -> asyncio.Task:
+        # 相同关键词同时只向上游发一个请求
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch_and_store(key, words, limit))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_refresh_done(key, t))
+        return task
+
+    def _on_refresh_done(self, key, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"刷新表情包搜索结果失败: {task.exception()}")
+
+    async def _fetch_and_store(self, key, words: str, limit: int) -> List:
+        emojis = await self._fetch(words, limit)
+        self._cache[key] = (emojis, time.monotonic())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return emojis
+
+    async def _fetch(self, words: str, limit: int) -> List:
+        # 从环境变量获取ID和Key
+        emoji_id = os.getenv("EMOJI_API_ID")
+        emoji_key = os.getenv("EMOJI_API_KEY")
+        if not emoji_id or not emoji_key:
+            raise ValueError("表情包API配置缺失")
+
+        params = {"id": emoji_id, "key": emoji_key, "words": words, "limit": limit}
+        delay = 0.2
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError("表情包API暂时不可用")
+            try:
+                self.upstream_calls += 1
+                started = time.perf_counter()
+                try:
+                    response = await self.client.get(self.base_url, params=params)
+                except httpx.TransportError:
+                    EMOJI_API_SECONDS.observe(time.perf_counter() - started, status="error")
+                    raise
+                EMOJI_API_SECONDS.observe(time.perf_counter() - started, status=response.status_code)
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise httpx.HTTPStatusError(
+                        f"表情包API返回 {response.status_code}", request=response.request, response=response
+                    )
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                self.breaker.record_failure()
+                if attempt == self.retries:
+                    raise
+                # 指数退避加随机抖动，避免重试集中打到上游
+                await asyncio.sleep(random.uniform(0, delay))
+                delay *= 2
+                logger.warning(f"表情包API请求失败，第 {attempt + 1} 次重试: {str(e)}")
+                continue
+
+            self.breaker.record_success()
+            if response.status_code != 200:
+                raise ValueError("表情包API请求失败")
+            data = response.json()
+            if data["code"] != 200:
+                raise ValueError(data.get("msg", "表情包API返回错误"))
+            return data["res"][:limit]  # 返回指定数量的表情包
+
+    def check(self) -> Dict:
+        """健康检查：熔断中视为不可用（不额外请求上游）"""
+        state = self.breaker.state
+        if state == "open":
+            raise CircuitOpenError("表情包API熔断中")
+        return {"breaker_state": state}
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._cache),
+            "cache_hits": self.cache_hits,
+            "stale_hits": self.stale_hits,
+            "upstream_calls": self.upstream_calls,
+            "breaker_state": self.breaker.state,
+        }
+
+    async def close(self):
+        for task in list(self._inflight.values()):
+            task.cancel()
+        await self.client.aclose()
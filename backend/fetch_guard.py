@@ -0,0 +1,74 @@
+import asyncio
+import ipaddress
+import socket
+from typing import Callable, Optional
+
+import httpcore
+import httpx
+
+
+class ForbiddenAddressError(ValueError):
+    """图片地址的主机无法解析，或解析到了不允许访问的地址"""
+
+
+async def resolve_public_address(host: str, port: int) -> str:
+    """解析主机，解析出的地址必须都是公网地址（不能是回环、内网、链路本地如云主机元数据服务、组播等），
+    返回第一个地址"""
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ForbiddenAddressError(f"无法解析图片地址的主机 {host}: {str(e)}")
+    if not infos:
+        raise ForbiddenAddressError(f"无法解析图片地址的主机 {host}")
+    for info in infos:
+        # IPv6 链路本地地址可能带有 %网卡 后缀
+        address = ipaddress.ip_address(info[4][0].split("%", 1)[0])
+        if not address.is_global or address.is_multicast:
+            raise ForbiddenAddressError(f"不允许访问的图片地址: {host} ({address})")
+    return infos[0][4][0]
+
+
+class PublicAddressBackend(httpcore.AsyncNetworkBackend):
+    """建立连接时自己解析主机并校验，直接连接校验过的地址
+
+    校验和连接用的是同一次解析结果，DNS 重绑定（先解析到公网地址，连接时再解析到内网地址）无法绕过。
+    TLS 的 SNI、证书校验和 Host 头仍使用原来的主机名。allow_host 返回真的主机不做校验。
+    """
+
+    def __init__(self, allow_host: Optional[Callable[[str], bool]] = None,
+                 backend: Optional[httpcore.AsyncNetworkBackend] = None):
+        self.allow_host = allow_host or (lambda host: False)
+        self.backend = backend or httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                          local_address: Optional[str] = None, socket_options=None) -> httpcore.AsyncNetworkStream:
+        if not self.allow_host(host):
+            host = await resolve_public_address(host, port)
+        return await self.backend.connect_tcp(host, port, timeout=timeout, local_address=local_address,
+                                              socket_options=socket_options)
+
+    async def connect_unix_socket(self, path: str, timeout: Optional[float] = None,
+                                  socket_options=None) -> httpcore.AsyncNetworkStream:
+        raise ForbiddenAddressError("不允许通过本地套接字下载图片")
+
+    async def sleep(self, seconds: float) -> None:
+        await self.backend.sleep(seconds)
+
+
+class PublicAddressTransport(httpx.AsyncHTTPTransport):
+    """只连接公网地址的 httpx 传输层，用于下载客户端提供的图片地址"""
+
+    def __init__(self, allow_host: Optional[Callable[[str], bool]] = None,
+                 limits: httpx.Limits = httpx.Limits(max_connections=100, max_keepalive_connections=20,
+                                                     keepalive_expiry=5.0),
+                 backend: Optional[httpcore.AsyncNetworkBackend] = None):
+        # 不读取代理环境变量：经代理访问时主机由代理解析，这里的校验就不起作用了
+        super().__init__(trust_env=False, limits=limits)
+        # httpx 不接受 network_backend 参数，按同样的配置换成使用带校验网络层的连接池
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(trust_env=False),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=PublicAddressBackend(allow_host, backend),
+        )
@@ -0,0 +1,133 @@
+import json
+import logging
+from typing import Dict, Iterable, Optional, Union
+
+try:
+    import msgpack
+except ImportError:  # msgpack 为可选依赖，未安装时只提供JSON协议
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+JSON_SUBPROTOCOL = "chat.json.v1"
+MSGPACK_SUBPROTOCOL = "chat.msgpack.v1"
+
+# 帧类型编号，已发布的编号不能修改或复用，只能在末尾追加；0 表示未登记的类型，按完整字典编码
+FRAME_TYPES = [
+    None, "text", "emoji", "image", "ack", "ping", "pong", "resume", "resume_done",
+    "analyze", "analysis_cancel", "analysis_start", "analysis_delta", "analysis_done", "analysis_error",
+    "pretranslation", "error",
+]
+TYPE_CODES = {name: code for code, name in enumerate(FRAME_TYPES) if name}
+
+# 各类型的固定字段顺序，二进制帧编码为 [类型编号, 字段值..., 其余字段字典(可选)]
+CHAT_FIELDS = ("id", "from", "to", "pair_id", "message", "image_data", "seq", "created_at")
+FRAME_FIELDS = {
+    "text": CHAT_FIELDS,
+    "emoji": CHAT_FIELDS,
+    "image": CHAT_FIELDS,
+    "ack": ("id", "seq"),
+    "resume": ("pair_id", "last_seq"),
+    "resume_done": ("seq", "truncated"),
+    "analysis_start": ("message_id",),
+    "analysis_delta": ("message_id", "delta"),
+    "analysis_done": ("message_id", "analysis"),
+    "analysis_error": ("message_id", "error"),
+    "pretranslation": ("message_id", "analysis"),
+    "error": ("id", "error"),
+}
+
+
+class JsonCodec:
+    """文本帧，兼容不支持二进制协议的客户端"""
+
+    binary = False
+
+    def __init__(self, subprotocol: Optional[str] = None):
+        self.subprotocol = subprotocol
+
+    def encode(self, frame: Dict) -> str:
+        return json.dumps(frame, ensure_ascii=False, separators=(",", ":"))
+
+    def decode(self, data: Union[str, bytes]) -> Dict:
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    """msgpack二进制帧：常用帧类型按固定字段顺序编码为数组，省去重复的键名"""
+
+    subprotocol = MSGPACK_SUBPROTOCOL
+    binary = True
+
+    def encode(self, frame: Dict) -> bytes:
+        frame_type = frame.get("type")
+        code = TYPE_CODES.get(frame_type)
+        if code is None:
+            return msgpack.packb([0, frame], use_bin_type=True)
+        fields = FRAME_FIELDS.get(frame_type, ())
+        values = [code]
+        values.extend(frame.get(field) for field in fields)
+        extra = {key: value for key, value in frame.items() if key != "type" and key not in fields}
+        if extra:
+            values.append(extra)
+        return msgpack.packb(values, use_bin_type=True)
+
+    def decode(self, data: bytes) -> Dict:
+        values = msgpack.unpackb(data, raw=False)
+        if not isinstance(values, list) or not values:
+            raise ValueError("无效的二进制帧")
+        code = values[0]
+        if not isinstance(code, int) or isinstance(code, bool):
+            raise ValueError(f"无效的帧类型编号: {code!r}")
+        if code == 0:
+            if len(values) != 2 or not isinstance(values[1], dict):
+                raise ValueError("未登记类型的帧应为 [0, 字典]")
+            return values[1]
+        if not 0 < code < len(FRAME_TYPES):
+            raise ValueError(f"未知的帧类型编号: {code}")
+        frame_type = FRAME_TYPES[code]
+        fields = FRAME_FIELDS.get(frame_type, ())
+        # 固定字段之后最多再跟一个其余字段字典；缺少的末尾字段视为空
+        if len(values) > len(fields) + 2:
+            raise ValueError(f"{frame_type} 帧的字段过多: {len(values) - 1}")
+        extra = values[len(fields) + 1] if len(values) == len(fields) + 2 else {}
+        if not isinstance(extra, dict):
+            raise ValueError(f"{frame_type} 帧的其余字段应为字典")
+        frame = {"type": frame_type}
+        for field, value in zip(fields, values[1:]):
+            if value is not None:
+                frame[field] = value
+        frame.update(extra)
+        return frame
+
+
+JSON_CODEC = JsonCodec()
+NEGOTIATED_JSON_CODEC = JsonCodec(JSON_SUBPROTOCOL)
+MSGPACK_CODEC = MsgpackCodec() if msgpack is not None else None
+
+
+def negotiate_codec(offered: Iterable[str]):
+    """根据客户端在 Sec-WebSocket-Protocol 中提供的子协议选择编码，优先二进制"""
+    offered = list(offered or ())
+    if MSGPACK_SUBPROTOCOL in offered and MSGPACK_CODEC is not None:
+        return MSGPACK_CODEC
+    if JSON_SUBPROTOCOL in offered:
+        return NEGOTIATED_JSON_CODEC
+    return JSON_CODEC
+
+
+def decode_message(message: Dict, codec) -> Dict:
+    """解码ASGI websocket.receive 消息；无论协商结果如何，文本帧都按JSON解析
+
+    内容无法解析或不是带 type 的帧时抛出 ValueError（msgpack 的解析错误也是 ValueError 的子类）
+    """
+    if message.get("bytes") is not None:
+        if codec.binary:
+            frame = codec.decode(message["bytes"])
+        else:
+            frame = json.loads(message["bytes"])
+    else:
+        frame = json.loads(message["text"])
+    if not isinstance(frame, dict) or not isinstance(frame.get("type"), str):
+        raise ValueError("帧应为带 type 字段的对象")
+    return frame
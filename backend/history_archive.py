@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_MAGIC = b"CHSEG1"
+# 分段中按列保存的字段，与历史查询返回的字段一致
+SEGMENT_COLUMNS = ("id", "from", "to", "type", "message", "pair_id", "created_at", "image_data", "seq",
+                   "pretranslation")
+
+
+def _plain(value):
+    # 数据库返回的 datetime 与历史接口的JSON输出保持一致
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def encode_segment(pair_id: int, rows: List[Dict]) -> Tuple[bytes, Dict]:
+    """列式编码：每个字段一个数组，整体 zlib 压缩。前面是魔数和长度前缀的JSON头（条数、消息ID和序号范围），
+    索引丢失时也能从分段本身恢复。返回 (分段内容, 头信息)"""
+    seqs = [row["seq"] for row in rows if row.get("seq") is not None]
+    header = {
+        "pair_id": int(pair_id),
+        "count": len(rows),
+        "first_id": min(row["id"] for row in rows),
+        "last_id": max(row["id"] for row in rows),
+        "first_seq": min(seqs) if seqs else None,
+        "last_seq": max(seqs) if seqs else None,
+        "columns": list(SEGMENT_COLUMNS),
+    }
+    columns = {name: [_plain(row.get(name)) for row in rows] for name in SEGMENT_COLUMNS}
+    body = zlib.compress(json.dumps(columns, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 9)
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return SEGMENT_MAGIC + struct.pack(">I", len(header_bytes)) + header_bytes + body, header
+
+
+def decode_segment(data: bytes) -> Tuple[Dict, List[Dict]]:
+    if not data.startswith(SEGMENT_MAGIC):
+        raise ValueError("不是聊天记录分段文件")
+    offset = len(SEGMENT_MAGIC)
+    (header_size,) = struct.unpack_from(">I", data, offset)
+    offset += 4
+    header = json.loads(data[offset:offset + header_size])
+    columns = json.loads(zlib.decompress(data[offset + header_size:]))
+    names = header["columns"]
+    rows = [dict(zip(names, values)) for values in zip(*(columns[name] for name in names))]
+    return header, rows
+
+
+class HistoryArchive:
+    """聊天记录的冷数据层：较早的消息按配对压缩成不可变的分段文件，存到对象存储（或本地目录）
+
+    归档策略：每个配对至少保留最新的 hot_min 条消息在热表中，其余超过 hot_days 天的消息
+    每攒够 segment_min 条写成一个分段（每段最多 segment_max 条）。分段按内容哈希命名，
+    重复归档同一批消息得到同一个对象。分段不可变，解码后的内容在内存中做LRU缓存。
+    """
+
+    def __init__(self, bucket, prefix: str = None, hot_days: float = None, hot_min: int = None,
+                 segment_min: int = None, segment_max: int = None, cache_segments: int = None):
+        self.bucket = bucket
+        self.prefix = (prefix or os.getenv("HISTORY_ARCHIVE_PREFIX", "history")).strip("/")
+        self.hot_days = hot_days if hot_days is not None else float(os.getenv("HISTORY_HOT_DAYS", "30"))
+        self.hot_min = max(1, hot_min or int(os.getenv("HISTORY_HOT_MIN", "200")))
+        self.segment_min = segment_min or int(os.getenv("HISTORY_SEGMENT_MIN", "100"))
+        self.segment_max = segment_max or int(os.getenv("HISTORY_SEGMENT_MAX", "5000"))
+        self.cache_segments = cache_segments or int(os.getenv("HISTORY_SEGMENT_CACHE", "32"))
+        # 历史查询在数据库线程池中执行，缓存需要加锁
+        self._cache: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.segment_reads = 0
+        self.cache_hits = 0
+
+    def write(self, pair_id: int, rows: List[Dict]) -> Dict:
+        """上传一个分段，返回要写入索引的信息"""
+        data, header = encode_segment(pair_id, rows)
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        key = f"{self.prefix}/{int(pair_id)}/{header['first_id']}-{header['last_id']}-{digest}.seg"
+        # 聊天记录不能跟随图片所在存储桶的公共读权限
+        result = self.bucket.put_object(key, data, headers={"x-oss-object-acl": "private"})
+        if result.status != 200:
+            raise Exception(f"上传聊天记录分段失败，状态码: {result.status}")
+        return {**header, "key": key, "size": len(data)}
+
+    def load(self, key: str) -> List[Dict]:
+        with self._lock:
+            rows = self._cache.get(key)
+            if rows is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return rows
+        stream = self.bucket.get_object(key)
+        try:
+            _, rows = decode_segment(stream.read())
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        with self._lock:
+            self.segment_reads += 1
+            self._cache[key] = rows
+            while len(self._cache) > self.cache_segments:
+                self._cache.popitem(last=False)
+        return rows
+
+    def merge(self, rows: List[Dict], segments: List[Dict], limit: int, before_id: Optional[int] = None,
+              after_id: Optional[int] = None, after_seq: Optional[int] = None) -> List[Dict]:
+        """把热表的一页（升序）与冷数据段合并，返回合并后的一页（升序）
+
+        segments 由调用方按查询方向排好序：向前翻页按 last_id 从新到旧，增量查询按 first_id/first_seq 从旧到新。
+        已取到的消息足够一页、且下一个分段整体都在这一页之外时停止读取。读取分段失败时跳过该分段。
+        """
+        if after_seq is not None:
+            key, descending, edge_field = "seq", False, "first_seq"
+            keep: Callable[[Dict], bool] = lambda row: row.get("seq") is not None and row["seq"] > after_seq
+        elif after_id is not None:
+            key, descending, edge_field = "id", False, "first_id"
+            keep = lambda row: row["id"] > after_id
+        else:
+            key, descending, edge_field = "id", True, "last_id"
+            keep = lambda row: before_id is None or row["id"] < before_id
+
+        collected: List[Dict] = []
+        for segment in segments:
+            if len(collected) >= limit:
+                collected.sort(key=lambda row: row[key], reverse=descending)
+                del collected[limit:]
+                edge = collected[-1][key]
+                if (segment[edge_field] < edge) if descending else (segment[edge_field] > edge):
+                    break
+            try:
+                archived = self.load(segment["key"])
+            except Exception as e:
+                logger.warning(f"读取聊天记录分段 {segment['key']} 失败: {str(e)}")
+                continue
+            collected.extend(dict(row) for row in archived if keep(row))
+
+        # 归档和删除热表之间中断时两层可能都有同一条消息，以热表为准
+        merged = {(row["id"], row["from"]): row for row in collected}
+        merged.update({(row["id"], row["from"]): row for row in rows})
+        page = sorted(merged.values(), key=lambda row: row[key], reverse=descending)[:limit]
+        return page[::-1] if descending else page
+
+    def stats(self) -> Dict:
+        return {
+            "segment_reads": self.segment_reads,
+            "segment_cache_hits": self.cache_hits,
+            "segments_cached": len(self._cache),
+        }
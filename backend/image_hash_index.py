@@ -0,0 +1,170 @@
+import io
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+BAND_BITS = 8
+BAND_COUNT = HASH_BITS // BAND_BITS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def dhash(source, hash_size: int = 8) -> int:
+    """计算差值哈希（dHash），source 为图片字节或文件对象。动图只取第一帧，缩放和灰度化后比较相邻像素亮度"""
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with Image.open(source) as image:
+        image.seek(0)
+        return dhash_image(image, hash_size)
+
+
+def dhash_image(image: Image.Image, hash_size: int = 8) -> int:
+    """对已打开的图片（当前帧）计算差值哈希"""
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class PerceptualHashIndex:
+    """按感知哈希索引表情包分析结果，视觉上相同或几乎相同的图片复用同一份分析
+
+    哈希分成8段，每段8位建倒排。根据抽屉原理，汉明距离不超过7的两个哈希至少有一段完全相同，
+    所以阈值不超过7时只需比较候选集合；更大的阈值退化为全量扫描。
+    数据以追加写的JSON Lines保存在磁盘上，启动时重放并压缩。
+    """
+
+    def __init__(self, path: str = None, threshold: int = None, max_urls: int = None):
+        self.path = path or os.getenv("EMOJI_HASH_INDEX_PATH", os.path.join("data", "emoji_hash_index.jsonl"))
+        self.threshold = threshold if threshold is not None else int(os.getenv("EMOJI_HASH_THRESHOLD", "4"))
+        self.max_urls = max_urls or int(os.getenv("EMOJI_HASH_MAX_URLS", "100000"))
+        self.analyses: Dict[int, Dict[str, str]] = {}
+        self.bands = [dict() for _ in range(BAND_COUNT)]
+        self.url_hashes: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _bands_of(self, value: int):
+        for i in range(BAND_COUNT):
+            yield i, (value >> (i * BAND_BITS)) & BAND_MASK
+
+    def _add_hash(self, value: int):
+        if value in self.analyses:
+            return
+        self.analyses[value] = {}
+        for i, band in self._bands_of(value):
+            self.bands[i].setdefault(band, set()).add(value)
+
+    def find(self, value: int) -> Optional[int]:
+        """返回距离最近且在阈值内的已知哈希"""
+        if value in self.analyses:
+            return value
+        if self.threshold < BAND_COUNT:
+            candidates = set()
+            for i, band in self._bands_of(value):
+                candidates.update(self.bands[i].get(band, ()))
+        else:
+            candidates = self.analyses.keys()
+        best, best_distance = None, self.threshold + 1
+        for candidate in candidates:
+            distance = hamming(value, candidate)
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+        return best
+
+    def get_analysis(self, value: int, role: str) -> Optional[str]:
+        match = self.find(value)
+        if match is None:
+            return None
+        return self.analyses[match].get(role)
+
+    def put_analysis(self, value: int, role: str, analysis: str):
+        with self._lock:
+            # 与已有图片足够相似时挂在已有哈希下，避免索引膨胀
+            match = self.find(value)
+            if match is None:
+                match = value
+                self._add_hash(match)
+            self.analyses[match][role] = analysis
+            self._append({"h": format(match, "016x"), "r": role, "a": analysis})
+
+    def hash_for_url(self, url: str) -> Optional[int]:
+        value = self.url_hashes.get(url)
+        if value is not None:
+            self.url_hashes.move_to_end(url)
+        return value
+
+    def remember_url(self, url: str, value: int):
+        with self._lock:
+            if self.url_hashes.get(url) == value:
+                return
+            self._remember_url(url, value)
+            self._append({"u": url, "h": format(value, "016x")})
+
+    def _remember_url(self, url: str, value: int):
+        self.url_hashes[url] = value
+        self.url_hashes.move_to_end(url)
+        while len(self.url_hashes) > self.max_urls:
+            self.url_hashes.popitem(last=False)
+
+    def _append(self, record: Dict):
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        except OSError as e:
+            logger.warning(f"写入表情包哈希索引失败: {str(e)}")
+
+    def _load(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(self.path):
+            return
+
+        lines = 0
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                    value = int(record["h"], 16)
+                except (ValueError, KeyError):
+                    continue
+                if "u" in record:
+                    self._remember_url(record["u"], value)
+                else:
+                    self._add_hash(value)
+                    self.analyses[value][record["r"]] = record["a"]
+
+        live = sum(len(roles) for roles in self.analyses.values()) + len(self.url_hashes)
+        if lines > 2 * live:
+            self._compact()
+        logger.info(f"表情包哈希索引加载完成: {len(self.analyses)} 张图片, {len(self.url_hashes)} 个URL")
+
+    def _compact(self):
+        # 重写日志，只保留每个键的最新记录
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for value, roles in self.analyses.items():
+                for role, analysis in roles.items():
+                    f.write(json.dumps({"h": format(value, "016x"), "r": role, "a": analysis},
+                                       ensure_ascii=False, separators=(",", ":")) + "\n")
+            for url, value in self.url_hashes.items():
+                f.write(json.dumps({"u": url, "h": format(value, "016x")},
+                                   ensure_ascii=False, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, self.path)
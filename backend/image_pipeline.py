@@ -0,0 +1,104 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Union
+
+from PIL import Image
+
+from image_hash_index import dhash_image
+
+logger = logging.getLogger(__name__)
+
+# 允许上传和分析的真实图片格式（以文件内容为准，不信任扩展名和 Content-Type）
+ALLOWED_FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif", "WEBP": "webp", "BMP": "bmp"}
+
+# 解码前拒绝像素数过大的图片，防止解压炸弹
+MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(50_000_000)))
+
+
+def _representative_frame(image: Image.Image) -> Image.Image:
+    # 动图取中间一帧，很多表情包的第一帧是空白或过渡帧
+    if getattr(image, "is_animated", False):
+        image.seek(image.n_frames // 2)
+    return image.convert("RGBA")
+
+
+def _flatten(image: Image.Image) -> Image.Image:
+    # 透明背景铺白底，转成JPEG给视觉模型
+    background = Image.new("RGB", image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel("A"))
+    return background
+
+
+def _scaled(image: Image.Image, max_dimension: int) -> Image.Image:
+    copy = image.copy()
+    copy.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    return copy
+
+
+def normalize_image(source: Union[bytes, str], vl_max_dimension: int, thumbnail_max_dimension: int) -> Dict:
+    """校验图片真实格式，生成视觉模型用的缩小版和聊天展示用的缩略图，并计算感知哈希
+
+    source 为图片内容或文件路径。在子进程中执行，只接收和返回可序列化的数据；
+    传路径时图片由子进程自己从文件读取，不经过进程间管道。
+    """
+    try:
+        with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+            if image.format not in ALLOWED_FORMATS:
+                raise ValueError(f"不支持的图片格式: {image.format}")
+            if image.width * image.height > MAX_PIXELS:
+                raise ValueError("图片分辨率过大")
+            image_format = image.format
+            width, height = image.size
+            animated = getattr(image, "is_animated", False)
+
+            image.seek(0)
+            image_hash = dhash_image(image)
+            frame = _representative_frame(image)
+    except ValueError:
+        raise
+    except Exception:
+        raise ValueError("无法识别的图片文件")
+
+    vl_output = io.BytesIO()
+    _flatten(_scaled(frame, vl_max_dimension)).save(vl_output, "JPEG", quality=85)
+
+    thumbnail_output = io.BytesIO()
+    _scaled(frame, thumbnail_max_dimension).save(thumbnail_output, "WEBP", quality=75)
+
+    return {
+        "format": image_format,
+        "extension": ALLOWED_FORMATS[image_format],
+        "width": width,
+        "height": height,
+        "animated": animated,
+        "dhash": image_hash,
+        "vl_image": vl_output.getvalue(),
+        "thumbnail": thumbnail_output.getvalue(),
+    }
+
+
+class ImagePipeline:
+    """在进程池中执行图片解码和缩放，CPU密集的处理不占用事件循环和GIL"""
+
+    def __init__(self, max_workers: int = None, vl_max_dimension: int = None, thumbnail_max_dimension: int = None):
+        self.max_workers = max_workers or int(os.getenv("IMAGE_PIPELINE_WORKERS", str(os.cpu_count() or 2)))
+        self.vl_max_dimension = vl_max_dimension or int(os.getenv("VL_IMAGE_MAX_DIMENSION", "768"))
+        self.thumbnail_max_dimension = thumbnail_max_dimension or int(os.getenv("THUMBNAIL_MAX_DIMENSION", "240"))
+        # 子进程用 spawn 启动：服务进程里已经有连接池、模型调用等线程，fork 会把它们持有的锁
+        # 原样复制到子进程中，可能永远等不到释放
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                            mp_context=multiprocessing.get_context("spawn"))
+
+    async def process(self, source: Union[bytes, str]) -> Dict:
+        """source 为图片内容或文件路径，文件在处理完成前不能删除"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, normalize_image, source, self.vl_max_dimension, self.thumbnail_max_dimension
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
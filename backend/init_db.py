@@ -8,22 +8,10 @@ def main():
     try:
         logger.info("开始初始化数据库...")
         db = DatabaseManager()
+        # 创建用户表和所有聊天对共用的 chat_messages 表
+        db.init_db()
+        db.close()
         logger.info("数据库初始化完成")
-        # 为每对用户创建聊天记录表
-        self.execute_query(f"""
-        CREATE TABLE IF NOT EXISTS chat_records_pair_{pair_id} (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            message_id BIGINT NOT NULL,
-            from_role VARCHAR(10) NOT NULL,
-            to_role VARCHAR(10) NOT NULL,
-            message_type VARCHAR(10) NOT NULL,
-            message_content TEXT,  # 非必填
-            image_data VARCHAR(255),  # 非必填
-            pair_id INT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            INDEX idx_message_id (message_id),
-            INDEX idx_pair_id (pair_id)
-        )""")
     except Exception as e:
         logger.error(f"初始化失败: {e}")
 
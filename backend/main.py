@@ -1,33 +1,207 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from PIL import Image
 import io
+import json
+import hashlib
 import base64
 import logging
-import imghdr
 import os
-import oss2
-from fastapi import UploadFile, File
-import uuid
+import tempfile
+import time
 import asyncio
-import os
-from typing import Dict, List
+import importlib
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
-from dashscope import MultiModalConversation, Generation
+
+# 加载环境变量（各模块导入时就读取配置，需要最先加载）
+load_dotenv()
+
 import httpx  
-from db_manager import DatabaseManager
+from db_manager import AsyncDatabaseManager
+from model_runner import ModelBusyError, ModelCallRunner
+from message_writer import MessageWriter
+from analysis_cache import AnalysisCache, create_cache_backend, message_analysis_key, text_analysis_key
+from image_hash_index import PerceptualHashIndex
+from object_storage import create_archive_bucket, create_image_storage, local_storage_root
+from history_archive import HistoryArchive
+from pair_registry import PairRegistry
+from image_pipeline import ImagePipeline
+from emoji_search import CircuitOpenError, EmojiSearchClient
+from fetch_guard import PublicAddressTransport
+from emoji_catalog import EmojiCatalog
+from message_broker import client_channel, create_message_broker
+from connection_manager import ClientConnection, ConnectionManager
+from frame_codec import TYPE_CODES, negotiate_codec
+from batch_analysis import build_batch_prompt, dedupe_messages, pack_batches, parse_batch_output
+from conversation_context import ConversationContext
+from pretranslation import Pretranslator
+from message_sequencer import MessageSequencer
+from services import ServiceContainer, ServiceUnavailableError
+import metrics
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 加载环境变量
-load_dotenv()
+# 应用依赖由容器管理：导入时只登记工厂，不连接任何后端；lifespan 启动时并行预热，
+# 没预热完的在首次使用时创建，关闭时按登记的逆序释放。/health 报告各依赖是否可用
+services = ServiceContainer()
+
+
+# 冷数据归档的间隔（秒），0 表示不在服务内定时归档（可以用 archive_history.py 单独运行）
+HISTORY_ARCHIVE_INTERVAL = float(os.getenv("HISTORY_ARCHIVE_INTERVAL", "0"))
+
+
+async def archive_history_loop():
+    """定时把较早的聊天记录归档到对象存储。分段按内容命名、热表按主键删除，多个worker同时运行也不会重复或丢失"""
+    while True:
+        await asyncio.sleep(HISTORY_ARCHIVE_INTERVAL)
+        try:
+            pairs, messages = await db.archive_history()
+            if messages:
+                logger.info(f"[归档] {pairs} 个配对共归档 {messages} 条消息")
+        except Exception as e:
+            logger.error(f"[归档] 归档聊天记录失败: {str(e)}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await services.start()
+    archive_task = asyncio.create_task(archive_history_loop()) if HISTORY_ARCHIVE_INTERVAL > 0 else None
+    yield
+    if archive_task is not None:
+        archive_task.cancel()
+    await services.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def create_database():
+    manager = AsyncDatabaseManager()
+    # 较早的聊天记录在对象存储中，历史查询时按需读取
+    manager.manager.archive = history_archive
+    return manager
+
+
+# 数据库连接池
+db = services.register("database", create_database, close=lambda d: d.close(), check=lambda d: d.check(),
+                       required=True)
+# 聊天记录冷数据层，只在读取或写入归档分段时创建
+history_archive = services.register("history_archive", lambda: HistoryArchive(create_archive_bucket()), warm=False)
+# DashScope SDK 导入较慢，放到预热阶段
+dashscope = services.register("dashscope", lambda: importlib.import_module("dashscope"))
+# 大模型调用统一调度：按模型限并发和限速，按优先级排队，合并相同请求
+model_runner = services.register("model_runner", ModelCallRunner, close=lambda r: r.shutdown())
+# 聊天消息异步批量落库
+message_writer = services.register("message_writer", lambda: MessageWriter(db), start=lambda w: w.start(),
+                                   close=lambda w: w.stop())
+# 文本分析结果缓存，ANALYSIS_CACHE_BACKEND 可配置 memory / redis 共享层
+analysis_cache = services.register(
+    "analysis_cache", lambda: AnalysisCache(backend=create_cache_backend(os.getenv("ANALYSIS_CACHE_BACKEND"))),
+    close=lambda c: c.close(), check=lambda c: c.check(),
+)
+# 按感知哈希复用表情包分析结果
+emoji_hash_index = services.register("emoji_hash_index", PerceptualHashIndex)
+# 图片校验、缩放和缩略图生成（进程池）
+image_pipeline = services.register("image_pipeline", ImagePipeline, close=lambda p: p.shutdown())
+# 表情包搜索API长连接客户端（带缓存和熔断）
+emoji_search_client = services.register("emoji_api", EmojiSearchClient, close=lambda c: c.close(),
+                                        check=lambda c: c.check())
+# 本地表情包目录（关键词倒排 + n-gram向量），未命中时才调用搜索API
+emoji_catalog = services.register("emoji_catalog", EmojiCatalog)
+# 用户上传的照片默认不进入所有配对共用的表情包目录
+EMOJI_CATALOG_INDEX_UPLOADS = os.getenv("EMOJI_CATALOG_INDEX_UPLOADS", "0") == "1"
+# 跨worker的消息路由和在线状态，MESSAGE_BROKER=socket 时支持 uvicorn --workers N
+broker = services.register("broker", lambda: create_message_broker(os.getenv("MESSAGE_BROKER")),
+                           start=lambda b: b.start(), close=lambda b: b.close(), check=lambda b: b.check(),
+                           required=True)
+# 配对内消息序号和最近消息缓冲，客户端重连时按序号补发
+sequencer = MessageSequencer(broker, db)
+# 客户端ID → 配对和对方的注册表，连接和每条聊天帧都按它校验
+pair_registry = services.register("pair_registry", lambda: PairRegistry(db, broker), start=lambda r: r.start())
+# 指标：热路径上只做计数和直方图累加，连接数、队列深度等在 /metrics 被抓取时才读取
+WS_FRAMES = metrics.counter("ws_frames_total", "收到的WebSocket帧数", ["type"])
+WS_FORWARD_SECONDS = metrics.histogram("ws_forward_seconds", "聊天帧从收到到转发完成的耗时（秒）", ["type"])
+metrics.gauge("ws_connections", "本worker上的WebSocket连接数", lambda: len(active_connections))
+metrics.gauge("ws_send_queue_depth", "所有连接发送队列中的帧数",
+              lambda: sum(len(c.queue) for c in active_connections.connections.values()))
+metrics.gauge("ws_send_queue_depth_max", "单个连接发送队列的最大深度",
+              lambda: max((len(c.queue) for c in active_connections.connections.values()), default=0))
+metrics.gauge("message_writer_queue_depth", "等待落库的消息数", lambda: message_writer.depth)
+metrics.gauge("model_queue_depth", "排队中的大模型调用数",
+              lambda: {(model,): lane["queued"] for model, lane in model_runner.stats()["models"].items()}, ["model"])
+metrics.gauge("model_active_calls", "进行中的大模型调用数",
+              lambda: {(model,): lane["active"] for model, lane in model_runner.stats()["models"].items()}, ["model"])
+
+# 下载表情包计算哈希用的长连接客户端，只连接公网地址（连接时解析并校验）。不自动跟随重定向：每一跳都要校验协议
+image_http_client = services.register("image_http_client",
+                                      lambda: httpx.AsyncClient(timeout=10.0, follow_redirects=False, trust_env=False,
+                                                                transport=PublicAddressTransport(fetch_allowed_host)),
+                                      close=lambda c: c.aclose())
+# 下载表情包的大小上限
+EMOJI_FETCH_MAX_BYTES = int(os.getenv("EMOJI_FETCH_MAX_BYTES", str(10 * 1024 * 1024)))
+EMOJI_FETCH_MAX_REDIRECTS = 5
+# 允许下载内网地址的图片，仅用于本地压测（表情包替身服务在 127.0.0.1 上）
+EMOJI_FETCH_ALLOW_PRIVATE = os.getenv("EMOJI_FETCH_ALLOW_PRIVATE", "0") == "1"
+
+# 上传图片的大小上限
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+# multipart 表单中分隔符和各部分头部占用的字节
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class RequestSizeLimit:
+    """在表单被解析之前限制请求体大小。Starlette 解析 multipart 时会把整个文件先写进临时文件，
+    等到接口里再检查大小时超大的请求体已经全部收完了。
+
+    声明了 Content-Length 的请求超限时直接返回413，不读取请求体；没有声明的（分块传输）
+    在累计收到的字节数超限时中止解析并返回413。
+    """
 
-# 在FastAPI应用初始化后添加
-app = FastAPI()
-db = DatabaseManager()  # 初始化数据库管理器
+    def __init__(self, app, path: str, max_bytes: int):
+        self.app = app
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _too_large(self):
+        return HTTPException(status_code=413, detail=f"图片大小超过限制（{self.max_bytes} 字节）")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        declared = dict(scope["headers"]).get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > self.max_bytes:
+            error = self._too_large()
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # 在解析表单时抛出，由 FastAPI 的异常处理返回413
+                    raise self._too_large()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+# 加在跨域中间件之前（即位于其内层），413 响应也带跨域头
+app.add_middleware(RequestSizeLimit, path="/api/upload_image", max_bytes=UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD)
 
 # 跨域配置
 app.add_middleware(
@@ -37,28 +211,52 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 存储活跃的WebSocket连接
-active_connections: Dict[str, WebSocket] = {}
+# 依赖还在初始化时（实例在后台创建，不阻塞事件循环）返回503，客户端稍后重试
+@app.exception_handler(ServiceUnavailableError)
+async def service_unavailable_handler(request, exc: ServiceUnavailableError):
+    return JSONResponse({"detail": str(exc)}, status_code=503, headers={"Retry-After": "1"})
+
+# 存储本worker上活跃的WebSocket连接（各自带有界发送队列），其他worker上的用户经由 broker 投递
+active_connections = ConnectionManager()
+
+
+async def deliver_local(client_id: str, data: Dict):
+    active_connections.send(client_id, data)
+
+
+async def route_message(recipient: str, data: Dict):
+    """接收方连在本worker上时放入其发送队列，否则发布到接收方的频道，由持有连接的worker投递"""
+    if recipient in active_connections:
+        active_connections.send(recipient, data)
+    else:
+        await broker.publish(client_channel(recipient), data)
 
 # 文本分析请求模型
 class TextAnalysisRequest(BaseModel):
     text: str
     role: str = "elder"  # 新增角色字段，默认为老人
     context: List[str] = []  # 新增上下文字段
+    # 提供 pair_id 时由服务端根据历史组装上下文（摘要 + 最近几轮），忽略 context
+    pair_id: Optional[int] = None
+    message_id: Optional[int] = None
 
 class TextAnalyzer:
+    # 修改提示词时递增，使旧的缓存结果失效
+    prompt_version = "1"
+
     def __init__(self):
         self.api_key = os.getenv("DASHSCOPE_API_KEY")
         self.model = "qwen-max"
     
-    async def analyze_text(self, text: str, role: str = "elder", context: List[str] = None) -> str:
-        try:
-            context_str = "\n".join([f"上下文消息 {i+1}: {msg}" for i, msg in enumerate(context or [])])
-            
-            if role == "elder":
-                prompt = f"""请结合以下聊天上下文，用简单易懂的方式解释年轻人说的话：
+    def build_prompt(self, text: str, role: str = "elder", context: List[str] = None, summary: str = "") -> str:
+        context_str = "\n".join([f"上下文消息 {i+1}: {msg}" for i, msg in enumerate(context or [])])
+        # 摘要放在最近几轮原文之前，同一配对的提示词前缀保持稳定
+        summary_str = f"对话摘要:\n                {summary}\n                \n                " if summary else ""
+        
+        if role == "elder":
+            prompt = f"""请结合以下聊天上下文，用简单易懂的方式解释年轻人说的话：
                 
-                聊天上下文:
+                {summary_str}聊天上下文:
                 {context_str}
                 
                 需要解释的话:
@@ -68,10 +266,10 @@ class TextAnalyzer:
                 1. 解释含义(10字内)
                 2. 智能转换👴(15字内)
                 3. 原因(10字内)"""
-            else:
-                prompt = f"""请结合以下聊天上下文，用年轻人易懂的方式解释老人说的话：
+        else:
+            prompt = f"""请结合以下聊天上下文，用年轻人易懂的方式解释老人说的话：
                 
-                聊天上下文:
+                {summary_str}聊天上下文:
                 {context_str}
                 
                 需要解释的话:
@@ -81,11 +279,21 @@ class TextAnalyzer:
                 1. 解释含义(10字内)
                 2. 智能转换👱(15字内)
                 3. 原因(10字内)"""
-            
-            response = Generation.call(
+        return prompt
+
+    async def analyze_text(self, text: str, role: str = "elder", context: List[str] = None, summary: str = "",
+                           priority: str = "interactive") -> str:
+        try:
+            prompt = self.build_prompt(text, role, context, summary)
+
+            response = await model_runner.run(
+                self.model,
+                dashscope.Generation.call,
                 model=self.model,
                 prompt=prompt,
-                api_key=self.api_key
+                api_key=self.api_key,
+                priority=priority,
+                analyzer="text"
             )
             
             if response.status_code == 200:
@@ -98,12 +306,147 @@ class TextAnalyzer:
             logger.error(f"调用文本分析模型出错: {str(e)}")
             raise
 
+    async def stream_text(self, text: str, role: str = "elder", context: List[str] = None,
+                          summary: str = "") -> AsyncIterator[str]:
+        """流式分析，逐段产出模型新生成的文本"""
+        prompt = self.build_prompt(text, role, context, summary)
+        async for response in model_runner.stream(
+            self.model,
+            dashscope.Generation.call,
+            model=self.model,
+            prompt=prompt,
+            api_key=self.api_key,
+            stream=True,
+            incremental_output=True,
+            analyzer="text"
+        ):
+            if response.status_code != 200:
+                logger.error(f"文本分析API错误: {response.message}")
+                raise ValueError(f"文本分析失败: {response.message}")
+            if response.output.text:
+                yield response.output.text
+
+class ConversationSummarizer:
+    """把新的聊天记录并入已有的对话摘要，使用较便宜的模型"""
+
+    def __init__(self):
+        self.api_key = os.getenv("DASHSCOPE_API_KEY")
+        self.model = os.getenv("SUMMARY_MODEL", "qwen-turbo")
+
+    async def summarize(self, previous: str, turns: List[str]) -> str:
+        turns_str = "\n".join(turns)
+        prompt = f"""以下是长辈和年轻人之间的聊天。请在已有摘要的基础上并入新的聊天记录，更新对话摘要。
+摘要需保留话题、人物、约定，以及双方常用的说法和网络用语的含义，不超过200字，只输出摘要本身。
+
+已有摘要:
+{previous or "无"}
+
+新的聊天记录:
+{turns_str}"""
+        response = await model_runner.run(
+            self.model,
+            dashscope.Generation.call,
+            model=self.model,
+            prompt=prompt,
+            api_key=self.api_key,
+            priority="background",
+            analyzer="summary"
+        )
+        if response.status_code != 200:
+            raise ValueError(f"生成对话摘要失败: {response.message}")
+        return response.output.text.strip()
+
+# 服务端组装分析上下文：每个配对的滚动摘要 + 最近几轮原文
+conversation_context = services.register("conversation_context",
+                                         lambda: ConversationContext(db, ConversationSummarizer().summarize),
+                                         close=lambda c: c.close())
+
+async def resolve_context(pair_id: Optional[int], message_id: Optional[int],
+                          client_context: List[str]) -> Tuple[str, List[str]]:
+    """返回 (摘要, 上下文)。有 pair_id 时由服务端组装，否则沿用客户端传来的上下文（兼容旧客户端）"""
+    if pair_id is None:
+        return "", client_context or []
+    return await conversation_context.build(int(pair_id), int(message_id) if message_id is not None else None)
+
+def analysis_cache_key(analyzer, text: str, role: str, pair_id, message_id, context: List[str]) -> str:
+    """服务端组装上下文时按配对和消息ID缓存（见 message_analysis_key）；
+    旧客户端自带上下文时，上下文不同结果就可能不同，按文本和上下文缓存"""
+    if pair_id is not None and message_id is not None:
+        return message_analysis_key(pair_id, message_id, text, role, analyzer.model, analyzer.prompt_version)
+    return text_analysis_key(text, role, context, analyzer.model, analyzer.prompt_version)
+
+# 批量文本分析请求模型
+class BatchAnalysisMessage(BaseModel):
+    id: Union[int, str]
+    text: str
+
+class BatchAnalysisRequest(BaseModel):
+    pair_id: int
+    role: str = "elder"
+    messages: List[BatchAnalysisMessage]
+    context: List[str] = []
+
+class BatchTextAnalyzer:
+    """把多条消息打包进尽量少的模型调用，要求模型按编号输出JSON数组，再拆回每条消息"""
+    # 修改批量提示词时递增，使旧的缓存结果失效
+    prompt_version = "batch-1"
+
+    def __init__(self):
+        self.api_key = os.getenv("DASHSCOPE_API_KEY")
+        self.model = "qwen-max"
+        # 每次调用的输入字数和条数上限，条数同时限制了输出长度
+        self.max_chars = int(os.getenv("BATCH_ANALYSIS_MAX_CHARS", "4000"))
+        self.max_items = int(os.getenv("BATCH_ANALYSIS_MAX_ITEMS", "30"))
+
+    async def _analyze_chunk(self, texts: List[str], role: str, context: List[str], summary: str) -> Dict[str, str]:
+        prompt = build_batch_prompt(texts, role, context, summary)
+        # 整段翻译一次发出多个批次，排在单条交互式翻译之后
+        response = await model_runner.run(
+            self.model,
+            dashscope.Generation.call,
+            model=self.model,
+            prompt=prompt,
+            api_key=self.api_key,
+            priority="prefetch",
+            analyzer="batch"
+        )
+        if response.status_code != 200:
+            logger.error(f"批量分析API错误: {response.message}")
+            raise ValueError(f"批量分析失败: {response.message}")
+        return parse_batch_output(response.output.text, texts, role)
+
+    async def analyze_batch(self, texts: List[str], role: str = "elder", context: List[str] = None,
+                            summary: str = "") -> Tuple[Dict[str, str], int]:
+        """返回 (文本 -> 分析结果, 模型调用次数)；多个批次并发调用，受 model_runner 的并发限制"""
+        batches = pack_batches(texts, self.max_chars, self.max_items)
+        outputs = await asyncio.gather(
+            *(self._analyze_chunk(batch, role, context, summary) for batch in batches), return_exceptions=True
+        )
+        calls = len(batches)
+        results: Dict[str, str] = {}
+        missing: List[str] = []
+        for batch, output in zip(batches, outputs):
+            if isinstance(output, Exception):
+                logger.error(f"批量分析出错: {str(output)}")
+                continue
+            results.update(output)
+            missing.extend(text for text in batch if text not in output)
+
+        # 模型漏掉或格式不对的条目重新打包再试一次
+        for batch in pack_batches(missing, self.max_chars, self.max_items):
+            calls += 1
+            try:
+                results.update(await self._analyze_chunk(batch, role, context, summary))
+            except Exception as e:
+                logger.error(f"批量分析重试出错: {str(e)}")
+        return results, calls
+
 class ImageAnalyzer:
     def __init__(self):
         self.api_key = os.getenv("DASHSCOPE_API_KEY")
         self.model = "qwen-vl-plus"
     
-    async def analyze_image(self, image_base64: str, role: str = "elder", context: List[str] = None) -> str:
+    def build_messages(self, image_base64: str, role: str = "elder", context: List[str] = None) -> List[Dict]:
         context_str = "\n".join([f"上下文消息 {i+1}: {msg}" for i, msg in enumerate(context or [])])
         
         if role == "elder":
@@ -142,12 +485,20 @@ class ImageAnalyzer:
                 ]
             }
         ]
-        
+        return messages
+
+    async def analyze_image(self, image_base64: str, role: str = "elder", context: List[str] = None,
+                            priority: str = "interactive") -> str:
+        messages = self.build_messages(image_base64, role, context)
         try:
-            response = MultiModalConversation.call(
+            response = await model_runner.run(
+                self.model,
+                dashscope.MultiModalConversation.call,
                 model=self.model,
                 messages=messages,
                 api_key=self.api_key,
+                priority=priority,
+                analyzer="image",
             )
             
             if response.status_code == 200:
@@ -160,52 +511,388 @@ class ImageAnalyzer:
             logger.error(f"调用大模型出错: {str(e)}")
             raise
 
-# WebSocket连接
-db_manager = DatabaseManager()
+    async def stream_image(self, image_base64: str, role: str = "elder", context: List[str] = None) -> AsyncIterator[str]:
+        """流式分析，逐段产出模型新生成的文本"""
+        messages = self.build_messages(image_base64, role, context)
+        async for response in model_runner.stream(
+            self.model,
+            dashscope.MultiModalConversation.call,
+            model=self.model,
+            messages=messages,
+            api_key=self.api_key,
+            stream=True,
+            incremental_output=True,
+            analyzer="image",
+        ):
+            if response.status_code != 200:
+                logger.error(f"通义千问API错误: {response.message}")
+                raise ValueError(f"大模型分析失败: {response.message}")
+            content = response.output.choices[0].message.content
+            if content and content[0].get("text"):
+                yield content[0]["text"]
+
+def check_fetch_url(url: str):
+    """图片地址由客户端提供，只允许 http/https。主机地址的校验在建立连接时进行（见 fetch_guard）"""
+    parsed = urlsplit(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError(f"不允许的图片地址: {url}")
+
+def fetch_allowed_host(host: str) -> bool:
+    """本应用自己的存储地址，以及本地压测时的内网替身服务，不受公网地址的限制"""
+    return EMOJI_FETCH_ALLOW_PRIVATE or host == urlsplit(image_storage.public_url("")).hostname
+
+async def download_image(image_url: str) -> bytes:
+    url = image_url
+    for _ in range(EMOJI_FETCH_MAX_REDIRECTS + 1):
+        check_fetch_url(url)
+        async with image_http_client.stream("GET", url) as response:
+            # 重定向的目标同样要校验，手动跟随
+            if response.next_request is not None:
+                url = str(response.next_request.url)
+                continue
+            response.raise_for_status()
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > EMOJI_FETCH_MAX_BYTES:
+                    raise ValueError("表情包文件过大")
+                chunks.append(chunk)
+            return b"".join(chunks)
+    raise ValueError(f"图片地址重定向次数过多: {image_url}")
+
+async def fetch_and_process_image(image_url: str) -> Optional[Dict]:
+    """下载图片并在进程池中规范化（校验格式、缩小、抽帧、计算感知哈希）。失败时返回None，退回直接用URL分析"""
+    try:
+        processed = await image_pipeline.process(await download_image(image_url))
+    except Exception as e:
+        logger.warning(f"下载或处理表情包失败: {str(e)}")
+        return None
+    emoji_hash_index.remember_url(image_url, processed["dhash"])
+    return processed
+
+def remember_emoji_analysis(image_url: str, image_hash: Optional[int], role: str, result: str):
+    """保存表情包分析结果：哈希索引供再次分析时复用，表情包目录供本地搜索"""
+    if image_hash is not None:
+        emoji_hash_index.put_analysis(image_hash, role, result)
+    if EMOJI_CATALOG_INDEX_UPLOADS or not image_url.startswith(image_storage.public_url("")):
+        emoji_catalog.add_analysis(image_url, result)
+
+async def prepare_emoji_analysis(image_url: str, role: str) -> Tuple[Optional[str], str, Optional[int]]:
+    """返回 (已缓存的分析结果, 发给视觉模型的图片, 感知哈希)"""
+    # 视觉上相同的表情包直接返回已有的分析结果
+    image_hash = emoji_hash_index.hash_for_url(image_url)
+    if image_hash is not None:
+        cached = emoji_hash_index.get_analysis(image_hash, role)
+        if cached is not None:
+            logger.info(f"表情包分析命中哈希缓存: {image_hash:016x}")
+            return cached, image_url, image_hash
+
+    # 下载并缩小图片后以base64发给视觉模型，处理失败时仍直接传URL
+    image_input = image_url
+    processed = await fetch_and_process_image(image_url)
+    if processed is not None:
+        image_hash = processed["dhash"]
+        cached = emoji_hash_index.get_analysis(image_hash, role)
+        if cached is not None:
+            logger.info(f"表情包分析命中哈希缓存: {image_hash:016x}")
+            return cached, image_url, image_hash
+        image_input = "data:image/jpeg;base64," + base64.b64encode(processed["vl_image"]).decode("ascii")
+    return None, image_input, image_hash
+
+async def pretranslate_message(message: Dict) -> Optional[str]:
+    """以预取优先级为长辈分析一条收到的消息，结果同时写入与点击分析相同的缓存"""
+    role = "elder"
+    if message.get("type") in ("image", "emoji"):
+        image_url = message.get("image_data") or ""
+        if not image_url.startswith(('http://', 'https://')):
+            return None
+        cached, image_input, image_hash = await prepare_emoji_analysis(image_url, role)
+        if cached is not None:
+            return cached
+        result = await ImageAnalyzer().analyze_image(image_input, role, [], priority="prefetch")
+        remember_emoji_analysis(image_url, image_hash, role, result)
+        return result
+
+    text = message.get("message") or ""
+    analyzer = TextAnalyzer()
+    summary, context = await resolve_context(message.get("pair_id"), message.get("id"), [])
+    cache_key = analysis_cache_key(analyzer, text, role, message.get("pair_id"), message.get("id"), context)
+    return await analysis_cache.get_or_compute(
+        cache_key,
+        lambda: analyzer.analyze_text(text, role, context, summary, priority="prefetch")
+    )
+
+# 长辈的预翻译：按配对开启，消息投递时在后台分析，结果保存并推送
+pretranslator = services.register("pretranslator", lambda: Pretranslator(db, pretranslate_message),
+                                  close=lambda p: p.close())
+
+async def stream_analysis(connection: ClientConnection, request: Dict):
+    """在WebSocket上流式推送分析结果：analysis_start → analysis_delta... → analysis_done / analysis_error
 
+    所有帧都带 message_id，客户端据此更新对应消息。任务被取消时上游生成随之停止。
+    """
+    message_id = request.get("message_id")
+    kind = request.get("kind", "text")
+    role = request.get("role", "elder")
+    context = request.get("context") or []
+    try:
+        if kind == "text":
+            text = request.get("text") or ""
+            if not text.strip():
+                raise ValueError("文本内容不能为空")
+            analyzer = TextAnalyzer()
+            cached = await pretranslator.lookup(request.get("pair_id"), message_id, role, text)
+            if cached is None:
+                summary, context = await resolve_context(request.get("pair_id"), message_id, context)
+                cache_key = analysis_cache_key(analyzer, text, role, request.get("pair_id"), message_id, context)
+                cached = await analysis_cache.get(cache_key)
+            chunks = analyzer.stream_text(text, role, context, summary) if cached is None else None
+        elif kind == "emoji":
+            image_url = request.get("image_url") or ""
+            if not image_url.startswith(('http://', 'https://')):
+                raise ValueError("URL必须以http://或https://开头")
+            cached, image_input, image_hash = await prepare_emoji_analysis(image_url, role)
+            chunks = ImageAnalyzer().stream_image(image_input, role, context) if cached is None else None
+        else:
+            raise ValueError(f"未知的分析类型: {kind}")
+
+        if cached is not None:
+            connection.send({"type": "analysis_done", "message_id": message_id, "analysis": cached})
+            return
+
+        connection.send({"type": "analysis_start", "message_id": message_id})
+        started = time.monotonic()
+        parts = []
+        try:
+            async for delta in chunks:
+                parts.append(delta)
+                connection.send({"type": "analysis_delta", "message_id": message_id, "delta": delta})
+        finally:
+            await chunks.aclose()
+
+        result = "".join(parts)
+        if kind == "text":
+            await analysis_cache.set(cache_key, result, time.monotonic() - started)
+        else:
+            remember_emoji_analysis(image_url, image_hash, role, result)
+        connection.send({"type": "analysis_done", "message_id": message_id, "analysis": result})
+    except asyncio.CancelledError:
+        logger.info(f"分析已取消: {message_id}")
+        raise
+    except Exception as e:
+        logger.error(f"流式分析错误: {str(e)}")
+        connection.send({"type": "analysis_error", "message_id": message_id, "error": str(e)})
+
+def parse_last_seq(value) -> int:
+    """握手参数或 resume 帧中的 last_seq：非负整数（或其十进制字符串），否则抛出 ValueError"""
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValueError(f"无效的 last_seq: {value!r}")
+    return value
+
+async def replay_missed(connection: ClientConnection, pair_id: int, last_seq: int):
+    """补发序号大于 last_seq 的消息，最后发送 resume_done 告知最新序号；超过补发上限时客户端改为拉取历史"""
+    frames, current, truncated = await sequencer.replay(pair_id, last_seq)
+    for frame in frames:
+        connection.send(frame)
+    connection.send({"type": "resume_done", "seq": current, "truncated": truncated})
+    logger.info(f"[补发] {connection.client_id} 从序号 {last_seq} 补发 {len(frames)} 条消息")
+
+# WebSocket连接
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    await websocket.accept()
-    active_connections[client_id] = websocket
+    # 只接受已注册的用户，配对以注册表为准，握手参数中的 pair_id 只用于校验
+    try:
+        member = await pair_registry.lookup(client_id)
+    except ServiceUnavailableError as se:
+        # 1013: 稍后重试
+        logger.warning(f"[连接] 暂时无法接受 {client_id}: {str(se)}")
+        await websocket.close(code=1013)
+        return
+    except Exception as e:
+        logger.error(f"[连接] 查询 {client_id} 的配对失败: {str(e)}")
+        await websocket.close(code=1011)
+        return
+    requested_pair = websocket.query_params.get("pair_id")
+    if member is None or (requested_pair and requested_pair != str(member.pair_id)):
+        logger.warning(f"[连接] 拒绝 {client_id}: 未注册或不属于配对 {requested_pair}")
+        await websocket.close(code=1008)
+        return
+    pair_id = member.pair_id
+
+    # 通过 Sec-WebSocket-Protocol 协商帧编码，客户端未提供子协议时使用JSON
+    codec = negotiate_codec(websocket.scope.get("subprotocols", []))
+    await websocket.accept(subprotocol=codec.subprotocol)
+    connection = active_connections.add(client_id, websocket, codec)
+    await broker.subscribe(client_channel(client_id), lambda data: deliver_local(client_id, data))
+    await broker.set_online(client_id)
     logger.info(f"[连接] {client_id} 连接成功，目前连接数: {len(active_connections)}")
-    logger.info(f"active_connections,{active_connections}")
+    # 当前连接上正在进行的流式分析，新的分析请求会取消旧的
+    analysis_task: Optional[asyncio.Task] = None
+    # 握手时带上最后确认的序号（last_seq），只补发断线期间错过的消息
+    last_seq = websocket.query_params.get("last_seq")
     try:
+        if last_seq:
+            try:
+                last_seq = parse_last_seq(last_seq)
+            except ValueError as ve:
+                # 不补发，连接照常使用；客户端可以再发 resume 帧
+                last_seq = None
+                connection.send({"type": "error", "id": None, "error": str(ve)})
+            if last_seq is not None:
+                await replay_missed(connection, pair_id, last_seq)
+
         while True:
-            data = await websocket.receive_json()
-            logger.info(f"收到消息: {data}")
+            data = await connection.receive()
+            received = time.perf_counter()
+            frame_type = data.get('type') if data.get('type') in TYPE_CODES else "other"
+            WS_FRAMES.inc(type=frame_type)
+            if metrics.sampled():
+                logger.info(f"收到消息(采样): {frame_type} {client_id} -> {data.get('to')}")
 
-            # 接收到心跳 ping/pong 可不处理
+            # 接收到心跳 ping/pong 可不处理（收到任何帧都会刷新心跳时间）
             if data['type'] == "ping":
-                await websocket.send_json({"type": "pong"})
+                connection.send({"type": "pong"})
                 continue
-            
-            # 保存消息到数据库
+            if data['type'] == "pong":
+                continue
+
+            # 流式分析请求，不转发也不保存
+            if data['type'] in ("analyze", "analysis_cancel"):
+                if analysis_task is not None and not analysis_task.done():
+                    analysis_task.cancel()
+                if data['type'] == "analyze":
+                    # 上下文只能取自己配对的对话
+                    data['pair_id'] = pair_id
+                    analysis_task = asyncio.create_task(stream_analysis(connection, data))
+                continue
+
+            # 客户端发现序号不连续时请求补发，只能补发自己配对的消息
+            if data['type'] == "resume":
+                try:
+                    last_seq = parse_last_seq(data.get('last_seq'))
+                except ValueError as ve:
+                    connection.send({"type": "error", "id": data.get('id'), "error": str(ve)})
+                    continue
+                await replay_missed(connection, pair_id, last_seq)
+                continue
+
+            # 只转发和保存本人发给配对中对方的聊天帧
             try:
-                db.save_message(
-                    message_id=data.get('id'),
-                    from_role=data.get('from'),
-                    to_role=data.get('to'),
-                    message_type=data.get('type'),
-                    message_content=data.get('message'),
-                    image_data=data.get('image_data'),
-                    pair_id=data.get('pair_id')
-                )
-                logger.info("消息成功保存到数据库")
-            except Exception as e:
-                logger.error(f"保存消息到数据库失败: {str(e)}")
-                raise
-                
-            # 转发消息 - 修改为只发送给对应pair_id的用户
-            recipient = data["to"]
-            logger.info(f"active_connections,{active_connections}")
-            if recipient in active_connections and \
-            (recipient.startswith(f"young_{data['pair_id']}") or \
-                recipient.startswith(f"elder_{data['pair_id']}")):
-                await active_connections[recipient].send_json(data)
+                pair_registry.validate_frame(client_id, member, data)
+            except ValueError as ve:
+                pair_registry.rejected_frames += 1
+                logger.warning(f"拒绝 {client_id} 的消息: {str(ve)}")
+                connection.send({"type": "error", "id": data.get('id'), "error": str(ve)})
+                continue
+
+            # 分配配对内序号：转发给对方、回执给发送方，并随消息一起保存
+            data['pair_id'] = pair_id
+            try:
+                data['seq'] = await sequencer.next_seq(pair_id)
+                sequencer.remember(pair_id, data)
+                connection.send({"type": "ack", "id": data.get('id'), "seq": data['seq']})
+            except ConnectionError as e:
+                logger.warning(f"分配消息序号失败: {str(e)}")
+
+            try:
+                await route_message(member.partner, data)
+            except ConnectionError as e:
+                # 路由暂时不可用时消息仍会落库，对方重连后通过历史接口补齐
+                logger.warning(f"转发消息失败: {str(e)}")
+            WS_FORWARD_SECONDS.observe(time.perf_counter() - received, type=frame_type)
+            if member.role == "young":
+                pretranslator.submit(data, route_message)
+
+            # 转发后放入写入队列，由后台批量保存到数据库
+            await message_writer.enqueue({
+                "message_id": data.get('id'),
+                "from_role": data.get('from'),
+                "to_role": data.get('to'),
+                "message_type": data.get('type'),
+                "message_content": data.get('message'),
+                "image_data": data.get('image_data'),
+                "pair_id": pair_id,
+                "seq": data.get('seq')
+            })
+            # 未被摘要覆盖的消息够多时在后台刷新对话摘要
+            conversation_context.note_message(pair_id, data.get('seq'))
     except WebSocketDisconnect:
-        del active_connections[client_id]
         logger.info(f"用户 {client_id} 已断开")
+    except Exception as e:
+        logger.error(f"用户 {client_id} 连接异常: {str(e)}")
+    finally:
+        # 同一用户可能已经在本worker上重新连接，只清理属于当前连接的状态
+        if active_connections.remove(connection):
+            await broker.unsubscribe(client_channel(client_id))
+        await broker.set_offline(client_id)
+        # 客户端断开后不再为没人看的生成付费
+        if analysis_task is not None and not analysis_task.done():
+            analysis_task.cancel()
+
+
+# 批量分析接口：一次翻译整段对话
+BATCH_ANALYSIS_MAX_MESSAGES = int(os.getenv("BATCH_ANALYSIS_MAX_MESSAGES", "200"))
+
+@app.post("/api/analyze_batch")
+async def analyze_batch_api(request: BatchAnalysisRequest):
+    try:
+        if not request.messages:
+            raise ValueError("消息列表不能为空")
+        if len(request.messages) > BATCH_ANALYSIS_MAX_MESSAGES:
+            raise ValueError(f"单次最多分析 {BATCH_ANALYSIS_MAX_MESSAGES} 条消息")
 
+        analyzer = BatchTextAnalyzer()
+        texts, ids_by_text = dedupe_messages([(str(m.id), m.text) for m in request.messages])
+        logger.info(f"收到批量分析请求: pair {request.pair_id}, {len(request.messages)} 条消息, 去重后 {len(texts)} 条")
+
+        # 批次本身就是连续的对话，服务端只补充该配对的滚动摘要
+        summary = await conversation_context.get_summary(request.pair_id)
+        summary = summary["summary"] if summary else ""
+        # 同一配对内相同的文本共用结果；摘要不计入键，理由同 message_analysis_key
+        key_context = [f"配对:{request.pair_id}", *request.context]
+
+        # 先查缓存，只把未命中的文本交给模型
+        cache_keys = {
+            text: text_analysis_key(text, request.role, key_context, analyzer.model, analyzer.prompt_version)
+            for text in texts
+        }
+        analyses: Dict[str, str] = {}
+        pending = []
+        for text in texts:
+            cached = await analysis_cache.get(cache_keys[text])
+            if cached is None:
+                pending.append(text)
+            else:
+                analyses[text] = cached
+
+        calls = 0
+        if pending:
+            started = time.monotonic()
+            computed, calls = await analyzer.analyze_batch(pending, request.role, request.context, summary)
+            elapsed = time.monotonic() - started
+            for text, analysis in computed.items():
+                await analysis_cache.set(cache_keys[text], analysis, elapsed / len(computed))
+            analyses.update(computed)
+
+        results = {
+            message_id: analyses[text]
+            for text, message_ids in ids_by_text.items() if text in analyses
+            for message_id in message_ids
+        }
+        failed = [str(m.id) for m in request.messages if str(m.id) not in results]
+        return {"status": "success", "results": results, "failed": failed, "model_calls": calls}
+    except (ModelBusyError, ServiceUnavailableError) as me:
+        logger.warning(f"批量分析模型繁忙: {str(me)}")
+        raise HTTPException(status_code=503, detail=str(me))
+    except ValueError as ve:
+        logger.error(f"批量分析参数错误: {str(ve)}")
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logger.error(f"批量分析错误: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 # 文本分析接口
 @app.post("/api/analyze_text")
@@ -215,9 +902,22 @@ async def analyze_text_api(request: TextAnalysisRequest):
             raise ValueError("文本内容不能为空")
             
         logger.info(f"收到文本分析请求: {request.text[:30]}... (角色: {request.role}, 上下文长度: {len(request.context)})")
+        precomputed = await pretranslator.lookup(request.pair_id, request.message_id, request.role, request.text)
+        if precomputed is not None:
+            return {"status": "success", "analysis": precomputed}
+
         analyzer = TextAnalyzer()
-        result = await analyzer.analyze_text(request.text, request.role, request.context)
+        summary, context = await resolve_context(request.pair_id, request.message_id, request.context)
+        cache_key = analysis_cache_key(analyzer, request.text, request.role, request.pair_id, request.message_id,
+                                       context)
+        result = await analysis_cache.get_or_compute(
+            cache_key,
+            lambda: analyzer.analyze_text(request.text, request.role, context, summary)
+        )
         return {"status": "success", "analysis": result}
+    except (ModelBusyError, ServiceUnavailableError) as me:
+        logger.warning(f"文本分析模型繁忙: {str(me)}")
+        raise HTTPException(status_code=503, detail=str(me))
     except ValueError as ve:
         logger.error(f"文本分析参数错误: {str(ve)}")
         raise HTTPException(status_code=400, detail=str(ve))
@@ -242,10 +942,18 @@ async def analyze_emoji_api(request: EmojiAnalysisRequest):
         if not request.image_url.startswith(('http://', 'https://')):
             raise ValueError("URL必须以http://或https://开头")
             
+        cached, image_input, image_hash = await prepare_emoji_analysis(request.image_url, request.role)
+        if cached is not None:
+            return {"status": "success", "analysis": cached}
+
         analyzer = ImageAnalyzer()
-        result = await analyzer.analyze_image(request.image_url, request.role, request.context)
+        result = await analyzer.analyze_image(image_input, request.role, request.context)
+        remember_emoji_analysis(request.image_url, image_hash, request.role, result)
         return {"status": "success", "analysis": result}
         
+    except (ModelBusyError, ServiceUnavailableError) as me:
+        logger.warning(f"表情包分析模型繁忙: {str(me)}")
+        raise HTTPException(status_code=503, detail=str(me))
     except ValueError as ve:
         logger.error(f"表情包分析参数错误: {str(ve)}")
         raise HTTPException(status_code=400, detail=str(ve))
@@ -253,17 +961,136 @@ async def analyze_emoji_api(request: EmojiAnalysisRequest):
         logger.error(f"表情包分析错误: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# 单页历史消息的最大条数
+HISTORY_PAGE_MAX = 500
+
+def _json_default(value):
+    # 数据库返回的 datetime 与 FastAPI 默认序列化保持一致
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
 @app.get("/api/get_messages")
-async def get_messages(pair_id: int):
+async def get_messages(pair_id: int, before_id: Optional[int] = None, after_id: Optional[int] = None,
+                       limit: int = HISTORY_PAGE_MAX):
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="before_id 和 after_id 不能同时指定")
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+
+    chunks = db.iter_messages(pair_id, limit, before_id, after_id)
     try:
-        messages = db.get_messages(pair_id)
-        return messages
+        # 先读第一块，查询出错时还能返回正确的状态码
+        first_chunk = await anext(chunks, None)
     except Exception as e:
+        await chunks.aclose()
         logger.error(f"获取历史消息失败: {str(e)}")
         raise HTTPException(status_code=500, detail="获取历史消息失败")
+
+    async def stream():
+        # 逐条序列化输出JSON数组，不拼装整页的JSON字符串；连接在读完整页后已归还
+        try:
+            yield "["
+            first = True
+            chunk = first_chunk
+            while chunk is not None:
+                for row in chunk:
+                    yield ("" if first else ",") + json.dumps(row, ensure_ascii=False, default=_json_default)
+                    first = False
+                chunk = await anext(chunks, None)
+            yield "]"
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(stream(), media_type="application/json")
+
+class PretranslateSetting(BaseModel):
+    enabled: bool
+
+@app.get("/api/pretranslate/{pair_id}")
+async def get_pretranslate(pair_id: int):
+    return {"pair_id": pair_id, "enabled": await pretranslator.enabled(pair_id)}
+
+@app.post("/api/pretranslate/{pair_id}")
+async def set_pretranslate(pair_id: int, setting: PretranslateSetting):
+    """开启或关闭该配对的预翻译"""
+    try:
+        await pretranslator.set_enabled(pair_id, setting.enabled)
+    except ServiceUnavailableError:
+        raise
+    except Exception as e:
+        logger.error(f"保存预翻译设置失败: {str(e)}")
+        raise HTTPException(status_code=500, detail="保存预翻译设置失败")
+    return {"pair_id": pair_id, "enabled": setting.enabled}
+
+class PairCreateRequest(BaseModel):
+    pair_id: Optional[int] = None
+
+@app.post("/api/pairs")
+async def create_pair(request: PairCreateRequest):
+    """运行时创建配对，不指定 pair_id 时自动分配。返回配对ID和双方的客户端ID"""
+    try:
+        return await pair_registry.create_pair(request.pair_id)
+    except ValueError as ve:
+        raise HTTPException(status_code=409, detail=str(ve))
+    except ServiceUnavailableError:
+        raise
+    except Exception as e:
+        logger.error(f"创建配对失败: {str(e)}")
+        raise HTTPException(status_code=500, detail="创建配对失败")
+
+@app.get("/api/pairs/{pair_id}")
+async def get_pair(pair_id: int):
+    members = await db.get_pair_members(pair_id)
+    if not members:
+        raise HTTPException(status_code=404, detail=f"配对 {pair_id} 不存在")
+    return {"pair_id": pair_id, "members": members}
+
+@app.delete("/api/pairs/{pair_id}")
+async def delete_pair(pair_id: int):
+    """删除配对及其用户，聊天记录保留；已建立的连接在重连时被拒绝"""
+    if not await pair_registry.delete_pair(pair_id):
+        raise HTTPException(status_code=404, detail=f"配对 {pair_id} 不存在")
+    return {"pair_id": pair_id, "deleted": True}
+
+@app.get("/api/presence/{pair_id}")
+async def get_presence(pair_id: int):
+    """查询配对双方是否在线（跨所有worker）"""
+    members = [member["id"] for member in await db.get_pair_members(pair_id)]
+    try:
+        online = await broker.online(members)
+    except ConnectionError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {member: member in online for member in members}
+
+@app.get("/api/connections/stats")
+async def connection_stats():
+    stats = {**active_connections.stats(), **sequencer.stats(), **pair_registry.stats()}
+    if services.created("history_archive"):
+        stats.update(history_archive.stats())
+    return stats
+
+@app.get("/api/analysis_cache/stats")
+async def analysis_cache_stats():
+    return {**analysis_cache.stats(), **conversation_context.stats(), **pretranslator.stats()}
+
+@app.get("/api/model_calls/stats")
+async def model_calls_stats():
+    return model_runner.stats()
+
+@app.get("/api/emoji_search/stats")
+async def emoji_search_stats():
+    return {**emoji_search_client.stats(), **emoji_catalog.stats()}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus 文本格式的指标（仅本worker）"""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    """各依赖的可用状态。必需依赖（数据库、消息路由）不可用或仍在预热时返回503，负载均衡据此摘除worker"""
+    report = await services.health()
+    return JSONResponse(report, status_code=503 if report["status"] in ("starting", "unavailable") else 200)
 
 
 class EmojiSearchRequest(BaseModel):
@@ -277,39 +1104,31 @@ async def search_emojis(request: EmojiSearchRequest):
             raise ValueError("搜索文本不能为空")
             
         logger.info(f"收到表情包搜索请求: {request.text}")
-        
-        # 从环境变量获取ID和Key
-        emoji_id = os.getenv("EMOJI_API_ID")
-        emoji_key = os.getenv("EMOJI_API_KEY")
-        
-        if not emoji_id or not emoji_key:
-            raise ValueError("表情包API配置缺失")
-        
-        params = {
-            "id": emoji_id,
-            "key": emoji_key,
-            "words": request.text,
-            "limit": request.limit
+
+        # 本地目录凑够数量就不再请求上游
+        local = emoji_catalog.search(request.text, request.limit)
+        if len(local) >= request.limit:
+            return {"status": "success", "emojis": local}
+
+        try:
+            emojis = await emoji_search_client.search(request.text, request.limit)
+        except (CircuitOpenError, httpx.HTTPError, ValueError) as e:
+            # 上游不可用时有多少本地结果就先返回多少
+            if not local:
+                raise
+            logger.warning(f"表情包API不可用，返回本地结果: {str(e)}")
+            return {"status": "success", "emojis": local}
+        emoji_catalog.add_search(request.text, emojis)
+        return {
+            "status": "success",
+            "emojis": emojis
         }
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://cn.apihz.cn/api/img/apihzbqbbaidu.php",
-                params=params
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data["code"] == 200:
-                    return {
-                        "status": "success",
-                        "emojis": data["res"][:request.limit]  # 返回指定数量的表情包
-                    }
-                else:
-                    raise ValueError(data.get("msg", "表情包API返回错误"))
-            else:
-                raise ValueError("表情包API请求失败")
-                
+
+    except ServiceUnavailableError:
+        raise
+    except CircuitOpenError as ce:
+        logger.error(f"表情包搜索暂不可用: {str(ce)}")
+        raise HTTPException(status_code=503, detail=str(ce))
     except ValueError as ve:
         logger.error(f"表情包搜索参数错误: {str(ve)}")
         raise HTTPException(status_code=400, detail=str(ve))
@@ -318,23 +1137,32 @@ async def search_emojis(request: EmojiSearchRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-# 阿里云 OSS 配置信息
-# 加载环境变量
-load_dotenv(override=True)
-
-# 从环境变量中获取阿里云 OSS 配置信息
-aliyun_access_key_id = os.getenv("ALIYUN_ACCESS_KEY_ID")
-aliyun_access_key_secret = os.getenv("ALIYUN_ACCESS_KEY_SECRET")
-aliyun_oss_endpoint = os.getenv("ALIYUN_OSS_ENDPOINT")
-aliyun_oss_bucket_name = os.getenv("ALIYUN_OSS_BUCKET_NAME")
+# 对象存储，OSS_BACKEND=local 时使用本地目录代替阿里云 OSS，由应用直接提供文件
+image_storage = services.register("object_storage", create_image_storage, close=lambda s: s.close(),
+                                  check=lambda s: s.check())
+if local_storage_root() is not None:
+    app.mount("/oss", StaticFiles(directory=local_storage_root(), check_dir=False), name="oss")
 
-# 检查环境变量是否存在
-if not aliyun_access_key_id or not aliyun_access_key_secret or not aliyun_oss_endpoint or not aliyun_oss_bucket_name:
-    raise ValueError("阿里云 OSS 配置信息缺失，请检查 .env 文件")
+def _spool_upload(source, target) -> Tuple[str, int]:
+    """把上传的文件按块复制到 target，同时计算内容哈希，返回 (哈希, 字节数)。
+    在线程中执行；超过大小上限时读到上限多一块就停止"""
+    digest = hashlib.sha256()
+    file_size = 0
+    while True:
+        chunk = source.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        file_size += len(chunk)
+        if file_size > UPLOAD_MAX_BYTES:
+            break
+        digest.update(chunk)
+        target.write(chunk)
+    target.flush()
+    return digest.hexdigest(), file_size
 
-# 阿里云 OSS 配置
-auth = oss2.Auth(aliyun_access_key_id, aliyun_access_key_secret)
-bucket = oss2.Bucket(auth, aliyun_oss_endpoint, aliyun_oss_bucket_name)
+def _safe_file_ext(filename: str) -> str:
+    ext = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else ''
+    return ext if ext.isalnum() and len(ext) <= 5 else 'jpg'
 
 @app.post("/api/upload_image")
 async def upload_image(image: UploadFile = File(...)):
@@ -345,27 +1173,42 @@ async def upload_image(image: UploadFile = File(...)):
             logger.error(f"文件类型错误，文件 {image.filename} 不是有效的图片文件")
             raise ValueError("请上传有效的图片文件")
 
-        # 生成唯一的文件名
-        file_ext = image.filename.split('.')[-1] if '.' in image.filename else 'jpg'
-        unique_filename = f"{uuid.uuid4()}.{file_ext}"
-        logger.info(f"生成的唯一文件名: {unique_filename}")
+        # 复制到有路径的临时文件（在线程中按块复制并计算内容哈希），处理进程和上传都直接读这个文件，
+        # 图片不在本进程内整体载入内存
+        with tempfile.NamedTemporaryFile(prefix="upload_") as spooled:
+            content_hash, file_size = await asyncio.to_thread(_spool_upload, image.file, spooled)
+            if file_size > UPLOAD_MAX_BYTES:
+                raise HTTPException(status_code=413, detail=f"图片大小超过限制（{UPLOAD_MAX_BYTES} 字节）")
+            if file_size == 0:
+                raise ValueError("上传的图片为空")
 
-        # 读取文件内容
-        file_content = await image.read()
-        logger.info(f"成功读取文件 {image.filename}，文件大小: {len(file_content)} 字节")
+            # 在进程池中校验真实格式并生成缩略图等版本
+            processed = await image_pipeline.process(spooled.name)
 
-        # 上传到阿里云 OSS
-        logger.info(f"开始上传文件 {unique_filename} 到阿里云 OSS")
-        result = bucket.put_object(unique_filename, file_content)
-        logger.info(f"阿里云 OSS 上传响应状态码: {result.status}")
+            # 按内容寻址命名，相同文件只存一份；扩展名以真实格式为准
+            object_key = f"{content_hash}.{processed['extension']}"
+            thumbnail_key = f"{content_hash}_thumb.webp"
+            image_url = image_storage.public_url(object_key)
+            thumbnail_url = image_storage.public_url(thumbnail_key)
+            logger.info(f"文件 {image.filename} 大小 {file_size} 字节，格式 {processed['format']}，对象名: {object_key}")
 
-        if result.status == 200:
-            # 生成图片的网络地址
-            image_url = f"https://{aliyun_oss_bucket_name}.{aliyun_oss_endpoint}/{unique_filename}"
-            return {"image_url": image_url}
-        else:
-            logger.error(f"图片 {unique_filename} 上传到 OSS 失败，状态码: {result.status}")
-            raise Exception("图片上传到 OSS 失败")
+            if await image_storage.exists(object_key):
+                logger.info(f"对象 {object_key} 已存在，跳过上传")
+            else:
+                # 先传缩略图再传原图，原图存在即代表所有版本都已上传
+                await image_storage.put_file(thumbnail_key, io.BytesIO(processed["thumbnail"]), len(processed["thumbnail"]))
+                spooled.seek(0)
+                await image_storage.put_file(object_key, spooled, file_size)
+                logger.info(f"文件 {object_key} 上传完成")
+
+        # 记录新URL对应的感知哈希，之后分析时无需再下载
+        emoji_hash_index.remember_url(image_url, processed["dhash"])
+        return {"image_url": image_url, "thumbnail_url": thumbnail_url}
+    except (HTTPException, ServiceUnavailableError):
+        raise
+    except ValueError as ve:
+        logger.error(f"图片上传参数错误: {str(ve)}")
+        raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
         logger.error(f"处理图片上传请求时发生错误: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -389,10 +1232,14 @@ class EmojiTagGenerator:
             4. 关键词要与词汇相关  
             5. 只返回关键词，不要其他内容"""
             
-            response = Generation.call(
+            response = await model_runner.run(
+                self.model,
+                dashscope.Generation.call,
                 model=self.model,
                 prompt=prompt,
-                api_key=self.api_key
+                api_key=self.api_key,
+                priority="background",
+                analyzer="tags"
             )
             
             if response.status_code == 200:
@@ -412,9 +1259,15 @@ async def generate_tags_api(text: str = Form(...)):
             raise ValueError("文本内容不能为空")
             
         logger.info(f"收到表情标签生成请求: {text[:30]}...")
-        generator = EmojiTagGenerator()
-        tags = await generator.generate_tags(text)
+        tags = emoji_catalog.tags_for(text)
+        if tags is None:
+            generator = EmojiTagGenerator()
+            tags = await generator.generate_tags(text)
+            emoji_catalog.remember_tags(text, tags)
         return {"status": "success", "tags": tags}
+    except (ModelBusyError, ServiceUnavailableError) as me:
+        logger.warning(f"表情标签生成模型繁忙: {str(me)}")
+        raise HTTPException(status_code=503, detail=str(me))
     except ValueError as ve:
         logger.error(f"表情标签生成参数错误: {str(ve)}")
         raise HTTPException(status_code=400, detail=str(ve))
@@ -0,0 +1,373 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Dict], Awaitable[None]]
+
+# 单行帧的最大长度，超过的帧会被读取方拒绝
+MAX_FRAME_BYTES = 1024 * 1024
+# 写缓冲超过该大小才等待 drain，避免每条消息都让出事件循环
+WRITE_HIGH_WATER = 256 * 1024
+
+
+def client_channel(client_id: str) -> str:
+    return f"client:{client_id}"
+
+
+class MessageBroker:
+    """跨worker的消息路由接口：按频道发布/订阅，并汇总各worker上的在线用户
+
+    每个worker对自己持有的WebSocket连接订阅 client:{id} 频道，向不在本worker的用户发消息时
+    发布到对方的频道，由持有连接的worker投递。
+    """
+
+    def __init__(self):
+        self.handlers: Dict[str, Handler] = {}
+
+    async def start(self):
+        pass
+
+    async def publish(self, channel: str, message: Dict):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, handler: Handler):
+        raise NotImplementedError
+
+    async def unsubscribe(self, channel: str):
+        raise NotImplementedError
+
+    async def set_online(self, client_id: str):
+        raise NotImplementedError
+
+    async def set_offline(self, client_id: str):
+        raise NotImplementedError
+
+    async def online(self, client_ids: Iterable[str]) -> Set[str]:
+        """返回其中在任意worker上在线的用户"""
+        raise NotImplementedError
+
+    async def incr(self, key: str, floor: int = 0, amount: int = 1) -> int:
+        """所有worker共享的计数器：先抬到不低于 floor，再加 amount 并返回新值（amount=0 时只读取）"""
+        raise NotImplementedError
+
+    async def check(self):
+        """健康检查，不可用时抛出异常"""
+        pass
+
+    async def close(self):
+        pass
+
+    async def _dispatch(self, channel: str, message: Dict):
+        handler = self.handlers.get(channel)
+        if handler is None:
+            return
+        try:
+            await handler(message)
+        except Exception as e:
+            logger.warning(f"投递频道 {channel} 的消息失败: {str(e)}")
+
+
+class InMemoryBroker(MessageBroker):
+    """单进程实现，行为与原来的进程内字典一致，用于单worker部署和测试"""
+
+    def __init__(self):
+        super().__init__()
+        self.presence: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {}
+
+    async def publish(self, channel: str, message: Dict):
+        await self._dispatch(channel, message)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        self.handlers[channel] = handler
+
+    async def unsubscribe(self, channel: str):
+        self.handlers.pop(channel, None)
+
+    async def set_online(self, client_id: str):
+        self.presence[client_id] = self.presence.get(client_id, 0) + 1
+
+    async def set_offline(self, client_id: str):
+        count = self.presence.get(client_id, 0) - 1
+        if count > 0:
+            self.presence[client_id] = count
+        else:
+            self.presence.pop(client_id, None)
+
+    async def online(self, client_ids: Iterable[str]) -> Set[str]:
+        return {client_id for client_id in client_ids if client_id in self.presence}
+
+    async def incr(self, key: str, floor: int = 0, amount: int = 1) -> int:
+        value = max(self.counters.get(key, 0), floor) + amount
+        self.counters[key] = value
+        return value
+
+
+def _encode(frame: Dict) -> bytes:
+    return json.dumps(frame, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+async def _write(writer: asyncio.StreamWriter, data: bytes):
+    writer.write(data)
+    if writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+        await writer.drain()
+
+
+class BrokerHub:
+    """本机消息中枢：各worker通过TCP连接过来，按频道转发消息并汇总在线状态
+
+    协议为每行一个JSON帧：sub/unsub 订阅频道，pub 发布消息（原样转发给订阅者），
+    online/offline 上报在线用户，who 查询在线用户，incr 递增共享计数器。连接断开时清理该worker的订阅和在线状态。
+    计数器只保存在中枢内存中，中枢重启后由各worker上报的 floor 重新抬升。
+    """
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+        self.presence: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self._handle, host, port, limit=MAX_FRAME_BYTES)
+        logger.info(f"消息中枢已启动: {host}:{port}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        channels: Set[str] = set()
+        clients: Dict[str, int] = {}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = json.loads(line)
+                op = frame.get("op")
+                if op == "pub":
+                    for subscriber in list(self.subscribers.get(frame["ch"], ())):
+                        try:
+                            await _write(subscriber, line)
+                        except ConnectionError:
+                            pass
+                elif op == "sub":
+                    channels.add(frame["ch"])
+                    self.subscribers.setdefault(frame["ch"], set()).add(writer)
+                elif op == "unsub":
+                    channels.discard(frame["ch"])
+                    self._remove_subscriber(frame["ch"], writer)
+                elif op == "online":
+                    clients[frame["client"]] = clients.get(frame["client"], 0) + 1
+                    self.presence[frame["client"]] = self.presence.get(frame["client"], 0) + 1
+                elif op == "offline":
+                    if clients.get(frame["client"], 0) > 0:
+                        clients[frame["client"]] -= 1
+                        self._decrement_presence(frame["client"], 1)
+                elif op == "who":
+                    online = [c for c in frame["clients"] if c in self.presence]
+                    await _write(writer, _encode({"op": "reply", "id": frame["id"], "result": online}))
+                elif op == "incr":
+                    value = max(self.counters.get(frame["key"], 0), frame["floor"]) + frame["amount"]
+                    self.counters[frame["key"]] = value
+                    await _write(writer, _encode({"op": "reply", "id": frame["id"], "result": value}))
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.warning(f"消息中枢连接异常: {str(e)}")
+        finally:
+            for channel in channels:
+                self._remove_subscriber(channel, writer)
+            for client_id, count in clients.items():
+                self._decrement_presence(client_id, count)
+            writer.close()
+
+    def _remove_subscriber(self, channel: str, writer: asyncio.StreamWriter):
+        subscribers = self.subscribers.get(channel)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self.subscribers[channel]
+
+    def _decrement_presence(self, client_id: str, count: int):
+        remaining = self.presence.get(client_id, 0) - count
+        if remaining > 0:
+            self.presence[client_id] = remaining
+        else:
+            self.presence.pop(client_id, None)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+class SocketBroker(MessageBroker):
+    """通过本机TCP消息中枢在多个worker之间路由消息
+
+    start_hub 为真时每个worker启动时都尝试监听中枢端口，抢到端口的worker同时充当中枢，
+    其余worker作为客户端连接。中枢所在的worker退出后，其余worker重连时会重新选出一个。
+    """
+
+    def __init__(self, host: str = None, port: int = None, start_hub: bool = True, reconnect_delay: float = 0.5,
+                 connect_wait: float = 1.0):
+        super().__init__()
+        self.host = host or os.getenv("MESSAGE_BROKER_HOST", "127.0.0.1")
+        self.port = port or int(os.getenv("MESSAGE_BROKER_PORT", "8765"))
+        self.start_hub = start_hub
+        self.reconnect_delay = reconnect_delay
+        self.connect_wait = connect_wait
+        self.hub: Optional[BrokerHub] = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connected = asyncio.Event()
+        self._online: Dict[str, int] = {}
+        self._requests: Dict[int, asyncio.Future] = {}
+        self._request_ids = itertools.count(1)
+        self._read_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def start(self):
+        # 连接由后台任务建立，中枢暂时不可达时按重连间隔继续尝试，启动不会因此失败。
+        # 正常情况下第一次连接很快，稍等一下，避免启动后的头几条消息因未连接而无法转发
+        self._read_task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self.connected.wait(), self.connect_wait)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.connect_wait}s 内未能连接消息中枢 {self.host}:{self.port}，后台继续重试")
+
+    async def _connect(self):
+        if self.start_hub and self.hub is None:
+            hub = BrokerHub()
+            try:
+                await hub.start(self.host, self.port)
+                self.hub = hub
+            except OSError:
+                # 端口已被其他worker占用，直接作为客户端连接
+                pass
+        reader, writer = await asyncio.open_connection(self.host, self.port, limit=MAX_FRAME_BYTES)
+        self.reader, self.writer = reader, writer
+        # 重连后重新上报订阅和在线状态
+        for channel in self.handlers:
+            writer.write(_encode({"op": "sub", "ch": channel}))
+        for client_id, count in self._online.items():
+            for _ in range(count):
+                writer.write(_encode({"op": "online", "client": client_id}))
+        await writer.drain()
+        self.connected.set()
+
+    async def _run(self):
+        reconnecting = False
+        while not self._closing:
+            # 第一次连接立即进行，之后每次失败或断开都等待重连间隔
+            while not self._closing:
+                if reconnecting:
+                    await asyncio.sleep(self.reconnect_delay)
+                reconnecting = True
+                try:
+                    await self._connect()
+                    logger.info("已连接消息中枢")
+                    break
+                except OSError as e:
+                    logger.warning(f"连接消息中枢失败: {str(e)}")
+            if self._closing:
+                return
+            try:
+                await self._read_loop()
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+                logger.warning(f"与消息中枢的连接中断: {str(e)}")
+            self.connected.clear()
+            for future in self._requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("与消息中枢的连接中断"))
+            self._requests.clear()
+
+    async def _read_loop(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            frame = json.loads(line)
+            op = frame.get("op")
+            if op == "pub":
+                await self._dispatch(frame["ch"], frame["msg"])
+            elif op == "reply":
+                future = self._requests.pop(frame["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(frame["result"])
+
+    async def _send(self, frame: Dict):
+        if not self.connected.is_set():
+            raise ConnectionError("消息中枢未连接")
+        await _write(self.writer, _encode(frame))
+
+    async def publish(self, channel: str, message: Dict):
+        await self._send({"op": "pub", "ch": channel, "msg": message})
+
+    async def subscribe(self, channel: str, handler: Handler):
+        self.handlers[channel] = handler
+        if self.connected.is_set():
+            await self._send({"op": "sub", "ch": channel})
+
+    async def unsubscribe(self, channel: str):
+        if self.handlers.pop(channel, None) is not None and self.connected.is_set():
+            await self._send({"op": "unsub", "ch": channel})
+
+    async def set_online(self, client_id: str):
+        self._online[client_id] = self._online.get(client_id, 0) + 1
+        if self.connected.is_set():
+            await self._send({"op": "online", "client": client_id})
+
+    async def set_offline(self, client_id: str):
+        count = self._online.get(client_id, 0)
+        if count == 0:
+            return
+        if count > 1:
+            self._online[client_id] = count - 1
+        else:
+            del self._online[client_id]
+        if self.connected.is_set():
+            await self._send({"op": "offline", "client": client_id})
+
+    async def _request(self, frame: Dict):
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._requests[request_id] = future
+        try:
+            await self._send({**frame, "id": request_id})
+            return await asyncio.wait_for(future, timeout=5)
+        finally:
+            self._requests.pop(request_id, None)
+
+    async def online(self, client_ids: Iterable[str]) -> Set[str]:
+        return set(await self._request({"op": "who", "clients": list(client_ids)}))
+
+    async def incr(self, key: str, floor: int = 0, amount: int = 1) -> int:
+        return await self._request({"op": "incr", "key": key, "floor": floor, "amount": amount})
+
+    async def check(self):
+        if not self.connected.is_set():
+            raise ConnectionError("未连接到消息中枢")
+        return {"hub": self.hub is not None}
+
+    async def close(self):
+        self._closing = True
+        if self._read_task is not None:
+            self._read_task.cancel()
+            try:
+                await self._read_task
+            except asyncio.CancelledError:
+                pass
+        if self.writer is not None:
+            self.writer.close()
+        if self.hub is not None:
+            await self.hub.close()
+
+
+def create_message_broker(name: Optional[str]) -> MessageBroker:
+    """MESSAGE_BROKER=memory（默认，单worker）或 socket（本机多worker，通过TCP中枢路由）"""
+    name = (name or "memory").lower()
+    if name == "memory":
+        return InMemoryBroker()
+    if name == "socket":
+        return SocketBroker()
+    raise ValueError(f"未知的消息路由后端: {name}")
@@ -0,0 +1,93 @@
+import logging
+import os
+from collections import OrderedDict, deque
+from typing import Dict, List, Tuple
+
+from message_broker import MessageBroker
+
+logger = logging.getLogger(__name__)
+
+
+def _row_to_frame(row: Dict) -> Dict:
+    created_at = row.get("created_at")
+    if hasattr(created_at, "isoformat"):
+        row["created_at"] = created_at.isoformat()
+    return row
+
+
+class MessageSequencer:
+    """为每个配对分配单调递增的消息序号，并在内存中保留最近的消息供重连补发
+
+    序号由 broker 的共享计数器分配，多个worker之间也不会重复；计数器丢失（中枢重启）时
+    以本worker见过的最大序号和数据库中的最大序号作为下限继续递增。
+    内存环形缓冲只包含本worker转发过的消息，不连续时回退到数据库查询。
+    """
+
+    def __init__(self, broker: MessageBroker, db, buffer_size: int = None, max_pairs: int = None,
+                 replay_limit: int = None):
+        self.broker = broker
+        self.db = db
+        self.buffer_size = buffer_size or int(os.getenv("MESSAGE_REPLAY_BUFFER", "200"))
+        self.max_pairs = max_pairs or int(os.getenv("MESSAGE_REPLAY_PAIRS", "10000"))
+        self.replay_limit = replay_limit or int(os.getenv("MESSAGE_REPLAY_LIMIT", "500"))
+        self.buffers: "OrderedDict[int, deque]" = OrderedDict()
+        self.known: Dict[int, int] = {}
+        self.buffer_replays = 0
+        self.db_replays = 0
+
+    async def _floor(self, pair_id: int) -> int:
+        if pair_id not in self.known:
+            self.known[pair_id] = await self.db.get_max_seq(pair_id)
+        return self.known[pair_id]
+
+    async def next_seq(self, pair_id: int) -> int:
+        seq = await self.broker.incr(f"seq:{pair_id}", await self._floor(pair_id))
+        self.known[pair_id] = max(self.known[pair_id], seq)
+        return seq
+
+    async def current_seq(self, pair_id: int) -> int:
+        return await self.broker.incr(f"seq:{pair_id}", await self._floor(pair_id), amount=0)
+
+    def remember(self, pair_id: int, frame: Dict):
+        buffer = self.buffers.get(pair_id)
+        if buffer is None:
+            buffer = self.buffers[pair_id] = deque(maxlen=self.buffer_size)
+            while len(self.buffers) > self.max_pairs:
+                self.buffers.popitem(last=False)
+        else:
+            self.buffers.move_to_end(pair_id)
+        buffer.append(frame)
+
+    def _from_buffer(self, pair_id: int, after_seq: int) -> List[Dict]:
+        buffer = self.buffers.get(pair_id)
+        if not buffer:
+            return []
+        return sorted((frame for frame in buffer if frame["seq"] > after_seq), key=lambda frame: frame["seq"])
+
+    async def replay(self, pair_id: int, after_seq: int) -> Tuple[List[Dict], int, bool]:
+        """返回 (after_seq 之后的消息, 当前最新序号, 是否因超过上限被截断)"""
+        current = await self.current_seq(pair_id)
+        if current <= after_seq:
+            return [], current, False
+
+        frames = self._from_buffer(pair_id, after_seq)
+        expected = list(range(after_seq + 1, min(current, after_seq + self.replay_limit) + 1))
+        if [frame["seq"] for frame in frames[:len(expected)]] == expected:
+            self.buffer_replays += 1
+            return frames[:len(expected)], current, current - after_seq > self.replay_limit
+
+        # 缓冲不完整时以数据库为准；还在写入队列中的消息由缓冲补上
+        self.db_replays += 1
+        rows = await self.db.get_messages_after_seq(pair_id, after_seq, self.replay_limit)
+        merged = {row["seq"]: _row_to_frame(row) for row in rows}
+        for frame in frames:
+            merged.setdefault(frame["seq"], frame)
+        replayed = [merged[seq] for seq in sorted(merged)][:self.replay_limit]
+        return replayed, current, current - after_seq > self.replay_limit
+
+    def stats(self) -> Dict:
+        return {
+            "pairs_buffered": len(self.buffers),
+            "buffer_replays": self.buffer_replays,
+            "db_replays": self.db_replays,
+        }
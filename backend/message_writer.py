@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+from db_manager import PERMANENT_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """消息异步批量落库（write-behind）
+
+    WebSocket 转发后只把消息放入内存队列，由后台任务按条数或时间阈值凑批，
+    一次多行INSERT写入数据库。写入失败的批次会退避重试而不是丢弃（至少一次语义）。
+    关闭时最多等待 stop_timeout 秒把队列写完；数据库在此期间仍不可用时，把没写入的消息
+    追加到本地的溢出文件，下次启动时先补写（重复写入由唯一键忽略）。
+    """
+
+    def __init__(self, db, batch_size: int = None, flush_interval: float = None,
+                 max_queue: int = None, retry_delay: float = None, stop_timeout: float = None,
+                 spill_path: str = None):
+        self.db = db
+        self.batch_size = batch_size or int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+        self.flush_interval = flush_interval or float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.05"))
+        self.max_queue = max_queue or int(os.getenv("MESSAGE_QUEUE_MAX", "10000"))
+        self.retry_delay = retry_delay or float(os.getenv("MESSAGE_RETRY_DELAY", "0.5"))
+        self.stop_timeout = stop_timeout if stop_timeout is not None else float(
+            os.getenv("MESSAGE_WRITER_STOP_TIMEOUT", "10"))
+        self.spill_path = spill_path or os.getenv("MESSAGE_SPILL_PATH", os.path.join("data", "message_spill.jsonl"))
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # 上次关闭时溢出、等待补写的消息，以及正在写入的批次（关闭超时时一并溢出）
+        self._backlog: List[Dict] = []
+        self._pending: List[Dict] = []
+        self._flushing: Optional[asyncio.Future] = None
+        self._deadline: Optional[float] = None
+
+    def start(self):
+        if self._task is None:
+            self.queue = asyncio.Queue(maxsize=self.max_queue)
+            self._deadline = None
+            self._backlog = self._claim_spill()
+            self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, message: Dict):
+        # 队列满时在此等待，对发送方形成背压而不是丢消息
+        await self.queue.put(message)
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    async def _collect_batch(self) -> List[Dict]:
+        # 直接收集到 _pending 中：凑批途中被取消时，已从队列取出的消息也会被溢出
+        batch = self._pending
+        batch.append(await self.queue.get())
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 and self.queue.empty():
+                break
+            try:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush(self, batch: List[Dict]):
+        delay = self.retry_delay
+        while True:
+            try:
+                await self.db.save_messages(batch)
+                return
+            except PERMANENT_ERRORS as e:
+                if len(batch) == 1:
+                    logger.error(f"消息无法保存，已丢弃: {batch[0].get('message_id')} {str(e)}")
+                    return
+                # 批次中有坏数据时逐条写入，避免一条消息拖住整批
+                logger.error(f"批量保存 {len(batch)} 条消息失败，改为逐条保存: {str(e)}")
+                for message in batch:
+                    await self._flush([message])
+                return
+            except Exception as e:
+                # 数据库不可用等临时错误：退避后重试整批，不丢消息。关闭期间等待不超过截止时间，
+                # 到期后由 stop 取消并溢出
+                if self._deadline is not None:
+                    delay = min(delay, max(self._deadline - time.monotonic(), 0))
+                logger.error(f"批量保存 {len(batch)} 条消息失败，{delay:.1f} 秒后重试: {str(e)}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def _write(self, batch: List[Dict]):
+        # 写入过程不响应 _run 的取消，保证已取出的批次写完；只有 stop 超时时才取消写入
+        self._flushing = asyncio.ensure_future(self._flush(batch))
+        try:
+            await asyncio.shield(self._flushing)
+        finally:
+            if self._flushing.done():
+                self._flushing = None
+
+    async def _run(self):
+        while self._backlog:
+            batch = self._backlog[:self.batch_size]
+            await self._write(batch)
+            del self._backlog[:len(batch)]
+        while True:
+            try:
+                batch = await self._collect_batch()
+            except asyncio.CancelledError:
+                return
+            await self._write(batch)
+            self._pending = []
+            for _ in batch:
+                self.queue.task_done()
+
+    async def stop(self, timeout: float = None):
+        if self._task is None:
+            return
+        timeout = self.stop_timeout if timeout is None else timeout
+        self._deadline = time.monotonic() + timeout
+        # 等待补写和队列中的消息全部写完后再结束后台任务，最多等 timeout 秒
+        try:
+            await asyncio.wait_for(self._drained(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"关闭时 {timeout:.0f} 秒内没有写完消息，剩余消息写入溢出文件")
+        for task in (self._flushing, self._task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._flushing = None
+
+        leftover = self._backlog + self._pending
+        while not self.queue.empty():
+            leftover.append(self.queue.get_nowait())
+            self.queue.task_done()
+        self._backlog, self._pending = [], []
+        if leftover:
+            self._spill(leftover)
+
+    async def _drained(self):
+        while self._backlog:
+            await asyncio.sleep(0.05)
+        await self.queue.join()
+
+    def _spill(self, messages: List[Dict]):
+        """追加到溢出文件，下次启动时补写。写文件也失败时只能记录日志"""
+        try:
+            directory = os.path.dirname(self.spill_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for message in messages:
+                    f.write(json.dumps(message, ensure_ascii=False, default=str) + "\n")
+            logger.warning(f"{len(messages)} 条消息未能落库，已写入溢出文件 {self.spill_path}")
+        except OSError as e:
+            ids = [message.get("message_id") for message in messages]
+            logger.error(f"写入溢出文件失败，{len(messages)} 条消息丢失: {ids} {str(e)}")
+
+    def _claim_spill(self) -> List[Dict]:
+        """读取上次溢出的消息。先把文件改名再读，多个worker同时启动时只有一个会补写"""
+        claimed = f"{self.spill_path}.{os.getpid()}"
+        try:
+            os.replace(self.spill_path, claimed)
+        except FileNotFoundError:
+            return []
+        except OSError as e:
+            logger.error(f"读取溢出文件 {self.spill_path} 失败: {str(e)}")
+            return []
+        messages = []
+        with open(claimed, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    messages.append(json.loads(line))
+                except ValueError:
+                    # 写到一半的最后一行
+                    logger.warning("溢出文件中有无法解析的行，已跳过")
+        # 已在内存中：没补写完就关闭时会重新溢出
+        os.remove(claimed)
+        logger.info(f"从溢出文件读取 {len(messages)} 条未落库的消息，开始补写")
+        return messages
@@ -0,0 +1,135 @@
+"""把旧的 chat_records_pair_N 分表数据在线迁移到统一的 chat_messages 表
+
+迁移按主键分批复制，每张表的进度记录在 message_migration_progress 中，
+可以在服务运行期间反复执行：再次运行只会复制上次之后新写入的行。
+目标表对 (pair_id, message_id, from_role) 去重，重复复制不会产生重复消息。
+
+用法:
+    python migrate_messages.py [--batch-size 1000] [--verify] [--drop-legacy]
+"""
+import argparse
+import logging
+import re
+
+from db_manager import DatabaseManager
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LEGACY_TABLE_PATTERN = re.compile(r"^chat_records_pair_(\d+)$")
+
+
+def ensure_progress_table(db):
+    db.execute_query("""
+    CREATE TABLE IF NOT EXISTS message_migration_progress (
+        table_name VARCHAR(64) PRIMARY KEY,
+        last_id BIGINT NOT NULL
+    )""")
+
+
+def get_progress(db, table):
+    _, rows = db.execute_query(
+        "SELECT last_id FROM message_migration_progress WHERE table_name = %s", (table,)
+    )
+    return rows[0][0] if rows else 0
+
+
+def set_progress(db, table, last_id):
+    if db.backend == 'sqlite':
+        query = "INSERT OR REPLACE INTO message_migration_progress (table_name, last_id) VALUES (%s, %s)"
+    else:
+        query = """
+        INSERT INTO message_migration_progress (table_name, last_id) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE last_id = VALUES(last_id)"""
+    db.execute_query(query, (table, last_id))
+
+
+def legacy_tables(db):
+    tables = []
+    for table in db.list_tables("chat_records_pair_%"):
+        match = LEGACY_TABLE_PATTERN.match(table)
+        if match:
+            tables.append((table, int(match.group(1))))
+    return sorted(tables, key=lambda item: item[1])
+
+
+def migrate_table(db, table, pair_id, batch_size):
+    last_id = get_progress(db, table)
+    copied = 0
+    while True:
+        columns, rows = db.execute_query(f"""
+        SELECT id, message_id, from_role, to_role, message_type, message_content, image_data, created_at
+        FROM {table}
+        WHERE id > %s
+        ORDER BY id
+        LIMIT %s
+        """, (last_id, batch_size))
+        if not rows:
+            break
+
+        messages = []
+        for row in rows:
+            record = dict(zip(columns, row))
+            # 以表名中的pair_id为准，旧表的pair_id列可能与表名不一致
+            record["pair_id"] = pair_id
+            messages.append(record)
+        db.save_messages(messages, created_at=True)
+
+        last_id = rows[-1][0]
+        set_progress(db, table, last_id)
+        copied += len(rows)
+    return copied
+
+
+def count_rows(db, query, params=()):
+    _, rows = db.execute_query(query, params)
+    return rows[0][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="迁移 chat_records_pair_N 分表到 chat_messages")
+    parser.add_argument("--batch-size", type=int, default=1000, help="每批复制的行数")
+    parser.add_argument("--verify", action="store_true", help="迁移后核对每个pair的消息条数")
+    parser.add_argument("--drop-legacy", action="store_true", help="核对一致后删除旧表（隐含 --verify）")
+    args = parser.parse_args()
+
+    db = DatabaseManager()
+    try:
+        db.ensure_schema()
+        ensure_progress_table(db)
+
+        tables = legacy_tables(db)
+        logger.info(f"发现 {len(tables)} 张旧聊天记录表")
+        for table, pair_id in tables:
+            copied = migrate_table(db, table, pair_id, args.batch_size)
+            logger.info(f"{table} -> chat_messages: 本次复制 {copied} 行")
+
+        if args.verify or args.drop_legacy:
+            for table, pair_id in tables:
+                legacy_count = count_rows(
+                    db, f"SELECT COUNT(DISTINCT message_id, from_role) FROM {table}"
+                    if db.backend != 'sqlite' else
+                    f"SELECT COUNT(*) FROM (SELECT DISTINCT message_id, from_role FROM {table})"
+                )
+                new_count = count_rows(
+                    db, "SELECT COUNT(*) FROM chat_messages WHERE pair_id = %s", (pair_id,)
+                )
+                if new_count < legacy_count:
+                    logger.error(f"{table} 核对失败: 旧表 {legacy_count} 条, 新表 {new_count} 条")
+                    continue
+                logger.info(f"{table} 核对通过: {legacy_count} 条")
+                if args.drop_legacy:
+                    db.execute_query(f"DROP TABLE {table}")
+                    db.execute_query(
+                        "DELETE FROM message_migration_progress WHERE table_name = %s", (table,)
+                    )
+                    logger.info(f"已删除旧表 {table}")
+    except Exception as e:
+        logger.error(f"迁移失败: {e}")
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Callable, Dict, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 优先级：交互式翻译 > 预取 > 后台任务（标签生成、摘要刷新）。数值越小越先调度
+PRIORITIES = {"interactive": 0, "prefetch": 1, "background": 2}
+PRIORITY_NAMES = {value: name for name, value in PRIORITIES.items()}
+
+# 这些状态码视为暂时性错误，退避后重试；429 同时让该模型的所有调用一起放慢
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+MODEL_CALL_SECONDS = metrics.histogram("model_call_seconds", "大模型调用耗时（秒，不含排队）", ["model", "analyzer"])
+MODEL_QUEUE_SECONDS = metrics.histogram("model_queue_seconds", "大模型调用排队耗时（秒）", ["model", "priority"])
+MODEL_CALLS = metrics.counter("model_calls_total", "大模型调用次数", ["model", "analyzer", "status"])
+
+
+class ModelBusyError(Exception):
+    """在截止时间前没有排上模型调用，或限流重试用尽"""
+
+
+def parse_model_limits(value: str, cast=int) -> Dict[str, int]:
+    """解析形如 "qwen-max=8,qwen-vl-plus=4" 的按模型配置"""
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        model, limit = item.split("=", 1)
+        try:
+            limits[model.strip()] = max(cast(1), cast(limit))
+        except ValueError:
+            logger.warning(f"忽略无效的模型配置: {item}")
+    return limits
+
+
+class _Ticket:
+    """一次排队中的调用；合并后的多个调用方共用一个 ticket，优先级和截止时间取最宽松的一方"""
+
+    def __init__(self, future: asyncio.Future, priority: int, deadline: Optional[float]):
+        self.future = future
+        self.priority = priority
+        self.deadline = deadline
+
+
+class _ModelLane:
+    """单个模型的调度队列：并发上限 + 令牌桶限速，按优先级（同级先来先服务）放行"""
+
+    def __init__(self, model: str, limit: int, rate: float, burst: float):
+        self.model = model
+        self.limit = limit
+        self.rate = rate / 60  # 配置按每分钟请求数，与平台配额的单位一致
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.active = 0
+        self._waiting = []
+        self._order = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, ticket in self._waiting if not ticket.future.done())
+
+    def push(self, ticket: _Ticket):
+        heapq.heappush(self._waiting, (ticket.priority, next(self._order), ticket))
+        self._dispatch()
+
+    def promote(self, ticket: _Ticket, priority: int):
+        # 重复入堆即可，先被放行的那一项生效，其余的在出堆时跳过
+        if priority < ticket.priority and not ticket.future.done():
+            ticket.priority = priority
+            self.push(ticket)
+
+    def release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def throttle(self, delay: float):
+        """上游返回429：清空令牌并暂停放行一段时间"""
+        self.tokens = 0
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self._dispatch()
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiting and self.active < self.limit:
+            ticket = self._waiting[0][2]
+            if ticket.future.done():
+                heapq.heappop(self._waiting)
+                continue
+            now = time.monotonic()
+            self._refill(now)
+            wait = self.paused_until - now
+            if self.rate > 0 and self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            if self.rate > 0:
+                self.tokens -= 1
+            heapq.heappop(self._waiting)
+            self.active += 1
+            ticket.future.set_result(None)
+
+    async def acquire(self, ticket: _Ticket):
+        """等待放行；截止时间到了仍未放行时放弃排队，抛出 ModelBusyError"""
+        with MODEL_QUEUE_SECONDS.time(model=self.model, priority=PRIORITY_NAMES[ticket.priority]):
+            await self._acquire(ticket)
+
+    async def _acquire(self, ticket: _Ticket):
+        self.push(ticket)
+        while True:
+            timeout = None if ticket.deadline is None else ticket.deadline - time.monotonic()
+            try:
+                if timeout is not None and timeout <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(asyncio.shield(ticket.future), timeout)
+                return
+            except asyncio.TimeoutError:
+                # 入队时或超时的同一轮里已经放行：名额已占用，照常调用，否则名额永远不会归还
+                if ticket.future.done() and not ticket.future.cancelled():
+                    return
+                # 合并进来的调用方可能延长了截止时间
+                if ticket.deadline is not None and ticket.deadline <= time.monotonic():
+                    ticket.future.cancel()
+                    raise ModelBusyError(f"模型 {self.model} 繁忙，请稍后重试")
+            except asyncio.CancelledError:
+                if ticket.future.done() and not ticket.future.cancelled():
+                    self.release()
+                else:
+                    ticket.future.cancel()
+                raise
+
+
+class _Shared:
+    def __init__(self, ticket: _Ticket, lane: _ModelLane, analyzer: str):
+        self.ticket = ticket
+        self.lane = lane
+        self.analyzer = analyzer
+        self.task: Optional[asyncio.Task] = None
+        self.callers = 0
+
+
+class ModelCallRunner:
+    """统一调度所有大模型调用，同步SDK在独立线程池中执行，避免阻塞事件循环
+
+    - 每个模型一个队列，限制并发数（MODEL_CONCURRENCY）和每分钟请求数（MODEL_RATE_LIMITS，令牌桶），
+      名额按优先级放行，交互式翻译总是排在预取和后台任务之前；
+    - 相同的并发请求（同一模型、同样的参数）只调用一次模型，结果共享；
+    - 截止时间只约束排队和重试退避：到期仍未开始的调用直接放弃，已经发出的调用不中断
+      （同步SDK无法打断，结果照样计费）；
+    - 上游返回429或5xx时按指数退避加抖动重试，429 还会让该模型的队列暂停放行一段时间。
+    """
+
+    def __init__(self, default_limit: int = None, limits: Dict[str, int] = None, max_workers: int = None,
+                 default_rate: float = None, rates: Dict[str, float] = None):
+        self.default_limit = default_limit or int(os.getenv("MODEL_MAX_CONCURRENCY", "8"))
+        self.limits = limits if limits is not None else parse_model_limits(os.getenv("MODEL_CONCURRENCY", ""))
+        # 每分钟请求数，0 表示不限速；令牌桶容量默认等于并发上限
+        self.default_rate = default_rate if default_rate is not None else float(os.getenv("MODEL_RATE_LIMIT", "0"))
+        self.rates = rates if rates is not None else parse_model_limits(os.getenv("MODEL_RATE_LIMITS", ""), float)
+        self.burst = float(os.getenv("MODEL_RATE_BURST", "0"))
+        self.deadlines = {
+            "interactive": float(os.getenv("MODEL_DEADLINE_INTERACTIVE", "30")),
+            "prefetch": float(os.getenv("MODEL_DEADLINE_PREFETCH", "120")),
+            "background": float(os.getenv("MODEL_DEADLINE_BACKGROUND", "600")),
+        }
+        self.max_retries = int(os.getenv("MODEL_RETRY_MAX", "3"))
+        self.retry_base = float(os.getenv("MODEL_RETRY_BASE", "0.5"))
+        self.retry_max_delay = float(os.getenv("MODEL_RETRY_MAX_DELAY", "8"))
+        self.max_workers = max_workers or int(os.getenv("MODEL_EXECUTOR_WORKERS", "32"))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="model-call")
+        self._lanes: Dict[str, _ModelLane] = {}
+        self._inflight: Dict[str, _Shared] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.throttled = 0
+        self.expired = 0
+
+    def get_limit(self, model: str) -> int:
+        return self.limits.get(model, self.default_limit)
+
+    def _lane(self, model: str) -> _ModelLane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            limit = self.get_limit(model)
+            lane = _ModelLane(model, limit, self.rates.get(model, self.default_rate), self.burst or limit)
+            self._lanes[model] = lane
+        return lane
+
+    def _ticket(self, priority: str, deadline: Optional[float]) -> _Ticket:
+        if priority not in PRIORITIES:
+            raise ValueError(f"未知的调用优先级: {priority}")
+        if deadline is None:
+            deadline = self.deadlines[priority]
+        future = asyncio.get_running_loop().create_future()
+        return _Ticket(future, PRIORITIES[priority], time.monotonic() + deadline)
+
+    def _backoff(self, attempt: int) -> float:
+        return min(self.retry_max_delay, self.retry_base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def _should_retry(self, lane: _ModelLane, ticket: _Ticket, status, attempt: int) -> Optional[float]:
+        """返回退避时间；不重试时返回 None"""
+        if status not in RETRY_STATUS:
+            return None
+        delay = self._backoff(attempt)
+        if status == 429:
+            self.throttled += 1
+            lane.throttle(delay)
+        if attempt >= self.max_retries or time.monotonic() + delay > ticket.deadline:
+            if status == 429:
+                raise ModelBusyError(f"模型 {lane.model} 限流，请稍后重试")
+            return None
+        self.retries += 1
+        logger.warning(f"模型 {lane.model} 返回 {status}，{delay:.1f} 秒后重试")
+        return delay
+
+    @staticmethod
+    def _coalesce_key(model: str, func: Callable, args, kwargs) -> Optional[str]:
+        try:
+            payload = json.dumps([model, getattr(func, "__qualname__", repr(func)), args, kwargs],
+                                 sort_keys=True, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def run(self, model: str, func: Callable, /, *args, priority: str = "interactive",
+                  deadline: Optional[float] = None, coalesce: bool = True, analyzer: str = "other", **kwargs):
+        """调度一次同步调用。deadline 为排队的最长秒数，默认按优先级取 MODEL_DEADLINE_*；analyzer 只用于指标"""
+        key = self._coalesce_key(model, func, args, kwargs) if coalesce else None
+        shared = self._inflight.get(key) if key is not None else None
+        if shared is None:
+            lane = self._lane(model)
+            shared = _Shared(self._ticket(priority, deadline), lane, analyzer)
+            shared.task = asyncio.create_task(self._execute(shared, func, args, kwargs))
+            if key is not None:
+                self._inflight[key] = shared
+                shared.task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+            ticket = self._ticket(priority, deadline)
+            shared.ticket.deadline = max(shared.ticket.deadline, ticket.deadline)
+            shared.lane.promote(shared.ticket, ticket.priority)
+
+        shared.callers += 1
+        try:
+            return await asyncio.shield(shared.task)
+        except asyncio.CancelledError:
+            # 所有调用方都放弃了才取消共享的调用
+            shared.callers -= 1
+            if shared.callers == 0:
+                shared.task.cancel()
+            raise
+
+    async def _execute(self, shared: _Shared, func: Callable, args, kwargs):
+        lane, ticket = shared.lane, shared.ticket
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            try:
+                await lane.acquire(ticket)
+            except ModelBusyError:
+                self.expired += 1
+                raise
+            self.calls += 1
+            started = time.perf_counter()
+            future = loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 线程里的同步调用无法中断，等它结束后再归还名额
+                future.add_done_callback(lambda _: lane.release())
+                raise
+            except BaseException:
+                lane.release()
+                MODEL_CALLS.inc(model=lane.model, analyzer=shared.analyzer, status="error")
+                raise
+            lane.release()
+            status = getattr(result, "status_code", None)
+            MODEL_CALL_SECONDS.observe(time.perf_counter() - started, model=lane.model, analyzer=shared.analyzer)
+            MODEL_CALLS.inc(model=lane.model, analyzer=shared.analyzer, status=status)
+
+            delay = self._should_retry(lane, ticket, status, attempt)
+            if delay is None:
+                return result
+            await asyncio.sleep(delay)
+            attempt += 1
+            ticket.future = loop.create_future()
+
+    async def stream(self, model: str, func: Callable, /, *args, priority: str = "interactive",
+                     deadline: Optional[float] = None, analyzer: str = "other", **kwargs) -> AsyncIterator:
+        """在线程池中迭代SDK返回的同步流式生成器，把每个结果转交给事件循环。
+
+        流式调用不参与合并；第一个分片就是可重试的错误时退避后重新发起。
+        调用方停止迭代（例如客户端断开或请求被取消）时，后台线程在下一个分片到达后停止读取并关闭上游流。
+        """
+        loop = asyncio.get_running_loop()
+        lane = self._lane(model)
+        ticket = self._ticket(priority, deadline)
+        attempt = 0
+        while True:
+            queue: asyncio.Queue = asyncio.Queue()
+            stopped = threading.Event()
+            finished = object()
+
+            def produce():
+                results = None
+                try:
+                    results = func(*args, **kwargs)
+                    for item in results:
+                        if stopped.is_set():
+                            break
+                        loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+                except Exception as e:
+                    loop.call_soon_threadsafe(queue.put_nowait, (finished, e))
+                    return
+                finally:
+                    if hasattr(results, "close"):
+                        results.close()
+                loop.call_soon_threadsafe(queue.put_nowait, (finished, None))
+
+            try:
+                await lane.acquire(ticket)
+            except ModelBusyError:
+                self.expired += 1
+                raise
+            self.calls += 1
+            started = time.perf_counter()
+            status = None
+            producer = loop.run_in_executor(self.executor, produce)
+            delay = None
+            try:
+                first = True
+                while True:
+                    item, error = await queue.get()
+                    if item is finished:
+                        if error is not None:
+                            raise error
+                        break
+                    if first:
+                        first = False
+                        status = getattr(item, "status_code", None)
+                        delay = self._should_retry(lane, ticket, status, attempt)
+                        if delay is not None:
+                            break
+                    yield item
+            finally:
+                stopped.set()
+                # 等后台线程退出后再释放并发名额
+                try:
+                    await producer
+                except Exception:
+                    pass
+                lane.release()
+                MODEL_CALL_SECONDS.observe(time.perf_counter() - started, model=lane.model, analyzer=analyzer)
+                MODEL_CALLS.inc(model=lane.model, analyzer=analyzer, status=status or "error")
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
+            attempt += 1
+            ticket.future = loop.create_future()
+
+    def stats(self) -> Dict:
+        return {
+            "model_calls": self.calls,
+            "model_coalesced": self.coalesced,
+            "model_retries": self.retries,
+            "model_throttled": self.throttled,
+            "model_expired": self.expired,
+            "models": {
+                model: {"active": lane.active, "queued": lane.queued, "limit": lane.limit,
+                        "rate_per_minute": lane.rate * 60}
+                for model, lane in self._lanes.items()
+            },
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
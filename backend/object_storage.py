@@ -0,0 +1,198 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from types import SimpleNamespace
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 健康检查时查询的对象名，不需要真实存在
+HEALTH_CHECK_KEY = "health-check"
+
+OSS_UPLOAD_SECONDS = metrics.histogram("oss_upload_seconds", "对象存储上传耗时（秒）", ["mode"])
+
+
+class LocalBucket:
+    """阿里云 OSS Bucket 的本地目录替身，实现上传和读取用到的接口子集，便于本地开发和压测"""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.upload_root = os.path.join(self.root, ".multipart")
+        os.makedirs(self.upload_root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"非法的对象名: {key}")
+        return path
+
+    def _write(self, path: str, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+        os.replace(tmp_path, path)
+
+    def put_object(self, key: str, data, headers=None):
+        self._write(self._path(key), data)
+        return SimpleNamespace(status=200)
+
+    def object_exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def get_object(self, key: str):
+        try:
+            return open(self._path(key), "rb")
+        except FileNotFoundError:
+            import oss2
+            raise oss2.exceptions.NoSuchKey(404, {}, b"", {})
+
+    def delete_object(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+        return SimpleNamespace(status=204)
+
+    def init_multipart_upload(self, key: str):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.upload_root, upload_id))
+        return SimpleNamespace(status=200, upload_id=upload_id)
+
+    def upload_part(self, key: str, upload_id: str, part_number: int, data):
+        data = data if isinstance(data, (bytes, bytearray)) else data.read()
+        self._write(os.path.join(self.upload_root, upload_id, str(part_number)), data)
+        return SimpleNamespace(status=200, etag=hashlib.md5(data).hexdigest().upper())
+
+    def complete_multipart_upload(self, key: str, upload_id: str, parts):
+        part_dir = os.path.join(self.upload_root, upload_id)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{upload_id}.tmp"
+        with open(tmp_path, "wb") as out:
+            for part in sorted(parts, key=lambda p: p.part_number):
+                with open(os.path.join(part_dir, str(part.part_number)), "rb") as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(tmp_path, path)
+        shutil.rmtree(part_dir, ignore_errors=True)
+        return SimpleNamespace(status=200)
+
+    def abort_multipart_upload(self, key: str, upload_id: str):
+        shutil.rmtree(os.path.join(self.upload_root, upload_id), ignore_errors=True)
+        return SimpleNamespace(status=204)
+
+
+class ImageStorage:
+    """对象存储封装：所有 OSS 调用都在独立线程池中执行，大文件走分片上传"""
+
+    def __init__(self, bucket, base_url: str, multipart_threshold: int = None, part_size: int = None,
+                 max_workers: int = None):
+        self.bucket = bucket
+        self.base_url = base_url.rstrip("/")
+        self.multipart_threshold = multipart_threshold or int(os.getenv("OSS_MULTIPART_THRESHOLD", str(5 * 1024 * 1024)))
+        # OSS 要求除最后一片外每片至少100KB
+        self.part_size = max(part_size or int(os.getenv("OSS_PART_SIZE", str(1024 * 1024))), 100 * 1024)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv("OSS_UPLOAD_WORKERS", "8")),
+            thread_name_prefix="oss",
+        )
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def public_url(self, key: str) -> str:
+        return f"{self.base_url}/{key}"
+
+    async def exists(self, key: str) -> bool:
+        return await self._run(self.bucket.object_exists, key)
+
+    async def put_file(self, key: str, fileobj, size: int):
+        """上传文件对象。fileobj 需已定位到开头，上传在线程池中按块读取，不整体载入内存"""
+        if size > self.multipart_threshold:
+            with OSS_UPLOAD_SECONDS.time(mode="multipart"):
+                await self._run(self._multipart_upload, key, fileobj)
+        else:
+            with OSS_UPLOAD_SECONDS.time(mode="single"):
+                result = await self._run(self.bucket.put_object, key, fileobj)
+            if result.status != 200:
+                raise Exception(f"上传到 OSS 失败，状态码: {result.status}")
+
+    def _multipart_upload(self, key: str, fileobj):
+        from oss2.models import PartInfo
+
+        upload_id = self.bucket.init_multipart_upload(key).upload_id
+        try:
+            parts = []
+            part_number = 1
+            while True:
+                data = fileobj.read(self.part_size)
+                if not data:
+                    break
+                result = self.bucket.upload_part(key, upload_id, part_number, data)
+                parts.append(PartInfo(part_number, result.etag))
+                part_number += 1
+            self.bucket.complete_multipart_upload(key, upload_id, parts)
+        except Exception:
+            self.bucket.abort_multipart_upload(key, upload_id)
+            raise
+
+    async def check(self):
+        """健康检查：能访问存储桶即可，对象本身不必存在"""
+        await self.exists(HEALTH_CHECK_KEY)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def local_storage_root():
+    """OSS_BACKEND=local 时本地存储目录的绝对路径，否则为 None"""
+    if os.getenv("OSS_BACKEND", "oss").lower() != "local":
+        return None
+    return os.path.abspath(os.getenv("OSS_LOCAL_DIR", os.path.join("data", "oss")))
+
+
+def create_image_storage() -> ImageStorage:
+    """根据环境变量创建对象存储。OSS_BACKEND=local 时使用本地目录（OSS_LOCAL_DIR）代替阿里云 OSS"""
+    root = local_storage_root()
+    if root is not None:
+        base_url = os.getenv("OSS_LOCAL_BASE_URL", "http://localhost:8000/oss")
+        return ImageStorage(LocalBucket(root), base_url)
+
+    bucket, bucket_name, endpoint = _oss_bucket(os.getenv("ALIYUN_OSS_BUCKET_NAME"))
+    return ImageStorage(bucket, f"https://{bucket_name}.{endpoint}")
+
+
+def create_archive_bucket():
+    """聊天记录归档用的存储桶。OSS_BACKEND=local 时使用单独的本地目录（HISTORY_ARCHIVE_LOCAL_DIR），
+    不放在对外提供访问的图片目录下；阿里云 OSS 默认与图片同一个桶（HISTORY_ARCHIVE_BUCKET 可另配），对象设为私有"""
+    if local_storage_root() is not None:
+        return LocalBucket(os.getenv("HISTORY_ARCHIVE_LOCAL_DIR", os.path.join("data", "history")))
+    bucket, _, _ = _oss_bucket(os.getenv("HISTORY_ARCHIVE_BUCKET") or os.getenv("ALIYUN_OSS_BUCKET_NAME"))
+    return bucket
+
+
+def _oss_bucket(bucket_name: str):
+    # 从环境变量中获取阿里云 OSS 配置信息
+    access_key_id = os.getenv("ALIYUN_ACCESS_KEY_ID")
+    access_key_secret = os.getenv("ALIYUN_ACCESS_KEY_SECRET")
+    endpoint = os.getenv("ALIYUN_OSS_ENDPOINT")
+
+    # 检查环境变量是否存在
+    if not access_key_id or not access_key_secret or not endpoint or not bucket_name:
+        raise ValueError("阿里云 OSS 配置信息缺失，请检查 .env 文件")
+
+    # oss2 导入较慢，只在真正使用阿里云 OSS 时导入
+    import oss2
+
+    auth = oss2.Auth(access_key_id, access_key_secret)
+    return oss2.Bucket(auth, endpoint, bucket_name), bucket_name, endpoint
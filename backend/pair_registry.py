@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# 配对变更时各worker互相通知失效的频道
+REGISTRY_CHANNEL = "pair_registry"
+# 会被转发和保存的聊天帧类型
+CHAT_FRAME_TYPES = ("text", "emoji", "image")
+
+
+class PairMember(NamedTuple):
+    pair_id: int
+    role: str
+    partner: str
+
+
+class PairRegistry:
+    """客户端ID → 配对、角色、对方ID 的注册表，以 users 表为准，内存中做LRU缓存
+
+    查询在内存中是一次字典查找；未命中时查库（主键查询），同一ID的并发查询合并成一次。
+    未注册的ID短时间缓存为不存在，避免无效连接反复查库。配对创建或删除后本worker立即失效，
+    并通过消息代理通知其他worker。
+    """
+
+    def __init__(self, db, broker=None, max_entries: int = None, negative_ttl: float = None):
+        self.db = db
+        self.broker = broker
+        self.max_entries = max_entries or int(os.getenv("PAIR_REGISTRY_CACHE_SIZE", "200000"))
+        self.negative_ttl = negative_ttl if negative_ttl is not None else float(
+            os.getenv("PAIR_REGISTRY_NEGATIVE_TTL", "5"))
+        self._members: "OrderedDict[str, PairMember]" = OrderedDict()
+        self._unknown: Dict[str, float] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.rejected_frames = 0
+
+    async def start(self):
+        if self.broker is not None:
+            await self.broker.subscribe(REGISTRY_CHANNEL, self._on_invalidate)
+
+    async def _on_invalidate(self, message: Dict):
+        self._forget(message.get("client_ids") or [])
+
+    def _forget(self, client_ids: Iterable[str]):
+        for client_id in client_ids:
+            self._members.pop(client_id, None)
+            self._unknown.pop(client_id, None)
+
+    async def invalidate(self, client_ids: Iterable[str]):
+        client_ids = list(client_ids)
+        self._forget(client_ids)
+        if self.broker is not None:
+            try:
+                await self.broker.publish(REGISTRY_CHANNEL, {"client_ids": client_ids})
+            except ConnectionError as e:
+                # 其他worker上的不存在缓存最多 negative_ttl 秒后过期
+                logger.warning(f"[配对] 通知其他worker失效失败: {str(e)}")
+
+    async def lookup(self, client_id: str) -> Optional[PairMember]:
+        member = self._members.get(client_id)
+        if member is not None:
+            self._members.move_to_end(client_id)
+            self.hits += 1
+            return member
+        expires = self._unknown.get(client_id)
+        if expires is not None:
+            if expires > time.monotonic():
+                self.hits += 1
+                return None
+            del self._unknown[client_id]
+
+        pending = self._pending.get(client_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[client_id] = future
+        try:
+            row = await self.db.get_pair_member(client_id)
+            member = PairMember(int(row["pair_id"]), row["role"], row["partner"]) if row else None
+            if member is None:
+                self._unknown[client_id] = time.monotonic() + self.negative_ttl
+            else:
+                self._members[client_id] = member
+                while len(self._members) > self.max_entries:
+                    self._members.popitem(last=False)
+            future.set_result(member)
+            return member
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            del self._pending[client_id]
+
+    def validate_frame(self, client_id: str, member: PairMember, data: Dict):
+        """聊天帧只能由本人发给配对中的对方，pair_id 必须是自己的配对；不合法时抛出 ValueError"""
+        if data.get("type") not in CHAT_FRAME_TYPES:
+            raise ValueError(f"未知的帧类型: {data.get('type')}")
+        if data.get("from") != client_id:
+            raise ValueError(f"发送方 {data.get('from')} 与连接用户 {client_id} 不一致")
+        if data.get("to") != member.partner:
+            raise ValueError(f"接收方 {data.get('to')} 不在配对 {member.pair_id} 中")
+        try:
+            pair_id = int(data.get("pair_id"))
+        except (TypeError, ValueError):
+            raise ValueError(f"无效的 pair_id: {data.get('pair_id')}")
+        if pair_id != member.pair_id:
+            raise ValueError(f"{client_id} 不属于配对 {pair_id}")
+
+    async def create_pair(self, pair_id: int = None) -> Dict:
+        pair = await self.db.create_pair(pair_id)
+        # 新用户可能刚被缓存为不存在
+        await self.invalidate([pair["elder_id"], pair["young_id"]])
+        logger.info(f"[配对] 已创建配对 {pair['pair_id']}: {pair['elder_id']} / {pair['young_id']}")
+        return pair
+
+    async def delete_pair(self, pair_id: int) -> bool:
+        members = await self.db.get_pair_members(pair_id)
+        existed = await self.db.delete_pair(pair_id)
+        await self.invalidate(member["id"] for member in members)
+        if existed:
+            logger.info(f"[配对] 已删除配对 {pair_id}")
+        return existed
+
+    def stats(self) -> Dict:
+        return {
+            "registry_cached": len(self._members),
+            "registry_unknown_cached": len(self._unknown),
+            "registry_hits": self.hits,
+            "registry_misses": self.misses,
+            "registry_rejected_frames": self.rejected_frames,
+        }
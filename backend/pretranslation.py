@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from analysis_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# 至少包含一个文字或数字（汉字也算），否则视为纯表情/标点，不值得翻译
+WORD_PATTERN = re.compile(r"[^\W_]")
+
+Translate = Callable[[Dict], Awaitable[Optional[str]]]
+Deliver = Callable[[str, Dict], Awaitable[None]]
+
+
+def content_hash(content: str, role: str) -> str:
+    """被翻译内容（文本或图片地址）和分析角色的哈希，查询时据此确认结果对应的是同一段内容"""
+    payload = json.dumps([normalize_text(content), role], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Pretranslator:
+    """为长辈预先翻译收到的消息：消息投递时在后台以预取优先级分析，结果保存并推送给长辈
+
+    按配对开启（默认关闭）。为控制费用，每个配对每小时最多预翻译 max_per_hour 条，
+    过短或只有表情符号的文本直接跳过。计数在本worker内统计：一个配对的消息由发送方所在的
+    worker 处理，通常就是同一个worker。
+    """
+
+    def __init__(self, db, translate: Translate, max_per_hour: int = None, min_chars: int = None,
+                 settings_ttl: float = None, max_pairs: int = None):
+        self.db = db
+        self.translate = translate
+        self.max_per_hour = max_per_hour or int(os.getenv("PRETRANSLATE_MAX_PER_HOUR", "60"))
+        self.min_chars = min_chars or int(os.getenv("PRETRANSLATE_MIN_CHARS", "4"))
+        self.default_enabled = os.getenv("PRETRANSLATE_DEFAULT", "0") == "1"
+        self.settings_ttl = settings_ttl or float(os.getenv("PRETRANSLATE_SETTINGS_TTL", "30"))
+        self.max_pairs = max_pairs or int(os.getenv("PRETRANSLATE_CACHE_PAIRS", "10000"))
+        self._settings: "OrderedDict[int, Tuple[bool, float]]" = OrderedDict()
+        self._usage: "OrderedDict[int, deque]" = OrderedDict()
+        self._tasks = set()
+        self.submitted = 0
+        self.completed = 0
+        self.skipped = 0
+        self.over_budget = 0
+        self.failures = 0
+
+    async def enabled(self, pair_id: int) -> bool:
+        cached = self._settings.get(pair_id)
+        if cached is not None and time.monotonic() - cached[1] < self.settings_ttl:
+            return cached[0]
+        enabled = await self.db.get_pretranslate(pair_id)
+        if enabled is None:
+            enabled = self.default_enabled
+        self._settings[pair_id] = (enabled, time.monotonic())
+        self._settings.move_to_end(pair_id)
+        while len(self._settings) > self.max_pairs:
+            self._settings.popitem(last=False)
+        return enabled
+
+    async def set_enabled(self, pair_id: int, enabled: bool):
+        await self.db.set_pretranslate(pair_id, enabled)
+        self._settings[pair_id] = (enabled, time.monotonic())
+
+    def worth_translating(self, message: Dict) -> bool:
+        if message.get("type") in ("image", "emoji"):
+            return bool(message.get("image_data"))
+        text = (message.get("message") or "").strip()
+        return len(text) >= self.min_chars and WORD_PATTERN.search(text) is not None
+
+    def _take_budget(self, pair_id: int) -> bool:
+        now = time.monotonic()
+        usage = self._usage.get(pair_id)
+        if usage is None:
+            usage = self._usage[pair_id] = deque()
+        self._usage.move_to_end(pair_id)
+        while len(self._usage) > self.max_pairs:
+            self._usage.popitem(last=False)
+        while usage and now - usage[0] >= 3600:
+            usage.popleft()
+        if len(usage) >= self.max_per_hour:
+            return False
+        usage.append(now)
+        return True
+
+    def submit(self, message: Dict, deliver: Deliver):
+        """消息投递给长辈时调用，不阻塞消息转发"""
+        task = asyncio.create_task(self._run(message, deliver))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, message: Dict, deliver: Deliver):
+        pair_id = int(message["pair_id"])
+        try:
+            if not await self.enabled(pair_id):
+                return
+            if not self.worth_translating(message):
+                self.skipped += 1
+                return
+            if not self._take_budget(pair_id):
+                self.over_budget += 1
+                return
+            self.submitted += 1
+            analysis = await self.translate(message)
+            if not analysis:
+                return
+            content = message.get("image_data") if message.get("type") in ("image", "emoji") else message.get("message")
+            await self.db.save_analysis(pair_id, message["id"], "elder", analysis, content_hash(content, "elder"))
+            await deliver(message["to"], {"type": "pretranslation", "message_id": message["id"], "analysis": analysis})
+            self.completed += 1
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"预翻译消息 {message.get('id')} 失败: {str(e)}")
+
+    async def lookup(self, pair_id: Optional[int], message_id: Optional[int], role: str,
+                     content: str) -> Optional[str]:
+        """点击分析时先查预翻译结果，只有保存时的内容和这次要分析的内容一致才返回"""
+        if pair_id is None or message_id is None:
+            return None
+        try:
+            return await self.db.get_analysis(int(pair_id), int(message_id), role, content_hash(content, role))
+        except Exception as e:
+            logger.warning(f"查询预翻译结果失败: {str(e)}")
+            return None
+
+    def stats(self) -> Dict:
+        return {
+            "pretranslate_submitted": self.submitted,
+            "pretranslate_completed": self.completed,
+            "pretranslate_skipped": self.skipped,
+            "pretranslate_over_budget": self.over_budget,
+            "pretranslate_failures": self.failures,
+            "pretranslate_running": len(self._tasks),
+        }
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
@@ -0,0 +1,249 @@
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceUnavailableError(RuntimeError):
+    """依赖还没创建好（预热中或上次创建失败），已在后台创建，稍后重试即可"""
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class _Service:
+    __slots__ = ("name", "factory", "start", "close", "check", "warm", "required", "instance", "started", "error",
+                 "lock", "start_lock", "task")
+
+    def __init__(self, name, factory, start, close, check, warm, required):
+        self.name = name
+        self.factory = factory
+        self.start = start
+        self.close = close
+        self.check = check
+        self.warm = warm
+        self.required = required
+        self.instance = None
+        # 没有 start 的依赖创建后即可用；有 start 的要等 start 成功后才算可用
+        self.started = start is None
+        self.error: Optional[str] = None
+        self.lock = threading.Lock()
+        self.start_lock = asyncio.Lock()
+        # 后台创建并启动的任务（预热或重试）
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.instance is not None and self.started
+
+
+class LazyService:
+    """依赖的占位对象：实例创建后访问属性直接转发。调用方照常写 db.get_messages(...)
+
+    实例在线程池中创建（预热或 aget），事件循环线程上从不同步执行工厂函数，也不等待创建锁：
+    实例还没创建时访问属性会在后台发起创建，并抛出 ServiceUnavailableError（接口返回503）。
+    不在事件循环中的线程（例如数据库线程池）仍然直接同步创建。
+    有 start 的依赖在 start 成功前，访问到的异步方法会先完成（或重试）start 再调用，
+    例如预热失败后第一次 await message_writer.enqueue(...) 会先启动后台写入任务。
+    """
+
+    __slots__ = ("_container", "_name", "_service")
+
+    def __init__(self, container: "ServiceContainer", name: str):
+        object.__setattr__(self, "_container", container)
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_service", container._services[name])
+
+    def _instance(self):
+        instance = self._service.instance
+        if instance is not None:
+            return instance
+        if _on_event_loop():
+            self._container.warm(self._name)
+            raise ServiceUnavailableError(f"依赖 {self._name} 正在初始化，请稍后重试")
+        return self._container.get(self._name)
+
+    def __getattr__(self, attr):
+        service = self._service
+        if service.ready:
+            return getattr(service.instance, attr)
+        container, name = self._container, self._name
+        value = getattr(self._instance(), attr)
+        if service.ready:
+            return value
+        if not inspect.iscoroutinefunction(value):
+            return value
+
+        @functools.wraps(value)
+        async def call_after_start(*args, **kwargs):
+            started = await container.aget(name)
+            return await getattr(started, attr)(*args, **kwargs)
+
+        return call_after_start
+
+    def __setattr__(self, attr, value):
+        setattr(self._instance(), attr, value)
+
+    def __repr__(self):
+        return f"<LazyService {self._name}>"
+
+
+class ServiceContainer:
+    """应用依赖的容器：导入 main 时只登记工厂，不连接任何后端
+
+    依赖在线程池中创建（加锁，只创建一次），有 start 的依赖由 aget 在创建后执行 start，
+    start 成功后才算可用，失败时下次使用再试。lifespan 启动时并行预热 warm=True 的依赖，
+    最多等待 SERVICE_WARMUP_TIMEOUT 秒，没完成的在后台继续；预热失败只记录日志，不阻止worker启动，
+    首次使用时在后台再试，在此之前使用它的请求得到 ServiceUnavailableError。关闭时按登记的逆序释放已创建的依赖。/health 逐个调用依赖的检查函数。
+    """
+
+    def __init__(self, warmup_timeout: float = None, check_timeout: float = None):
+        self.warmup_timeout = warmup_timeout if warmup_timeout is not None else float(
+            os.getenv("SERVICE_WARMUP_TIMEOUT", "10"))
+        self.check_timeout = check_timeout or float(os.getenv("HEALTH_CHECK_TIMEOUT", "2"))
+        self._services: Dict[str, _Service] = {}
+        self._warming: set = set()
+
+    def register(self, name: str, factory: Callable[[], Any], start: Callable = None, close: Callable = None,
+                 check: Callable = None, warm: bool = True, required: bool = False) -> LazyService:
+        """登记依赖，返回占位对象。start 在事件循环中、创建后执行一次；close 和 check 可以是同步或异步函数，
+        check 抛出异常即视为不可用，返回的字典并入健康报告。required 的依赖不可用时 /health 返回503"""
+        self._services[name] = _Service(name, factory, start, close, check, warm, required)
+        return LazyService(self, name)
+
+    def get(self, name: str):
+        service = self._services[name]
+        if service.instance is not None:
+            return service.instance
+        with service.lock:
+            if service.instance is None:
+                started = time.perf_counter()
+                try:
+                    service.instance = service.factory()
+                except Exception as e:
+                    service.error = str(e)
+                    raise
+                service.error = None
+                logger.info(f"[服务] {name} 已创建，耗时 {(time.perf_counter() - started) * 1000:.0f}ms")
+        return service.instance
+
+    def created(self, name: str) -> bool:
+        return self._services[name].instance is not None
+
+    def ready(self, name: str) -> bool:
+        return self._services[name].ready
+
+    async def aget(self, name: str):
+        """创建（在线程池中）并启动依赖，返回可用的实例。start 失败时抛出异常，下次调用会重试"""
+        service = self._services[name]
+        if service.ready:
+            return service.instance
+        instance = service.instance
+        if instance is None:
+            instance = await asyncio.to_thread(self.get, name)
+        async with service.start_lock:
+            if not service.started:
+                try:
+                    await _maybe_await(service.start(instance))
+                except Exception as e:
+                    service.error = str(e)
+                    raise
+                service.started = True
+                service.error = None
+                logger.info(f"[服务] {name} 已启动")
+        return instance
+
+    async def _warm_up(self, service: _Service):
+        try:
+            await self.aget(service.name)
+        except Exception as e:
+            service.error = str(e)
+            logger.error(f"[服务] {service.name} 预热失败: {str(e)}")
+
+    def warm(self, name: str) -> asyncio.Task:
+        """在后台创建并启动依赖，已经在进行中时不重复发起"""
+        service = self._services[name]
+        if service.task is None or service.task.done():
+            service.task = asyncio.create_task(self._warm_up(service))
+            self._warming.add(service.task)
+            service.task.add_done_callback(self._warming.discard)
+        return service.task
+
+    async def start(self):
+        """lifespan 启动阶段：并行预热，超时后剩余的在后台继续"""
+        started = time.perf_counter()
+        for service in self._services.values():
+            if service.warm:
+                self.warm(service.name)
+        if self._warming:
+            await asyncio.wait(list(self._warming), timeout=self.warmup_timeout)
+        pending = len(self._warming)
+        logger.info(f"[服务] 预热耗时 {(time.perf_counter() - started) * 1000:.0f}ms"
+                    + (f"，{pending} 个依赖在后台继续初始化" if pending else ""))
+
+    async def close(self):
+        for task in list(self._warming):
+            task.cancel()
+        for service in reversed(list(self._services.values())):
+            service.task = None
+            # 没启动成功的依赖没有需要释放的后台任务或连接
+            if not service.ready or service.close is None:
+                continue
+            try:
+                await _maybe_await(service.close(service.instance))
+            except Exception as e:
+                logger.warning(f"[服务] 关闭 {service.name} 失败: {str(e)}")
+            # 实例保留，再次进入 lifespan（新的事件循环）时重新执行 start
+            service.started = service.start is None
+            service.start_lock = asyncio.Lock()
+
+    async def _check(self, service: _Service) -> Dict:
+        if not service.ready:
+            if service.error is not None:
+                return {"status": "down", "error": service.error}
+            return {"status": "starting" if service.warm else "idle"}
+        if service.check is None:
+            return {"status": "up"}
+        started = time.perf_counter()
+        try:
+            details = await asyncio.wait_for(_maybe_await(service.check(service.instance)), self.check_timeout)
+        except asyncio.TimeoutError:
+            return {"status": "down", "error": f"检查超时（{self.check_timeout}s）"}
+        except Exception as e:
+            return {"status": "down", "error": str(e)}
+        report = {"status": "up", "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+        report.update(details or {})
+        return report
+
+    async def health(self) -> Dict:
+        """各依赖的状态。status: healthy / degraded（可选依赖不可用）/ starting（必需依赖仍在预热）/ unavailable"""
+        services: List[_Service] = list(self._services.values())
+        reports = await asyncio.gather(*(self._check(service) for service in services))
+        dependencies = {service.name: report for service, report in zip(services, reports)}
+        required = [report["status"] for service, report in zip(services, reports) if service.required]
+        if "down" in required:
+            status = "unavailable"
+        elif "starting" in required:
+            status = "starting"
+        elif any(report["status"] == "down" for report in reports):
+            status = "degraded"
+        else:
+            status = "healthy"
+        return {"status": status, "dependencies": dependencies}
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+from analysis_cache import AnalysisCache, MemoryCacheBackend, text_analysis_key
+
+
+def test_lru_evicts_least_recently_used():
+    cache = AnalysisCache(max_entries=2, ttl=60)
+
+    async def scenario():
+        await cache.set("a", "A")
+        await cache.set("b", "B")
+        assert await cache.get("a") == "A"
+        await cache.set("c", "C")
+        return [await cache.get(key) for key in ("a", "b", "c")]
+
+    assert asyncio.run(scenario()) == ["A", None, "C"]
+
+
+def test_expired_entries_are_dropped():
+    cache = AnalysisCache(max_entries=10, ttl=0.01)
+
+    async def scenario():
+        await cache.set("a", "A")
+        await asyncio.sleep(0.02)
+        return await cache.get("a")
+
+    assert asyncio.run(scenario()) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_concurrent_requests_compute_once():
+    cache = AnalysisCache(max_entries=10, ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "结果"
+
+    async def scenario():
+        results = await asyncio.gather(*(cache.get_or_compute("k", compute) for _ in range(5)))
+        return results + [await cache.get_or_compute("k", compute)]
+
+    assert asyncio.run(scenario()) == ["结果"] * 6
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert stats["misses"] == 1 and stats["coalesced"] == 4 and stats["local_hits"] == 1
+
+
+def test_waiter_gets_value_when_leader_is_cancelled():
+    cache = AnalysisCache(max_entries=10, ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "结果"
+
+    async def scenario():
+        leader = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    assert asyncio.run(scenario()) == "结果"
+    assert len(calls) == 1
+
+
+def test_compute_is_cancelled_when_every_caller_gives_up():
+    cache = AnalysisCache(max_entries=10, ttl=60)
+    cancelled = []
+
+    async def compute():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return "结果"
+
+    async def scenario():
+        callers = [asyncio.create_task(cache.get_or_compute("k", compute)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        return cache._inflight
+
+    assert asyncio.run(scenario()) == {}
+    assert cancelled == [1]
+
+
+def test_failure_is_shared_and_not_cached():
+    cache = AnalysisCache(max_entries=10, ttl=60)
+    attempts = []
+
+    async def failing():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("模型出错")
+
+    async def scenario():
+        results = await asyncio.gather(cache.get_or_compute("k", failing), cache.get_or_compute("k", failing),
+                                       return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        return await cache.get_or_compute("k", lambda: asyncio.sleep(0, "结果"))
+
+    assert asyncio.run(scenario()) == "结果"
+    assert len(attempts) == 1
+
+
+def test_shared_backend_hit_skips_compute():
+    backend = MemoryCacheBackend()
+    writer, reader = AnalysisCache(ttl=60, backend=backend), AnalysisCache(ttl=60, backend=backend)
+
+    async def compute():
+        raise AssertionError("共享层命中时不应调用模型")
+
+    async def scenario():
+        await writer.set("k", "结果")
+        return await reader.get_or_compute("k", compute)
+
+    assert asyncio.run(scenario()) == "结果"
+    assert reader.stats()["shared_hits"] == 1
+
+
+def test_text_key_ignores_width_and_whitespace_differences():
+    key = text_analysis_key("绝绝子！ 真的", "elder", None, "qwen-max", "v1")
+    assert text_analysis_key("绝绝子!  真的 ", "elder", None, "qwen-max", "v1") == key
+    assert text_analysis_key("绝绝子!", "elder", None, "qwen-max", "v1") != key
+    assert text_analysis_key("绝绝子！ 真的", "young", None, "qwen-max", "v1") != key
@@ -0,0 +1,74 @@
+import asyncio
+import socket
+
+import httpcore
+import pytest
+
+from fetch_guard import ForbiddenAddressError, PublicAddressBackend, resolve_public_address
+
+
+class RecordingBackend(httpcore.AsyncNetworkBackend):
+    def __init__(self):
+        self.connected = []
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        self.connected.append((host, port))
+        return object()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+def fake_dns(answers):
+    """按顺序返回每次解析的结果，模拟 TTL 很短的重绑定域名"""
+    calls = []
+
+    async def getaddrinfo(host, port, type=0, **kwargs):
+        calls.append(host)
+        ip = answers[min(len(calls), len(answers)) - 1] if isinstance(answers, list) else answers.get(host, host)
+        family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+        return [(family, socket.SOCK_STREAM, 6, "", (ip, port))]
+
+    return getaddrinfo, calls
+
+
+def run_with_dns(answers, coroutine_factory):
+    getaddrinfo, calls = fake_dns(answers)
+
+    async def scenario():
+        asyncio.get_running_loop().getaddrinfo = getaddrinfo
+        return await coroutine_factory()
+
+    return asyncio.run(scenario()), calls
+
+
+@pytest.mark.parametrize("ip", ["127.0.0.1", "10.1.2.3", "169.254.169.254", "192.168.1.1", "100.64.0.1",
+                                "224.0.0.1", "::1", "fe80::1%eth0", "::ffff:127.0.0.1"])
+def test_private_addresses_are_rejected(ip):
+    with pytest.raises(ForbiddenAddressError):
+        run_with_dns({"img.example": ip}, lambda: resolve_public_address("img.example", 80))
+
+
+def test_connects_to_the_address_that_was_checked():
+    inner = RecordingBackend()
+    backend = PublicAddressBackend(backend=inner)
+    # 第一次解析到公网地址，之后解析到云主机元数据地址
+    _, calls = run_with_dns(["93.184.216.34", "169.254.169.254"],
+                            lambda: backend.connect_tcp("rebind.example", 443))
+    assert inner.connected == [("93.184.216.34", 443)]
+    assert calls == ["rebind.example"]
+
+
+def test_rebound_private_address_is_never_connected():
+    inner = RecordingBackend()
+    backend = PublicAddressBackend(backend=inner)
+    with pytest.raises(ForbiddenAddressError):
+        run_with_dns(["169.254.169.254"], lambda: backend.connect_tcp("rebind.example", 80))
+    assert inner.connected == []
+
+
+def test_allowed_hosts_skip_the_check():
+    inner = RecordingBackend()
+    backend = PublicAddressBackend(allow_host=lambda host: host == "localhost", backend=inner)
+    _, calls = run_with_dns({}, lambda: backend.connect_tcp("localhost", 8000))
+    assert inner.connected == [("localhost", 8000)] and calls == []
@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+from typing import Dict, List
+
+import pytest
+
+from history_archive import HistoryArchive
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects: Dict[str, bytes] = {}
+        self.reads: List[str] = []
+
+    def put_object(self, key, data, headers=None):
+        self.objects[key] = data
+        return SimpleNamespace(status=200)
+
+    def get_object(self, key):
+        self.reads.append(key)
+        if key not in self.objects:
+            raise KeyError(key)
+        data = self.objects[key]
+        return SimpleNamespace(read=lambda: data)
+
+
+def message(i: int, seq=True, text=None) -> Dict:
+    return {"id": 1000 + i, "from": "elder_1", "to": "young_1", "type": "text", "message": text or f"m{i}",
+            "pair_id": 1, "created_at": None, "image_data": None, "seq": i if seq else None,
+            "pretranslation": None}
+
+
+@pytest.fixture
+def archive():
+    return HistoryArchive(FakeBucket(), prefix="test")
+
+
+@pytest.fixture
+def segments(archive):
+    # 三个分段：消息 1-10、11-20、21-30
+    return [archive.write(1, [message(i) for i in range(start, start + 10)]) for start in (1, 11, 21)]
+
+
+@pytest.fixture
+def hot():
+    # 热表中是 31-40
+    return [message(i) for i in range(31, 41)]
+
+
+def newest_first(segments):
+    return sorted(segments, key=lambda s: s["last_id"], reverse=True)
+
+
+def oldest_first(segments):
+    return sorted(segments, key=lambda s: s["first_id"])
+
+
+def ids(rows):
+    return [row["id"] - 1000 for row in rows]
+
+
+def test_before_id_page_spans_hot_rows_and_segments(archive, segments, hot):
+    page = archive.merge(hot[:5], newest_first(segments), limit=15, before_id=1036)
+    assert ids(page) == list(range(21, 36))
+
+
+def test_before_id_stops_reading_segments_outside_the_page(archive, segments):
+    page = archive.merge([], newest_first(segments), limit=5, before_id=1031)
+    assert ids(page) == list(range(26, 31))
+    # 第一个分段已够一页，更早的两个分段整体在这一页之外
+    assert archive.bucket.reads == [segments[2]["key"]]
+
+
+def test_after_id_returns_oldest_messages_after_cursor(archive, segments, hot):
+    page = archive.merge(hot, oldest_first(segments), limit=8, after_id=1005)
+    assert ids(page) == list(range(6, 14))
+    assert segments[2]["key"] not in archive.bucket.reads
+
+
+def test_after_seq_skips_messages_without_seq(archive, segments):
+    legacy = archive.write(1, [message(i, seq=False) for i in range(41, 44)])
+    page = archive.merge([], oldest_first(segments) + [legacy], limit=100, after_seq=25)
+    assert ids(page) == list(range(26, 31))
+
+
+def test_hot_row_wins_over_archived_duplicate(archive, segments, hot):
+    hot = [message(30, text="热表版本")] + hot
+    page = archive.merge(hot, newest_first(segments), limit=12)
+    assert ids(page) == list(range(29, 41))
+    assert page[1]["message"] == "热表版本"
+
+
+def test_unreadable_segment_is_skipped(archive, segments):
+    del archive.bucket.objects[segments[2]["key"]]
+    page = archive.merge([], newest_first(segments), limit=5, before_id=1031)
+    assert ids(page) == list(range(16, 21))
+
+
+def test_segments_are_cached_after_first_read(archive, segments):
+    for _ in range(3):
+        archive.merge([], newest_first(segments), limit=5)
+    assert archive.bucket.reads == [segments[2]["key"]]
+    assert archive.segment_reads == 1 and archive.cache_hits == 2
@@ -0,0 +1,112 @@
+import asyncio
+from typing import Dict, List
+
+from message_broker import InMemoryBroker
+from message_sequencer import MessageSequencer
+
+
+class FakeDB:
+    def __init__(self, max_seq: Dict[int, int] = None, rows: List[Dict] = None):
+        self.max_seq = max_seq or {}
+        self.rows = rows or []
+        self.max_seq_queries = 0
+
+    async def get_max_seq(self, pair_id: int) -> int:
+        self.max_seq_queries += 1
+        return self.max_seq.get(pair_id, 0)
+
+    async def get_messages_after_seq(self, pair_id: int, after_seq: int, limit: int) -> List[Dict]:
+        rows = sorted((row for row in self.rows if row["pair_id"] == pair_id and row["seq"] > after_seq),
+                      key=lambda row: row["seq"])
+        return [dict(row) for row in rows[:limit]]
+
+
+def frame(pair_id: int, seq: int) -> Dict:
+    return {"type": "text", "id": 1000 + seq, "pair_id": pair_id, "seq": seq, "message": f"m{seq}"}
+
+
+def test_sequence_starts_above_database_max_and_is_per_pair():
+    db = FakeDB(max_seq={1: 41})
+    sequencer = MessageSequencer(InMemoryBroker(), db)
+
+    async def scenario():
+        return [await sequencer.next_seq(1), await sequencer.next_seq(1), await sequencer.next_seq(2)]
+
+    assert asyncio.run(scenario()) == [42, 43, 1]
+    # 数据库中的最大序号每个配对只查一次
+    assert db.max_seq_queries == 2
+
+
+def test_sequence_continues_after_broker_counter_is_lost():
+    db = FakeDB()
+    sequencer = MessageSequencer(InMemoryBroker(), db)
+
+    async def scenario():
+        for _ in range(5):
+            await sequencer.next_seq(1)
+        # 中枢重启：计数器丢失，以本worker见过的最大序号为下限
+        sequencer.broker = InMemoryBroker()
+        return await sequencer.next_seq(1)
+
+    assert asyncio.run(scenario()) == 6
+
+
+def test_replay_from_buffer():
+    sequencer = MessageSequencer(InMemoryBroker(), FakeDB())
+
+    async def scenario():
+        for _ in range(5):
+            seq = await sequencer.next_seq(1)
+            sequencer.remember(1, frame(1, seq))
+        return await sequencer.replay(1, 2)
+
+    frames, current, truncated = asyncio.run(scenario())
+    assert [f["seq"] for f in frames] == [3, 4, 5]
+    assert current == 5 and not truncated
+    assert sequencer.buffer_replays == 1 and sequencer.db_replays == 0
+
+
+def test_replay_nothing_missed():
+    sequencer = MessageSequencer(InMemoryBroker(), FakeDB(max_seq={1: 7}))
+    assert asyncio.run(sequencer.replay(1, 7)) == ([], 7, False)
+
+
+def test_replay_falls_back_to_database_when_buffer_has_gaps():
+    # 1-4 已落库；5 还在写入队列里，只在缓冲中
+    db = FakeDB(max_seq={1: 4}, rows=[frame(1, seq) for seq in range(1, 5)])
+    sequencer = MessageSequencer(InMemoryBroker(), db, buffer_size=2)
+
+    async def scenario():
+        seq = await sequencer.next_seq(1)
+        sequencer.remember(1, frame(1, seq))
+        return await sequencer.replay(1, 1)
+
+    frames, current, truncated = asyncio.run(scenario())
+    assert [f["seq"] for f in frames] == [2, 3, 4, 5]
+    assert current == 5 and not truncated
+    assert sequencer.db_replays == 1
+
+
+def test_replay_is_truncated_to_limit():
+    sequencer = MessageSequencer(InMemoryBroker(), FakeDB(), replay_limit=3)
+
+    async def scenario():
+        for _ in range(10):
+            seq = await sequencer.next_seq(1)
+            sequencer.remember(1, frame(1, seq))
+        return await sequencer.replay(1, 0)
+
+    frames, current, truncated = asyncio.run(scenario())
+    assert [f["seq"] for f in frames] == [1, 2, 3]
+    assert current == 10 and truncated
+
+
+def test_buffers_keep_most_recently_used_pairs():
+    sequencer = MessageSequencer(InMemoryBroker(), FakeDB(), buffer_size=2, max_pairs=2)
+    sequencer.remember(1, frame(1, 1))
+    sequencer.remember(2, frame(2, 1))
+    sequencer.remember(1, frame(1, 2))
+    sequencer.remember(1, frame(1, 3))
+    sequencer.remember(3, frame(3, 1))
+    assert list(sequencer.buffers) == [1, 3]
+    assert [f["seq"] for f in sequencer.buffers[1]] == [2, 3]
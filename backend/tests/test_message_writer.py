@@ -0,0 +1,143 @@
+import asyncio
+import json
+import sqlite3
+import time
+from typing import Dict, List
+
+from message_writer import MessageWriter
+
+
+class FakeDB:
+    """记录每次批量写入；down 为真时模拟数据库不可用，bad 中的消息模拟数据错误"""
+
+    def __init__(self):
+        self.batches: List[List[Dict]] = []
+        self.down = False
+        self.bad = set()
+        self.attempts = 0
+
+    async def save_messages(self, batch: List[Dict]):
+        self.attempts += 1
+        await asyncio.sleep(0)
+        if self.down:
+            raise ConnectionError("数据库不可用")
+        if any(message["message_id"] in self.bad for message in batch):
+            raise sqlite3.DataError("无效的数据")
+        self.batches.append(list(batch))
+
+    @property
+    def saved(self) -> List[int]:
+        return [message["message_id"] for batch in self.batches for message in batch]
+
+
+def message(i: int) -> Dict:
+    return {"message_id": i, "from_role": "elder_1", "to_role": "young_1", "message_type": "text",
+            "message_content": f"m{i}", "pair_id": 1, "seq": i}
+
+
+def make_writer(db, tmp_path, **kwargs) -> MessageWriter:
+    options = {"batch_size": 100, "flush_interval": 0.01, "retry_delay": 0.01, "stop_timeout": 1}
+    options.update(kwargs)
+    return MessageWriter(db, spill_path=str(tmp_path / "spill.jsonl"), **options)
+
+
+def test_messages_are_written_in_batches(tmp_path):
+    db = FakeDB()
+    writer = make_writer(db, tmp_path)
+
+    async def scenario():
+        writer.start()
+        for i in range(250):
+            await writer.enqueue(message(i))
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert db.saved == list(range(250))
+    assert max(len(batch) for batch in db.batches) == 100
+    assert len(db.batches) <= 5
+
+
+def test_partial_batch_is_flushed_after_interval(tmp_path):
+    db = FakeDB()
+    writer = make_writer(db, tmp_path, flush_interval=0.02)
+
+    async def scenario():
+        writer.start()
+        await writer.enqueue(message(1))
+        await asyncio.sleep(0.1)
+        saved = db.saved
+        await writer.stop()
+        return saved
+
+    assert asyncio.run(scenario()) == [1]
+
+
+def test_transient_failure_is_retried_without_losing_messages(tmp_path):
+    db = FakeDB()
+    db.down = True
+    writer = make_writer(db, tmp_path)
+
+    async def scenario():
+        writer.start()
+        for i in range(10):
+            await writer.enqueue(message(i))
+        await asyncio.sleep(0.05)
+        db.down = False
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert db.saved == list(range(10))
+    assert db.attempts > 1
+    assert not (tmp_path / "spill.jsonl").exists()
+
+
+def test_bad_message_is_dropped_alone(tmp_path):
+    db = FakeDB()
+    db.bad = {3}
+    writer = make_writer(db, tmp_path)
+
+    async def scenario():
+        writer.start()
+        for i in range(6):
+            await writer.enqueue(message(i))
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert sorted(db.saved) == [0, 1, 2, 4, 5]
+
+
+def test_stop_is_bounded_and_spills_unwritten_messages(tmp_path):
+    db = FakeDB()
+    db.down = True
+    writer = make_writer(db, tmp_path)
+
+    async def scenario():
+        writer.start()
+        for i in range(10):
+            await writer.enqueue(message(i))
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        await writer.stop(timeout=0.2)
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 1
+    assert db.saved == []
+    spilled = [json.loads(line)["message_id"] for line in (tmp_path / "spill.jsonl").read_text().splitlines()]
+    assert sorted(spilled) == list(range(10))
+
+
+def test_spilled_messages_are_written_on_next_start(tmp_path):
+    (tmp_path / "spill.jsonl").write_text(
+        "".join(json.dumps(message(i)) + "\n" for i in range(5)) + '{"message_id": 9, "trunc', encoding="utf-8")
+    db = FakeDB()
+    writer = make_writer(db, tmp_path, batch_size=2)
+
+    async def scenario():
+        writer.start()
+        await writer.enqueue(message(5))
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert db.saved == list(range(6))
+    assert not (tmp_path / "spill.jsonl").exists()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,203 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from model_runner import ModelBusyError, ModelCallRunner, parse_model_limits
+
+
+def make_runner(**kwargs) -> ModelCallRunner:
+    runner = ModelCallRunner(default_limit=kwargs.pop("default_limit", 1), limits={}, max_workers=4,
+                             default_rate=0, rates={}, **kwargs)
+    runner.retry_base = 0.01
+    runner.retry_max_delay = 0.02
+    return runner
+
+
+def response(status_code: int, output: str = "ok"):
+    return SimpleNamespace(status_code=status_code, output=output)
+
+
+def test_parse_model_limits():
+    assert parse_model_limits("qwen-max=8, qwen-vl-plus=4,bad,x=oops") == {"qwen-max": 8, "qwen-vl-plus": 4}
+    assert parse_model_limits("qwen-max=0") == {"qwen-max": 1}
+    assert parse_model_limits("qwen-max=90.5", float) == {"qwen-max": 90.5}
+    assert parse_model_limits("") == {}
+
+
+def test_interactive_calls_run_before_queued_background_calls():
+    runner = make_runner()
+    order = []
+    gate = threading.Event()
+
+    def call(name):
+        if name == "first":
+            gate.wait(5)
+        order.append(name)
+        return response(200, name)
+
+    async def scenario():
+        first = asyncio.create_task(runner.run("m", call, "first", coalesce=False))
+        await asyncio.sleep(0.05)
+        background = asyncio.create_task(runner.run("m", call, "background", priority="background",
+                                                    coalesce=False))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(runner.run("m", call, "interactive", coalesce=False))
+        await asyncio.sleep(0.05)
+        gate.set()
+        await asyncio.gather(first, background, interactive)
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        runner.shutdown()
+    assert order == ["first", "interactive", "background"]
+
+
+def test_identical_concurrent_calls_are_coalesced():
+    runner = make_runner(default_limit=4)
+    calls = []
+
+    def call(text):
+        calls.append(text)
+        time.sleep(0.05)
+        return response(200, text.upper())
+
+    async def scenario():
+        return await asyncio.gather(runner.run("m", call, "hi"), runner.run("m", call, "hi"),
+                                    runner.run("m", call, "other"))
+
+    try:
+        results = asyncio.run(scenario())
+    finally:
+        runner.shutdown()
+    assert [r.output for r in results] == ["HI", "HI", "OTHER"]
+    assert sorted(calls) == ["hi", "other"]
+    assert runner.coalesced == 1
+
+
+def test_queued_call_past_deadline_raises_busy():
+    runner = make_runner()
+    gate = threading.Event()
+
+    def slow():
+        gate.wait(5)
+        return response(200)
+
+    async def scenario():
+        running = asyncio.create_task(runner.run("m", slow, coalesce=False))
+        await asyncio.sleep(0.05)
+        try:
+            with pytest.raises(ModelBusyError):
+                await runner.run("m", slow, deadline=0.05, coalesce=False)
+        finally:
+            gate.set()
+            await running
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        runner.shutdown()
+    assert runner.expired == 1
+
+
+def test_retryable_status_is_retried_until_success():
+    runner = make_runner()
+    statuses = [503, 500, 200]
+
+    def call():
+        return response(statuses.pop(0))
+
+    try:
+        result = asyncio.run(runner.run("m", call))
+    finally:
+        runner.shutdown()
+    assert result.status_code == 200
+    assert runner.retries == 2
+    assert runner.calls == 3
+
+
+def test_rate_limited_until_retries_run_out_raises_busy():
+    runner = make_runner()
+    runner.max_retries = 1
+
+    async def scenario():
+        with pytest.raises(ModelBusyError):
+            await runner.run("m", lambda: response(429))
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        runner.shutdown()
+    assert runner.calls == 2
+    assert runner.throttled == 2
+
+
+def test_non_retryable_status_is_returned_as_is():
+    runner = make_runner()
+    try:
+        result = asyncio.run(runner.run("m", lambda: response(400)))
+    finally:
+        runner.shutdown()
+    assert result.status_code == 400
+    assert runner.retries == 0
+
+
+def test_stream_yields_items_and_retries_failed_first_chunk():
+    runner = make_runner()
+    attempts = []
+
+    def stream():
+        attempts.append(1)
+        if len(attempts) == 1:
+            yield response(503)
+            return
+        for text in ("a", "b", "c"):
+            yield response(200, text)
+
+    async def scenario():
+        return [item.output async for item in runner.stream("m", stream)]
+
+    try:
+        outputs = asyncio.run(scenario())
+    finally:
+        runner.shutdown()
+    assert outputs == ["a", "b", "c"]
+    assert len(attempts) == 2
+    assert runner._lane("m").active == 0
+
+
+def test_unknown_priority_is_rejected():
+    runner = make_runner()
+
+    async def scenario():
+        with pytest.raises(ValueError):
+            await runner.run("m", lambda: response(200), priority="urgent")
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        runner.shutdown()
+
+
+def test_expired_ticket_granted_on_push_does_not_leak_slot():
+    runner = make_runner()
+    lane = runner._lane("m")
+
+    async def scenario():
+        # 空闲的队列在入队时立即放行，即使截止时间已过也要占用并归还名额
+        ticket = runner._ticket("interactive", -1)
+        await lane.acquire(ticket)
+        assert lane.active == 1
+        lane.release()
+        result = await runner.run("m", lambda: response(200), deadline=-1, coalesce=False)
+        assert result.status_code == 200
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        runner.shutdown()
+    assert lane.active == 0
+    assert runner.expired == 0
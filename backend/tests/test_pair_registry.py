@@ -0,0 +1,46 @@
+import pytest
+
+from pair_registry import PairMember, PairRegistry
+
+ELDER = PairMember(pair_id=7, role="elder", partner="young_7")
+
+
+def chat(**fields):
+    data = {"type": "text", "id": 1, "from": "elder_7", "to": "young_7", "pair_id": 7, "message": "hi"}
+    data.update(fields)
+    return data
+
+
+@pytest.fixture
+def registry():
+    return PairRegistry(db=None)
+
+
+@pytest.mark.parametrize("data", [
+    chat(),
+    chat(type="emoji", image_data="https://img.example/1.gif"),
+    chat(type="image", image_data="https://img.example/2.jpg"),
+    chat(pair_id="7"),
+])
+def test_accepts_own_chat_frames_to_partner(registry, data):
+    registry.validate_frame("elder_7", ELDER, data)
+
+
+@pytest.mark.parametrize("data, reason", [
+    (chat(type="resume_done"), "未知的帧类型"),
+    (chat(type=None), "未知的帧类型"),
+    (chat(**{"from": "young_7"}), "发送方"),
+    (chat(to="young_8"), "接收方"),
+    (chat(to="elder_7"), "接收方"),
+    (chat(pair_id=8), "不属于配对"),
+    (chat(pair_id=None), "无效的 pair_id"),
+    (chat(pair_id="seven"), "无效的 pair_id"),
+])
+def test_rejects_frames_outside_own_pair(registry, data, reason):
+    with pytest.raises(ValueError, match=reason):
+        registry.validate_frame("elder_7", ELDER, data)
+
+
+def test_missing_fields_are_rejected(registry):
+    with pytest.raises(ValueError):
+        registry.validate_frame("elder_7", ELDER, {"type": "text"})
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from services import ServiceContainer, ServiceUnavailableError
+
+
+def slow_factory(seconds: float, calls: list):
+    def factory():
+        calls.append(threading.current_thread().name)
+        time.sleep(seconds)
+        return SimpleNamespace(value=42)
+    return factory
+
+
+def test_attribute_access_during_warmup_does_not_block_loop():
+    container = ServiceContainer(warmup_timeout=0)
+    calls = []
+    service = container.register("slow", slow_factory(0.3, calls))
+
+    async def scenario():
+        await container.start()
+        started = time.perf_counter()
+        with pytest.raises(ServiceUnavailableError):
+            service.value
+        blocked = time.perf_counter() - started
+        await container.warm("slow")
+        return blocked, service.value
+
+    blocked, value = asyncio.run(scenario())
+    assert blocked < 0.05
+    assert value == 42
+    # 工厂只在线程池中执行一次
+    assert len(calls) == 1 and calls[0] != threading.main_thread().name
+
+
+def test_failed_warmup_is_retried_in_background():
+    container = ServiceContainer(warmup_timeout=1)
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("数据库不可用")
+        return SimpleNamespace(value="ok")
+
+    service = container.register("flaky", factory)
+
+    async def scenario():
+        await container.start()
+        assert not container.created("flaky")
+        with pytest.raises(ServiceUnavailableError):
+            service.value
+        await container.warm("flaky")
+        return service.value
+
+    assert asyncio.run(scenario()) == "ok"
+    assert len(attempts) == 2
+
+
+def test_access_outside_event_loop_creates_synchronously():
+    container = ServiceContainer()
+    calls = []
+    service = container.register("slow", slow_factory(0, calls), warm=False)
+    assert service.value == 42
+    assert calls == [threading.current_thread().name]
+
+
+def test_async_methods_wait_for_start():
+    container = ServiceContainer(warmup_timeout=0)
+    events = []
+
+    class Writer:
+        async def start(self):
+            events.append("start")
+
+        async def enqueue(self, item):
+            events.append(item)
+
+    writer = container.register("writer", Writer, start=lambda w: w.start(), warm=False)
+
+    async def scenario():
+        await container.warm("writer")
+        # 模拟 start 失败后：实例已创建但未启动
+        container._services["writer"].started = False
+        await writer.enqueue("message")
+
+    asyncio.run(scenario())
+    assert events == ["start", "start", "message"]
@@ -3,6 +3,8 @@ import './App.css';
 import LoadingPage from './LoadingPage';
 
 const API_BASE_URL = '8.137.70.68:8000';
+// 流式分析超过这么久没有收到新的分析帧就视为失败，解除"分析中"状态
+const ANALYSIS_IDLE_TIMEOUT_MS = 30000;
 
 function App() {
   // 从URL参数获取初始角色
@@ -54,9 +56,76 @@ function App() {
   const [emojiTags, setEmojiTags] = useState([]);
   const [showTagPanel, setShowTagPanel] = useState(false);
   const [activeTag, setActiveTag] = useState('');
+  // 预翻译：开启后收到的消息会在后台提前翻译好，点击分析时直接显示
+  const [pretranslate, setPretranslate] = useState(false);
 
 
-  const heartbeatTimerRef = useRef()
+  // 已收到的最新消息ID，断线重连后只拉取这之后的增量消息
+  const lastMessageIdRef = useRef(null);
+
+  useEffect(() => {
+    const ids = messages.map(m => Number(m.id)).filter(id => !Number.isNaN(id));
+    lastMessageIdRef.current = ids.length ? Math.max(...ids) : null;
+  }, [messages]);
+
+  // 已连续确认的最大消息序号（服务端按配对分配），重连时据此只补发错过的消息
+  const lastSeqRef = useRef(null);
+  // 已收到但前面还有缺口的序号
+  const pendingSeqsRef = useRef(new Set());
+  // 已请求补发、尚未收到 resume_done
+  const resumingRef = useRef(false);
+
+  // 进行中的流式分析：{ messageId, timer }。结果只会发到发起分析的那条连接上，
+  // 连接断开、重连或超时都要结束它，否则"分析中"状态永远不会被清除
+  const streamingAnalysisRef = useRef(null);
+
+  const armAnalysisTimeout = (messageId) => {
+    if (streamingAnalysisRef.current) {
+      clearTimeout(streamingAnalysisRef.current.timer);
+    }
+    const timer = setTimeout(() => endStreamingAnalysis('分析超时，请重试'), ANALYSIS_IDLE_TIMEOUT_MS);
+    streamingAnalysisRef.current = { messageId, timer };
+  };
+
+  // 结束进行中的流式分析；传入 error 时把还没完成的分析标记为失败
+  const endStreamingAnalysis = (error) => {
+    const streaming = streamingAnalysisRef.current;
+    if (!streaming) return;
+    clearTimeout(streaming.timer);
+    streamingAnalysisRef.current = null;
+    if (error) {
+      setMessages(prev => prev.map(m =>
+        m.id === streaming.messageId ? { ...m, analysis: { type: "error", error } } : m
+      ));
+    }
+    setAnalysisInProgress(false);
+  };
+
+  // 记录收到的序号，返回是否出现了缺口
+  const markSeq = (seq) => {
+    if (!seq) return false;
+    if (lastSeqRef.current === null) {
+      lastSeqRef.current = seq;
+      return false;
+    }
+    if (seq <= lastSeqRef.current) return false;
+    pendingSeqsRef.current.add(seq);
+    while (pendingSeqsRef.current.has(lastSeqRef.current + 1)) {
+      lastSeqRef.current += 1;
+      pendingSeqsRef.current.delete(lastSeqRef.current);
+    }
+    return pendingSeqsRef.current.size > 0;
+  };
+
+  // 按ID去重，并按序号插入到正确位置（补发的旧消息可能晚于新消息到达）
+  const mergeMessage = (prev, msg) => {
+    if (prev.some(m => m.id === msg.id)) {
+      return prev.map(m => (m.id === msg.id ? { ...m, seq: msg.seq } : m));
+    }
+    const index = msg.seq ? prev.findIndex(m => m.seq && m.seq > msg.seq) : -1;
+    if (index === -1) return [...prev, msg];
+    return [...prev.slice(0, index), msg, ...prev.slice(index)];
+  };
 
   // 新增：获取表情包函数
   const fetchEmojiPackages = async (tag) => {
@@ -150,10 +219,25 @@ function App() {
     // 添加刷新消息的函数
     const refreshMessages = async () => {
       try {
-        const response = await fetch(`http://${API_BASE_URL}/api/get_messages?pair_id=${pairId}`);
+        const lastId = lastMessageIdRef.current;
+        const query = lastId ? `&after_id=${lastId}` : '';
+        const response = await fetch(`http://${API_BASE_URL}/api/get_messages?pair_id=${pairId}${query}`);
         if (response.ok) {
           const history = await response.json();
-          setMessages(history);
+          const seqs = history.map(m => m.seq).filter(Boolean);
+          if (seqs.length) {
+            lastSeqRef.current = Math.max(lastSeqRef.current || 0, ...seqs);
+            pendingSeqsRef.current.clear();
+          }
+          if (lastId) {
+            // 增量消息追加到已有列表，按ID去重
+            setMessages(prev => {
+              const knownIds = new Set(prev.map(m => m.id));
+              return [...prev, ...history.filter(m => !knownIds.has(m.id))];
+            });
+          } else {
+            setMessages(history);
+          }
         }
       } catch (error) {
         console.error('刷新历史消息失败:', error);
@@ -172,32 +256,22 @@ function App() {
       return;
     }
 
-    // 心跳时间
-    const heartbeatInterval = 3000
-
-    const startHeartbeat = (socket) => {
-      stopHeartbeat();
-      heartbeatTimerRef.current = setInterval(() => {
-        socket.send(JSON.stringify({ type: 'ping' }));
-      }, heartbeatInterval);
-    }
-
-    const stopHeartbeat = () => {
-      if (heartbeatTimerRef.current) {
-        clearInterval(heartbeatTimerRef.current);
-        heartbeatTimerRef.current = null;
-      }
-    }
-
+    // 心跳由服务端发送原生 ping 帧，浏览器自动回复 pong，前端不再定时发送应用层 ping
     const connectWebSocket = () => {
-      const ws = new WebSocket(`ws://${API_BASE_URL}/ws/${clientId}`);
+      // 带上最后确认的序号，服务端只补发断线期间的消息
+      const resume = lastSeqRef.current !== null ? `&last_seq=${lastSeqRef.current}` : '';
+      const ws = new WebSocket(`ws://${API_BASE_URL}/ws/${clientId}?pair_id=${pairId}${resume}`);
       setSocket(ws);
 
       ws.onopen = () => {
         console.log(`WebSocket connected for ${clientId}`);
         setIsWebSocketReady(true);
-        // 开始心跳
-        startHeartbeat(ws)
+        // 旧连接上发起的分析不会再有结果
+        endStreamingAnalysis('连接已重置，请重试');
+        // 没有序号的旧消息无法按序号补发，重连后按消息ID拉取增量
+        if (lastSeqRef.current === null && lastMessageIdRef.current) {
+          refreshMessages();
+        }
       };
       ws.onmessage = (e) => {
         try {
@@ -208,6 +282,79 @@ function App() {
             return;
           }
 
+          // 服务端心跳，回复 pong，超时未回复的连接会被服务端断开
+          if (data.type === "ping") {
+            ws.send(JSON.stringify({ type: 'pong' }));
+            return;
+          }
+
+          // 流式分析结果，按 message_id 更新对应消息的分析内容
+          if (data.type && data.type.startsWith('analysis_')) {
+            setMessages(prev => prev.map(m => {
+              if (m.id !== data.message_id) return m;
+              if (data.type === 'analysis_start') {
+                return { ...m, analysis: { type: "analysis_result", content: "" } };
+              }
+              if (data.type === 'analysis_delta') {
+                const content = m.analysis && m.analysis.type === "analysis_result" ? m.analysis.content : "";
+                return { ...m, analysis: { type: "analysis_result", content: content + data.delta } };
+              }
+              if (data.type === 'analysis_done') {
+                return { ...m, analysis: { type: "analysis_result", content: data.analysis } };
+              }
+              return { ...m, analysis: { type: "error", error: data.error } };
+            }));
+            if (data.type === 'analysis_done' || data.type === 'analysis_error') {
+              endStreamingAnalysis();
+              setAnalysisInProgress(false);
+            } else if (streamingAnalysisRef.current && streamingAnalysisRef.current.messageId === data.message_id) {
+              armAnalysisTimeout(data.message_id);
+            }
+            return;
+          }
+
+          // 预翻译结果先存起来，点击分析时直接显示
+          if (data.type === "pretranslation") {
+            setMessages(prev => prev.map(m =>
+              m.id === data.message_id ? { ...m, pretranslation: data.analysis } : m
+            ));
+            return;
+          }
+
+          // 服务端拒绝的消息（例如接收方不在本配对中），不会被转发和保存
+          if (data.type === "error") {
+            console.error(`消息 ${data.id} 被拒绝: ${data.error}`);
+            setSendingMessages(prev => {
+              const newState = { ...prev };
+              delete newState[data.id];
+              return newState;
+            });
+            return;
+          }
+
+          // 自己发出的消息的回执，带有服务端分配的序号
+          if (data.type === "ack") {
+            markSeq(data.seq);
+            setMessages(prev => prev.map(m => (m.id === data.id ? { ...m, seq: data.seq } : m)));
+            setSendingMessages(prev => {
+              const newState = { ...prev };
+              delete newState[data.id];
+              return newState;
+            });
+            return;
+          }
+
+          // 补发结束；超过补发上限时改为拉取历史
+          if (data.type === "resume_done") {
+            if (data.truncated) {
+              refreshMessages();
+            }
+            lastSeqRef.current = Math.max(lastSeqRef.current || 0, data.seq);
+            pendingSeqsRef.current.clear();
+            resumingRef.current = false;
+            return;
+          }
+
           if (!data.id) {
             data.id = `${data.from || 'unknown'}_${Date.now()}`;
           }
@@ -217,7 +364,12 @@ function App() {
           if (!data.role) {
             data.role = data.from === 'elder' ? 'elder' : 'young';
           }
-          setMessages(prev => [...prev, data]);
+          setMessages(prev => mergeMessage(prev, data));
+          // 序号出现缺口（例如发送队列溢出丢弃了消息）时请求补发
+          if (markSeq(data.seq) && !resumingRef.current) {
+            resumingRef.current = true;
+            ws.send(JSON.stringify({ type: 'resume', pair_id: Number(pairId), last_seq: lastSeqRef.current }));
+          }
           // 收到对方确认消息后，移除发送状态
           if (data.from === otherClientId && sendingMessages[data.id]) {
             setSendingMessages(prev => {
@@ -233,6 +385,7 @@ function App() {
       ws.onclose = () => {
         console.log('WebSocket closed');
         setIsWebSocketReady(false);
+        endStreamingAnalysis('连接中断，请重试');
         setTimeout(connectWebSocket, 5000);
       };
       ws.onerror = (err) => {
@@ -318,12 +471,14 @@ function App() {
 
       const result = await response.json();
       const imageUrl = result.image_url;
+      const thumbnailUrl = result.thumbnail_url;
 
       if (socket && socket.readyState === WebSocket.OPEN) {
         const newMessage = {
           to: otherClientId,
           type: "image",
           image_data: imageUrl,
+          thumbnail_url: thumbnailUrl,
           from: clientId,
           role: clientId,
           id: Date.now(),
@@ -342,9 +497,37 @@ function App() {
     }
   };
 
+  // 已有预翻译结果时直接显示，不再请求分析
+  const showPretranslation = (msg) => {
+    if (!msg.pretranslation) return false;
+    setMessages(prev => prev.map(m =>
+      m.id === msg.id ? { ...m, analysis: { type: "analysis_result", content: msg.pretranslation } } : m
+    ));
+    return true;
+  };
+
+  const togglePretranslate = async () => {
+    const enabled = !pretranslate;
+    try {
+      const response = await fetch(`http://${API_BASE_URL}/api/pretranslate/${pairId}`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ enabled })
+      });
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      setPretranslate(enabled);
+    } catch (error) {
+      console.error("保存预翻译设置失败:", error);
+      alert("保存预翻译设置失败，请稍后重试");
+    }
+  };
+
   // 文本分析
   const analyzeTextMessage = async (msg) => {
     if (msg.analysis || analysisInProgress) return;
+    if (showPretranslation(msg)) return;
 
     // 检查文本是否为空
     if (!msg.message.trim()) {
@@ -359,20 +542,32 @@ function App() {
       m.id === msg.id ? { ...m, analysis: { type: "pending", message: "分析中..." } } : m
     ));
 
+    let streaming = false;
     try {
-      // 获取最近5条消息作为上下文
-      const context = messages
-        .slice(-5)
-        .filter(m => m.id !== msg.id)
-        .map(m => m.message || (m.type === 'image' ? '[图片]' : ''));
+      // 上下文（对话摘要 + 该消息之前的几轮）由服务端根据 pair_id 和 message_id 组装
+      // 连接可用时走WebSocket流式分析，结果由 analysis_* 帧逐步更新
+      if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({
+          type: 'analyze',
+          kind: 'text',
+          message_id: msg.id,
+          text: msg.message,
+          role: clientId.startsWith('elder') ? 'elder' : 'young',
+          pair_id: Number(pairId)
+        }));
+        streaming = true;
+        armAnalysisTimeout(msg.id);
+        return;
+      }
 
       const response = await fetch(`http://${API_BASE_URL}/api/analyze_text`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           text: msg.message,
-          role: clientId === 'elder' ? 'elder' : 'young',
-          context
+          role: clientId.startsWith('elder') ? 'elder' : 'young',
+          pair_id: Number(pairId),
+          message_id: msg.id
         })
       });
 
@@ -400,6 +595,58 @@ function App() {
       setMessages(prev => prev.map(m =>
         m.id === msg.id ? { ...m, analysis: { type: "error", error: error.message } } : m
       ));
+    } finally {
+      if (!streaming) {
+        setAnalysisInProgress(false);
+      }
+    }
+  };
+
+  // 一次翻译对方发来的所有未分析文本消息，后端打包成尽量少的模型调用
+  const analyzeAllMessages = async () => {
+    if (analysisInProgress) return;
+    const targets = messages.filter(m =>
+      m.from !== clientId && m.type === "text" && m.message && m.message.trim() &&
+      (!m.analysis || m.analysis.type === "error")
+    );
+    if (!targets.length) return;
+
+    setAnalysisInProgress(true);
+    const targetIds = new Set(targets.map(m => String(m.id)));
+    setMessages(prev => prev.map(m =>
+      targetIds.has(String(m.id)) ? { ...m, analysis: { type: "pending", message: "分析中..." } } : m
+    ));
+
+    try {
+      const response = await fetch(`http://${API_BASE_URL}/api/analyze_batch`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          pair_id: Number(pairId),
+          role: clientId.startsWith('elder') ? 'elder' : 'young',
+          messages: targets.map(m => ({ id: m.id, text: m.message }))
+        })
+      });
+
+      if (!response.ok) {
+        const errorData = await response.json();
+        throw new Error(errorData.detail || `HTTP error! status: ${response.status}`);
+      }
+
+      const result = await response.json();
+      setMessages(prev => prev.map(m => {
+        const id = String(m.id);
+        if (!targetIds.has(id)) return m;
+        if (result.results[id]) {
+          return { ...m, analysis: { type: "analysis_result", content: result.results[id] } };
+        }
+        return { ...m, analysis: { type: "error", error: "分析失败，请单独重试" } };
+      }));
+    } catch (error) {
+      console.error('批量分析失败:', error);
+      setMessages(prev => prev.map(m =>
+        targetIds.has(String(m.id)) ? { ...m, analysis: { type: "error", error: error.message } } : m
+      ));
     } finally {
       setAnalysisInProgress(false);
     }
@@ -408,6 +655,7 @@ function App() {
   // 网络表情包分析
   const analyzeEmojiMessage = async (msg) => {
     if (analysisInProgress) return;
+    if (!msg.analysis && showPretranslation(msg)) return;
 
     setAnalysisInProgress(true);
 
@@ -415,6 +663,7 @@ function App() {
       m.id === msg.id ? { ...m, analysis: { type: "pending", message: "分析中..." } } : m
     ));
 
+    let streaming = false;
     try {
       // 获取最近5条消息作为上下文
       const context = messages
@@ -422,12 +671,27 @@ function App() {
         .filter(m => m.id !== msg.id)
         .map(m => m.message || (m.type === 'image' ? '[图片]' : ''));
 
+      // 连接可用时走WebSocket流式分析，结果由 analysis_* 帧逐步更新
+      if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({
+          type: 'analyze',
+          kind: 'emoji',
+          message_id: msg.id,
+          image_url: msg.image_data,
+          role: clientId.startsWith('elder') ? 'elder' : 'young',
+          context
+        }));
+        streaming = true;
+        armAnalysisTimeout(msg.id);
+        return;
+      }
+
       const response = await fetch(`http://${API_BASE_URL}/api/analyze_emoji`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           image_url: msg.image_data,
-          role: clientId === 'elder' ? 'elder' : 'young',
+          role: clientId.startsWith('elder') ? 'elder' : 'young',
           context
         })
       });
@@ -464,10 +728,21 @@ function App() {
         } : m
       ));
     } finally {
-      setAnalysisInProgress(false);
+      if (!streaming) {
+        setAnalysisInProgress(false);
+      }
     }
   };
 
+  // 长辈端读取本配对的预翻译开关
+  useEffect(() => {
+    if (initialRole !== 'elder') return;
+    fetch(`http://${API_BASE_URL}/api/pretranslate/${pairId}`)
+      .then(response => response.json())
+      .then(result => setPretranslate(Boolean(result.enabled)))
+      .catch(error => console.error("获取预翻译设置失败:", error));
+  }, []);
+
   // 添加副作用，在消息更新时滚动到底部
   useEffect(() => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
@@ -479,6 +754,20 @@ function App() {
       {isWebSocketReady && (
         <div className="App" style={{ fontSize: elderStyle.fontSize }}>
           <h1 className="app-title">智能聊天助手</h1>
+          <button
+            className="analysis-button"
+            onClick={analyzeAllMessages}
+            disabled={analysisInProgress}
+            style={{ fontSize: elderStyle.smallFontSize }}
+          >
+            📝翻译全部消息
+          </button>
+          {initialRole === 'elder' && (
+            <label className="pretranslate-toggle" style={{ fontSize: elderStyle.smallFontSize }}>
+              <input type="checkbox" checked={pretranslate} onChange={togglePretranslate} />
+              自动预翻译收到的消息
+            </label>
+          )}
 
           {/* <div className="user-selector">
             <label>选择用户: </label>
@@ -518,7 +807,7 @@ function App() {
                       <div className="content image-content">
                         {uploading && msg.id === Date.now() && <div className="uploading">上传中...</div>}
                         <img
-                          src={msg.image_data}
+                          src={msg.thumbnail_url || msg.image_data}
                           alt="发送的图片"
                           style={{
                             maxWidth: '200px',